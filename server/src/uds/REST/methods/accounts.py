@@ -64,6 +64,7 @@ class Accounts(ModelHandler):
         {'time_mark': {'title': _('Time mark'), 'type': 'callback'}},
         {'tags': {'title': _('tags'), 'visible': False}},
     ]
+    query_fields = {'name': 'name', 'comments': 'comments', 'time_mark': 'time_mark'}
 
     def item_as_dict(self, item: Account):
         return {
@@ -72,7 +73,7 @@ class Accounts(ModelHandler):
             'tags': [tag.tag for tag in item.tags.all()],
             'comments': item.comments,
             'time_mark': item.time_mark,
-            'permission': permissions.getEffectivePermission(self._user, item)
+            'permission': self.userPermissions().getEffectivePermission(item)
         }
 
     def getGui(self, type_: str) -> typing.List[typing.Any]:
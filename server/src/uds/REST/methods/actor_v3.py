@@ -69,7 +69,7 @@ class BlockAccess(Exception):
 
 
 def checkBlockedIp(ip: str) -> None:
-    cache = Cache('actorv3')
+    cache = Cache('actorv3', local=False)
     fails = cache.get(ip) or 0
     if fails > ALLOWED_FAILS:
         logger.info('Access to actor from %s is blocked for %s seconds since last fail', ip, GlobalConfig.LOGIN_BLOCK.getInt())
@@ -77,7 +77,7 @@ def checkBlockedIp(ip: str) -> None:
 
 
 def incFailedIp(ip: str) -> None:
-    cache = Cache('actorv3')
+    cache = Cache('actorv3', local=False)
     fails = (cache.get(ip) or 0) + 1
     cache.put(ip, fails, GlobalConfig.LOGIN_BLOCK.getInt())
 
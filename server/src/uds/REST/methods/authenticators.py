@@ -72,6 +72,13 @@ class Authenticators(ModelHandler):
         {'users_count': {'title': _('Users'), 'type': 'numeric', 'width': '5em'}},
         {'tags': {'title': _('tags'), 'visible': False}},
     ]
+    query_fields = {
+        'name': 'name',
+        'comments': 'comments',
+        'priority': 'priority',
+        'visible': 'visible',
+        'small_name': 'small_name',
+    }
 
     def enum_types(self) -> typing.Iterable[typing.Type[auths.Authenticator]]:
         return auths.factory().providers().values()
@@ -133,7 +140,7 @@ class Authenticators(ModelHandler):
             'type': type_.type(),
             'type_name': type_.name(),
             'type_info': self.typeInfo(type_),
-            'permission': permissions.getEffectivePermission(self._user, item),
+            'permission': self.userPermissions().getEffectivePermission(item),
         }
 
     # Custom "search" method
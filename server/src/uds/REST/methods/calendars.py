@@ -35,7 +35,6 @@ import typing
 
 from django.utils.translation import ugettext_lazy as _
 from uds.models import Calendar
-from uds.core.util import permissions
 
 from uds.REST.model import ModelHandler
 from .calendarrules import CalendarRules
@@ -62,6 +61,7 @@ class Calendars(ModelHandler):
         {'modified': {'title': _('Modified'), 'type': 'datetime'}},
         {'tags': {'title': _('tags'), 'visible': False}},
     ]
+    query_fields = {'name': 'name', 'comments': 'comments', 'modified': 'modified'}
 
     def item_as_dict(self, item: Calendar) -> typing.Dict[str, typing.Any]:
         return {
@@ -70,7 +70,7 @@ class Calendars(ModelHandler):
             'tags': [tag.tag for tag in item.tags.all()],
             'comments': item.comments,
             'modified': item.modified,
-            'permission': permissions.getEffectivePermission(self._user, item)
+            'permission': self.userPermissions().getEffectivePermission(item)
         }
 
     def getGui(self, type_: str) -> typing.List[typing.Any]:
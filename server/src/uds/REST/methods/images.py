@@ -59,6 +59,7 @@ class Images(ModelHandler):
         {'name': {'title': _('Name')}},
         {'size': {'title': _('Size')}},
     ]
+    query_fields = {'name': 'name'}
 
     def beforeSave(self, fields: typing.Dict[str, typing.Any]) -> None:
         fields['data'] = Image.prepareForDb(Image.decode64(fields['data'].encode('utf8')))
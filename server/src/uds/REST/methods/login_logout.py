@@ -106,7 +106,7 @@ class Login(Handler):
         Calls to any method of REST that must be authenticated needs to be called with "X-Auth-Token" Header added
         """
         # Checks if client is "blocked"
-        cache = Cache('RESTapi')
+        cache = Cache('RESTapi', local=False)
         fails = cache.get(self._request.ip) or 0
         if fails > ALLOWED_FAILS:
             logger.info('Access to REST API %s is blocked for %s seconds since last fail', self._request.ip, GlobalConfig.LOGIN_BLOCK.getInt())
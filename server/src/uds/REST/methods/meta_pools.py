@@ -76,6 +76,13 @@ class MetaPools(ModelHandler):
         {'pool_group_name': {'title': _('Pool Group')}},
         {'tags': {'title': _('tags'), 'visible': False}},
     ]
+    query_fields = {
+        'name': 'name',
+        'short_name': 'short_name',
+        'comments': 'comments',
+        'visible': 'visible',
+        'policy': 'policy',
+    }
 
     custom_methods = [('setFallbackAccess', True), ('getFallbackAccess', True)]
 
@@ -111,7 +118,7 @@ class MetaPools(ModelHandler):
             'visible': item.visible,
             'policy': item.policy,
             'fallbackAccess': item.fallbackAccess,
-            'permission': permissions.getEffectivePermission(self._user, item),
+            'permission': self.userPermissions().getEffectivePermission(item),
             'calendar_message': item.calendar_message,
         }
 
@@ -36,8 +36,6 @@ import typing
 from django.utils.translation import ugettext_lazy as _, ugettext
 
 from uds.models import Network
-from uds.core.util import net
-from uds.core.util import permissions
 from uds.core.ui import gui
 
 from uds.REST.model import ModelHandler, SaveException
@@ -62,11 +60,12 @@ class Networks(ModelHandler):
         {'networks_count': {'title': _('Used by'), 'type': 'numeric', 'width': '8em'}},
         {'tags': {'title': _('tags'), 'visible': False}},
     ]
+    query_fields = {'name': 'name', 'net_string': 'net_string'}
 
     def beforeSave(self, fields: typing.Dict[str, typing.Any]) -> None:
         logger.debug('Before %s', fields)
         try:
-            nr = net.networkFromString(fields['net_string'])
+            nr = Network.storedRange(fields['net_string'])
             fields['net_start'] = nr[0]
             fields['net_end'] = nr[1]
         except Exception as e:
@@ -92,5 +91,5 @@ class Networks(ModelHandler):
             'tags': [tag.tag for tag in item.tags.all()],
             'net_string': item.net_string,
             'networks_count': item.transports.count(),
-            'permission': permissions.getEffectivePermission(self._user, item)
+            'permission': self.userPermissions().getEffectivePermission(item)
         }
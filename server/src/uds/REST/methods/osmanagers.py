@@ -36,7 +36,6 @@ import typing
 from django.utils.translation import ugettext, ugettext_lazy as _
 
 from uds.core import osmanagers
-from uds.core.util import permissions
 from uds.models import OSManager
 from uds.REST import NotFound, RequestError
 from uds.REST.model import ModelHandler
@@ -58,6 +57,7 @@ class OsManagers(ModelHandler):
         {'deployed_count': {'title': _('Used by'), 'type': 'numeric', 'width': '8em'}},
         {'tags': {'title': _('tags'), 'visible': False}},
     ]
+    query_fields = {'name': 'name', 'comments': 'comments'}
 
     def osmToDict(self, osm: OSManager) -> typing.Dict[str, typing.Any]:
         type_ = osm.getType()
@@ -70,7 +70,7 @@ class OsManagers(ModelHandler):
             'type_name': type_.name(),
             'servicesTypes': type_.servicesType,
             'comments': osm.comments,
-            'permission': permissions.getEffectivePermission(self._user, osm)
+            'permission': self.userPermissions().getEffectivePermission(osm)
         }
 
     def item_as_dict(self, item: OSManager) -> typing.Dict[str, typing.Any]:
@@ -78,6 +78,7 @@ class Providers(ModelHandler):
         },  # , 'width': '132px'
         {'tags': {'title': _('tags'), 'visible': False}},
     ]
+    query_fields = {'name': 'name', 'comments': 'comments', 'maintenance_mode': 'maintenance_mode'}
     # Field from where to get "class" and prefix for that class, so this will generate "row-state-A, row-state-X, ....
     table_row_style = {'field': 'maintenance_mode', 'prefix': 'row-maintenance-'}
 
@@ -110,7 +111,7 @@ class Providers(ModelHandler):
             'type': type_.type(),
             'type_name': type_.name(),
             'comments': item.comments,
-            'permission': permissions.getEffectivePermission(self._user, item),
+            'permission': self.userPermissions().getEffectivePermission(item),
         }
 
     def checkDelete(self, item: Provider) -> None:
@@ -134,9 +135,10 @@ class Providers(ModelHandler):
         """
         Custom method that returns "all existing services", no mater who's his daddy :)
         """
-        for s in Service.objects.all():
+        userPermissions = self.userPermissions()
+        for s in userPermissions.filterQuery(Service.objects.all()):
             try:
-                perm = permissions.getEffectivePermission(self._user, s)
+                perm = userPermissions.getEffectivePermission(s)
                 if perm >= permissions.PERMISSION_READ:
                     yield DetailServices.serviceToDict(s, perm, True)
             except Exception:
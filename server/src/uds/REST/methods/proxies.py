@@ -36,7 +36,6 @@ import typing
 from django.utils.translation import ugettext_lazy as _, ugettext
 from uds.models import Proxy
 from uds.core.ui import gui
-from uds.core.util import permissions
 
 from uds.REST.model import ModelHandler
 
@@ -62,6 +61,15 @@ class Proxies(ModelHandler):
         {'comments': {'title': _('Comments')}},
         {'tags': {'title': _('tags'), 'visible': False}},
     ]
+    query_fields = {
+        'name': 'name',
+        'comments': 'comments',
+        'url': 'url',
+        'host': 'host',
+        'port': 'port',
+        'ssl': 'ssl',
+        'check_cert': 'check_cert',
+    }
 
     def item_as_dict(self, item: Proxy) -> typing.Dict[str, typing.Any]:
         return {
@@ -74,7 +82,7 @@ class Proxies(ModelHandler):
             'port': item.port,
             'ssl': item.ssl,
             'check_cert': item.check_cert,
-            'permission': permissions.getEffectivePermission(self._user, item)
+            'permission': self.userPermissions().getEffectivePermission(item)
         }
 
     def getGui(self, type_: str) -> typing.List[typing.Any]:
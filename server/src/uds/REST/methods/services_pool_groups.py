@@ -63,6 +63,7 @@ class ServicesPoolGroups(ModelHandler):
         {'name': {'title': _('Name')}},
         {'comments': {'title': _('Comments')}},
     ]
+    query_fields = {'name': 'name', 'comments': 'comments', 'priority': 'priority'}
 
     def beforeSave(self, fields: typing.Dict[str, typing.Any]) -> None:
         imgId = fields['image_id']
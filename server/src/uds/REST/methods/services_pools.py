@@ -141,6 +141,16 @@ class ServicesPools(ModelHandler):
         {'parent': {'title': _('Parent service')}},
         {'tags': {'title': _('tags'), 'visible': False}},
     ]
+    query_fields = {
+        'name': 'name',
+        'short_name': 'short_name',
+        'comments': 'comments',
+        'parent': 'service__name',
+        'visible': 'visible',
+        'show_transports': 'show_transports',
+        'user_services_count': 'valid_count',
+        'user_services_in_preparation': 'preparing_count',
+    }
     # Field from where to get "class" and prefix for that class, so this will generate "row-state-A, row-state-X, ....
     table_row_style = {'field': 'state', 'prefix': 'row-state-'}
 
@@ -293,7 +303,7 @@ class ServicesPools(ModelHandler):
             val['user_services_in_preparation'] = preparing_count
             val['tags'] = [tag.tag for tag in item.tags.all()]
             val['restrained'] = restrained
-            val['permission'] = permissions.getEffectivePermission(self._user, item)
+            val['permission'] = self.userPermissions().getEffectivePermission(item)
             val['info'] = Services.serviceInfo(item.service)
             val['pool_group_id'] = poolGroupId
             val['pool_group_name'] = poolGroupName
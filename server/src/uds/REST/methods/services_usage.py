@@ -52,6 +52,17 @@ class ServicesUsage(DetailHandler):
     """
     Rest handler for Assigned Services, which parent is Service
     """
+    query_fields = {
+        'unique_id': 'unique_id',
+        'friendly_name': 'friendly_name',
+        'state_date': 'state_date',
+        'creation_date': 'creation_date',
+        'service': 'deployed_service__service__name',
+        'pool': 'deployed_service__name',
+        'source_host': 'src_hostname',
+        'source_ip': 'src_ip',
+        'in_use': 'in_use',
+    }
 
     @staticmethod
     def itemToDict(item: UserService) -> typing.Dict[str, typing.Any]:
@@ -100,7 +111,11 @@ class ServicesUsage(DetailHandler):
             else:
                 userServicesQuery = UserService.objects.filter(deployed_service__service_uuid=processUuid(item))
 
-            return [ServicesUsage.itemToDict(k) for k in userServicesQuery.filter(state=State.USABLE).order_by('creation_date').
+            userServicesQuery = self.listParameters().applyToQuery(
+                userServicesQuery.filter(state=State.USABLE).order_by('creation_date'), self.query_fields
+            )
+
+            return [ServicesUsage.itemToDict(k) for k in userServicesQuery.
                     prefetch_related('deployed_service').prefetch_related('deployed_service__service').prefetch_related('properties').
                     prefetch_related('user').prefetch_related('user__manager')]
 
@@ -36,7 +36,6 @@ import typing
 from django.utils.translation import ugettext_lazy as _, ugettext
 from uds.models import Transport, Network, ServicePool
 from uds.core import transports
-from uds.core.util import permissions
 from uds.core.util import os_detector as OsDetector
 
 from uds.REST.model import ModelHandler
@@ -61,6 +60,12 @@ class Transports(ModelHandler):
         {'allowed_oss': {'title': _('Devices'), 'width': '8em'}},
         {'tags': {'title': _('tags'), 'visible': False}},
     ]
+    query_fields = {
+        'name': 'name',
+        'comments': 'comments',
+        'priority': 'priority',
+        'nets_positive': 'nets_positive',
+    }
 
     def enum_types(self) -> typing.Iterable[typing.Type[transports.Transport]]:
         return transports.factory().providers().values()
@@ -128,7 +133,7 @@ class Transports(ModelHandler):
             'type': type_.type(),
             'type_name': type_.name(),
             'protocol': type_.protocol,
-            'permission': permissions.getEffectivePermission(self._user, item)
+            'permission': self.userPermissions().getEffectivePermission(item)
         }
 
     def beforeSave(self, fields: typing.Dict[str, typing.Any]) -> None:
@@ -35,7 +35,7 @@ import typing
 from uds import models
 from uds.core import managers
 from uds.REST import Handler
-from uds.REST import AccessDenied
+from uds.REST import AccessDenied, NotFound
 from uds.core.auths.auth import isTrustedSource
 from uds.core.util import log, net
 from uds.core.util.stats import events
@@ -73,6 +73,15 @@ class Tunnel(Handler):
             user, userService, host, port, extra = models.TicketStore.get_for_tunnel(
                 self._args[0]
             )
+        except models.TicketStore.InvalidTicket as e:
+            # Unknown ticket, distinct answer so the tunnel server can cache it
+            logger.info('Ticket not found: %s', e)
+            raise NotFound('Ticket not found')
+        except Exception as e:
+            logger.error('Error getting ticket: %s', e)
+            raise AccessDenied()
+
+        try:
             data = {}
             if self._args[1][:4] == 'stop':
                 sent, recv = self._params['sent'], self._params['recv']
@@ -84,7 +93,7 @@ class Tunnel(Handler):
                 log.doLog(user.manager, log.INFO, msg)
                 log.doLog(userService, log.INFO, msg)
             else:
-                if net.ipToLong(self._args[1][:32]) == 0:
+                if net.ipToLongAndVersion(self._args[1][:64])[0] == 0:
                     raise Exception('Invalid from IP')
                 events.addEvent(
                     userService.deployed_service,
@@ -53,6 +53,17 @@ class AssignedService(DetailHandler):
     """
 
     custom_methods = ['reset']
+    query_fields = {
+        'unique_id': 'unique_id',
+        'friendly_name': 'friendly_name',
+        'os_state': 'os_state',
+        'state_date': 'state_date',
+        'creation_date': 'creation_date',
+        'in_use': 'in_use',
+        'in_use_date': 'in_use_date',
+        'source_host': 'src_hostname',
+        'source_ip': 'src_ip',
+    }
 
     @staticmethod
     def itemToDict(
@@ -112,10 +123,11 @@ class AssignedService(DetailHandler):
             if not item:
                 return [
                     AssignedService.itemToDict(k)
-                    for k in parent.assignedUserServices()
-                    .all()
-                    .prefetch_related(
-                        'properties', 'deployed_service', 'publication', 'user'
+                    for k in self.listParameters().applyToQuery(
+                        parent.assignedUserServices().prefetch_related(
+                            'properties', 'deployed_service', 'publication', 'user'
+                        ),
+                        self.query_fields,
                     )
                 ]
             return AssignedService.itemToDict(
@@ -237,15 +249,27 @@ class CachedService(AssignedService):
     Rest handler for Cached Services, wich parent is Service
     """
 
+    query_fields = {
+        'unique_id': 'unique_id',
+        'friendly_name': 'friendly_name',
+        'os_state': 'os_state',
+        'state_date': 'state_date',
+        'creation_date': 'creation_date',
+        'cache_level': 'cache_level',
+    }
+
     def getItems(self, parent: models.ServicePool, item: typing.Optional[str]):
         # Extract provider
         try:
             if not item:
                 return [
                     AssignedService.itemToDict(k, True)
-                    for k in parent.cachedUserServices()
-                    .all()
-                    .prefetch_related('properties', 'deployed_service', 'publication')
+                    for k in self.listParameters().applyToQuery(
+                        parent.cachedUserServices().prefetch_related(
+                            'properties', 'deployed_service', 'publication'
+                        ),
+                        self.query_fields,
+                    )
                 ]
             cachedService: models.UserService = parent.cachedUserServices().get(
                 uuid=processUuid(item)
@@ -79,6 +79,15 @@ def getPoolsForGroups(groups):
 class Users(DetailHandler):
 
     custom_methods = ['servicesPools', 'userServices']
+    query_fields = {
+        'name': 'name',
+        'real_name': 'real_name',
+        'comments': 'comments',
+        'state': 'state',
+        'staff_member': 'staff_member',
+        'is_admin': 'is_admin',
+        'last_access': 'last_access',
+    }
 
     @staticmethod
     def uuid_to_id(iterator):
@@ -92,7 +101,11 @@ class Users(DetailHandler):
         # Extract authenticator
         try:
             if item is None:
-                values = list(Users.uuid_to_id(parent.users.all().values('uuid', 'name', 'real_name', 'comments', 'state', 'staff_member', 'is_admin', 'last_access', 'parent')))
+                query = self.listParameters().applyToQuery(
+                    parent.users.all().values('uuid', 'name', 'real_name', 'comments', 'state', 'staff_member', 'is_admin', 'last_access', 'parent'),
+                    self.query_fields,
+                )
+                values = list(Users.uuid_to_id(query))
                 for res in values:
                     res['role'] = res['staff_member'] and (res['is_admin'] and _('Admin') or _('Staff member')) or _('User')
                 return values
@@ -244,12 +257,16 @@ class Groups(DetailHandler):
 
     custom_methods = ['servicesPools', 'users']
 
+    query_fields = {'name': 'name', 'comments': 'comments', 'state': 'state', 'meta_if_any': 'meta_if_any'}
+
     def getItems(self, parent, item):
         try:
             multi = False
             if item is None:
                 multi = True
-                q = parent.groups.all().order_by('name')
+                q = self.listParameters().applyToQuery(
+                    parent.groups.all().order_by('name'), self.query_fields
+                )
             else:
                 q = parent.groups.filter(uuid=processUuid(item))
             res = []
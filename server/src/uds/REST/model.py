@@ -74,6 +74,15 @@ LOG = 'log'
 
 OK = 'ok'  # Constant to be returned when result is just "operation complete successfully"
 
+# List parameters
+FILTER = 'filter'
+SORT = 'sort'
+OFFSET = 'offset'
+LIMIT = 'limit'
+
+# Header with the total number of items of a paginated list
+TOTAL_COUNT_HEADER = 'X-Total-Count'
+
 # Exception to "rethrow" on save error
 class SaveException(HandlerError):
     """
@@ -81,11 +90,181 @@ class SaveException(HandlerError):
     """
 
 
+class ListParameters:
+    """
+    Filtering, sorting and pagination requested for a list of items:
+    ?filter=fld=pattern, unix file like pattern (case insensitive), with ^ and $ supported
+    ?sort=fld1,-fld2, comma separated fields, "-" for descending order
+    ?offset=N&limit=M
+
+    Handlers push them into the db query for the fields they know (applyToQuery),
+    and whatever is not done there is done over the resulting list (applyToList)
+    """
+
+    fltr: typing.Optional[str]
+    sort: typing.List[str]
+    offset: int
+    limit: typing.Optional[int]
+    # Total number of items (before pagination), if pagination has been requested
+    total: typing.Optional[int]
+
+    # Already done on query
+    filtered: bool
+    sorted: bool
+    paginated: bool
+
+    def __init__(self, params: typing.Any) -> None:
+        self.fltr, self.sort, self.offset, self.limit = None, [], 0, None
+        self.total = None
+        self.filtered = self.sorted = self.paginated = False
+        if not isinstance(params, dict):
+            return
+
+        # Filter is removed from params, as it was done before. Other parameters are kept, because
+        # they can have meaning for non list requests (for example, limit on searches)
+        if FILTER in params:
+            self.fltr = params[FILTER]
+            del params[FILTER]
+            logger.debug('Found a filter expression (%s)', self.fltr)
+        self.sort = [f for f in params.get(SORT, '').split(',') if f.strip('-')]
+        try:
+            self.offset = max(int(params.get(OFFSET, 0)), 0)
+            self.limit = max(int(params[LIMIT]), 0) if LIMIT in params else None
+        except ValueError:
+            raise RequestError('Invalid pagination parameters')
+
+    @property
+    def paging(self) -> bool:
+        return self.limit is not None or self.offset > 0
+
+    def filterExpression(self) -> typing.Tuple[str, str]:
+        try:
+            fld, pattern = typing.cast(str, self.fltr).split('=')
+            if pattern[:1] == '^':  # Patterns always match the whole value
+                pattern = pattern[1:]
+            if pattern[-1:] == '$':
+                pattern = pattern[:-1]
+            return fld, pattern
+        except Exception:
+            logger.info('Filtering expression %s is invalid!', self.fltr)
+            raise RequestError('Filtering expression {} is invalid'.format(self.fltr))
+
+    def filterQuery(self, lookup: str, pattern: str) -> models.Q:
+        # Simple patterns (only * on the edges) are translated to its lookups, and the rest to regex
+        inner = pattern.strip('*')
+        if '*' not in inner and '?' not in inner:
+            if not inner:
+                return models.Q(**{lookup + '__isnull': False})
+            lookups = {
+                (False, False): 'iexact',
+                (True, False): 'iendswith',
+                (False, True): 'istartswith',
+                (True, True): 'icontains',
+            }
+            kind = lookups[(pattern[:1] == '*', pattern[-1:] == '*')]
+            return models.Q(**{lookup + '__' + kind: inner})
+
+        regex = ''.join(
+            '.*' if c == '*' else '.' if c == '?' else re.escape(c) for c in pattern
+        )
+        return models.Q(**{lookup + '__iregex': '^' + regex + '$'})
+
+    def applyToQuery(
+        self,
+        query: 'models.QuerySet',
+        fields: typing.Mapping[str, str],
+        paginate: bool = True,
+    ) -> 'models.QuerySet':
+        """
+        Pushes filter, sort and pagination into query for known fields.
+        fields maps returned item fields to query lookups.
+        Pagination is only done if filter and sorting has been done too (and paginate is True).
+        paginate must be False if items of the query can be skipped later, or pages will be short
+        """
+        if self.fltr and not self.filtered:
+            fld, pattern = self.filterExpression()
+            # Sets ([...]) are not supported on db
+            if fld in fields and '[' not in pattern:
+                query = query.filter(self.filterQuery(fields[fld], pattern))
+                self.filtered = True
+
+        if self.sort and not self.sorted:
+            if all(f.lstrip('-') in fields for f in self.sort):
+                # Nulls go last (first if descending), as on applyToList, whatever the db default is
+                query = query.order_by(
+                    *(
+                        models.F(fields[f[1:]]).desc(nulls_first=True)
+                        if f[0] == '-'
+                        else models.F(fields[f]).asc(nulls_last=True)
+                        for f in self.sort
+                    ),
+                    'pk',  # So pages are stable
+                )
+                self.sorted = True
+
+        if (
+            paginate
+            and self.paging
+            and not self.paginated
+            and (self.filtered or not self.fltr)
+            and (self.sorted or not self.sort)
+        ):
+            self.total = query.count()
+            end = None if self.limit is None else self.offset + self.limit
+            query = query[self.offset : end]
+            self.paginated = True
+
+        return query
+
+    def applyToList(self, data: typing.Iterable[typing.Any]) -> typing.List[typing.Any]:
+        """
+        Filters, sorts and paginates (whatever not done on query) a list of items
+        """
+        if self.fltr and not self.filtered:
+            fld, pattern = self.filterExpression()
+            r = re.compile(fnmatch.translate(pattern), re.RegexFlag.IGNORECASE)
+
+            def fltr_function(item: typing.Any) -> bool:
+                try:
+                    if fld not in item or r.match(item[fld]) is None:
+                        return False
+                except Exception:
+                    return False
+                return True
+
+            data = filter(fltr_function, data)
+
+        result = list(data)
+
+        if self.sort and not self.sorted:
+            # Sorted by last field first, as sort is stable. None values go last (first if descending)
+            for f in reversed(self.sort):
+                fld = f.lstrip('-')
+
+                def key(item: typing.Any) -> typing.Tuple[bool, typing.Any]:
+                    value = item.get(fld) if isinstance(item, dict) else None
+                    return (value is None, value if value is not None else '')
+
+                try:
+                    result.sort(key=key, reverse=f[0] == '-')
+                except TypeError:  # Mixed types
+                    result.sort(key=lambda item: str(key(item)), reverse=f[0] == '-')
+
+        if self.paging and not self.paginated:
+            self.total = len(result)
+            end = None if self.limit is None else self.offset + self.limit
+            result = result[self.offset : end]
+
+        return result
+
+
 class BaseModelHandler(Handler):
     """
     Base Handler for Master & Detail Handlers
     """
 
+    _userPermissions: typing.Optional[permissions.UserPermissions] = None
+
     def addField(
         self, gui: typing.List[typing.Any], field: typing.Dict[str, typing.Any]
     ) -> typing.List[typing.Any]:
@@ -208,10 +387,20 @@ class BaseModelHandler(Handler):
 
         return gui
 
+    def userPermissions(self) -> permissions.UserPermissions:
+        """
+        Permissions of the request user, loaded once per request (and cached per session)
+        """
+        if self._userPermissions is None:
+            self._userPermissions = permissions.UserPermissions(
+                self._user, getattr(self, '_authToken', None)
+            )
+        return self._userPermissions
+
     def ensureAccess(
         self, obj: models.Model, permission: int, root: bool = False
     ) -> int:
-        perm = permissions.getEffectivePermission(self._user, obj, root)
+        perm = self.userPermissions().getEffectivePermission(obj, root)
         if perm < permission:
             raise self.accessDenied()
         return perm
@@ -382,6 +571,8 @@ class DetailHandler(BaseModelHandler):
     """
 
     custom_methods: typing.ClassVar[typing.List[str]] = []
+    # Item fields that can be filtered and sorted on db (field --> query lookup)
+    query_fields: typing.ClassVar[typing.Dict[str, str]] = {}
     _parent: typing.Optional['ModelHandler']
     _path: str
     _params: typing.Any  # _params is deserialized object from request
@@ -531,6 +722,19 @@ class DetailHandler(BaseModelHandler):
 
         return OK
 
+    def userPermissions(self) -> permissions.UserPermissions:
+        if self._parent:
+            return self._parent.userPermissions()
+        return super().userPermissions()
+
+    def listParameters(self) -> ListParameters:
+        """
+        Filter, sort and pagination requested for lists (kept by parent handler)
+        """
+        if self._parent:
+            return self._parent.listParameters()
+        return ListParameters(None)
+
     def fallbackGet(self) -> typing.Any:
         """
         Invoked if default get can't process request.
@@ -664,6 +868,11 @@ class ModelHandler(BaseModelHandler):
 
     # By default, filter is empty
     fltr: typing.Optional[str] = None
+    _listParameters: typing.Optional[ListParameters] = None
+
+    # Item fields that can be filtered and sorted on db (field --> query lookup)
+    # Other fields are filtered and sorted on returned list of items
+    query_fields: typing.ClassVar[typing.Dict[str, str]] = {}
 
     # This is an array of tuples of two items, where first is method and second inticates if method needs parent id (normal behavior is it needs it)
     # For example ('services', True) -- > .../id_parent/services
@@ -761,18 +970,22 @@ class ModelHandler(BaseModelHandler):
 
     # End overridable
 
+    def listParameters(self) -> ListParameters:
+        """
+        Filter, sort and pagination requested for lists
+        """
+        if self._listParameters is None:
+            self._listParameters = ListParameters(self._params)
+        return self._listParameters
+
     def extractFilter(self) -> None:
-        # Extract filter from params if present
-        self.fltr = None
-        if 'filter' in self._params:
-            self.fltr = self._params['filter']
-            del self._params['filter']  # Remove parameter
-            logger.debug('Found a filter expression (%s)', self.fltr)
+        # Extract filter (and sort and pagination) from params if present
+        self.fltr = self.listParameters().fltr
 
     def doFilter(self, data: typing.Any) -> typing.Any:
-        # Right now, filtering only supports a single filter, in a future
-        # we may improve it
-        if self.fltr is None:
+        # Filters, sorts and paginates lists, for whatever has not been already done on db
+        params = self.listParameters()
+        if not (params.fltr or params.sort or params.paging):
             return data
 
         # Filtering a non iterable (list or tuple)
@@ -780,34 +993,10 @@ class ModelHandler(BaseModelHandler):
             return data
 
         logger.debug('data: %s, fltr: %s', data, self.fltr)
-        try:
-            fld, pattern = self.fltr.split('=')
-            s, e = '', ''
-            if pattern[0] == '^':
-                pattern = pattern[1:]
-                s = '^'
-            if pattern[-1] == '$':
-                pattern = pattern[:-1]
-                e = '$'
-
-            r = re.compile(s + fnmatch.translate(pattern) + e, re.RegexFlag.IGNORECASE)
-
-            def fltr_function(item: typing.MutableMapping[str, typing.Any]):
-                try:
-                    if fld not in item or r.match(item[fld]) is None:
-                        return False
-                except Exception:
-                    return False
-                return True
-
-            res = list(filter(fltr_function, data))
-
-            logger.debug('After filtering: %s', res)
-            return res
-        except:
-            logger.exception('Exception:')
-            logger.info('Filtering expression %s is invalid!', self.fltr)
-            raise RequestError('Filtering expression {} is invalid'.format(self.fltr))
+        res = params.applyToList(data)
+        if params.total is not None:
+            self.addHeader(TOTAL_COUNT_HEADER, str(params.total))
+        return res
 
     # Helper to process detail
     # Details can be managed (writen) by any user that has MANAGEMENT permission over parent
@@ -882,14 +1071,16 @@ class ModelHandler(BaseModelHandler):
                 *prefetch
             )
 
+        # Only readable items, and filter and sort on db for known fields. Pagination is done
+        # over the returned list, as items can still be skipped here (permissions, failures)
+        userPermissions = self.userPermissions()
+        query = userPermissions.filterQuery(query, permissions.PERMISSION_READ)
+        query = self.listParameters().applyToQuery(query, self.query_fields, paginate=False)
+
         for item in query:
             try:
                 if (
-                    permissions.checkPermissions(
-                        typing.cast('User', self._user),
-                        item,
-                        permissions.PERMISSION_READ,
-                    )
+                    userPermissions.checkPermissions(item, permissions.PERMISSION_READ)
                     is False
                 ):
                     continue
@@ -916,8 +1107,9 @@ class ModelHandler(BaseModelHandler):
         logger.debug('method GET for %s, %s', self.__class__.__name__, self._args)
         nArgs = len(self._args)
 
+        # Items are not retrieved here, but while the response is being streamed
         if nArgs == 0:
-            return list(self.getItems(overview=False))
+            return self.getItems(overview=False)
 
         # if has custom methods, look for if this request matches any of them
         for cm in self.custom_methods:
@@ -950,7 +1142,7 @@ class ModelHandler(BaseModelHandler):
 
         if nArgs == 1:
             if self._args[0] == OVERVIEW:
-                return list(self.getItems())
+                return self.getItems()
             if self._args[0] == TYPES:
                 return list(self.getTypes())
             if self._args[0] == TABLEINFO:
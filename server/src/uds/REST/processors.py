@@ -31,6 +31,7 @@
 @author: Adolfo Gómez, dkmaster at dkmon dot com
 """
 import datetime
+import itertools
 import json
 import logging
 import time
@@ -43,6 +44,9 @@ from django import http
 
 logger = logging.getLogger(__name__)
 
+# Responses are streamed in chunks of (at least) this size
+STREAM_CHUNK_SIZE = 64 * 1024
+
 
 class ParametersException(Exception):
     pass
@@ -54,6 +58,8 @@ class ContentProcessor:
     """
     mime_type: typing.ClassVar[str] = ''
     extensions: typing.ClassVar[typing.Iterable[str]] = []
+    # If true, lists and generators are rendered incrementally (see renderChunks)
+    streaming: typing.ClassVar[bool] = False
 
     _request: http.HttpRequest
 
@@ -79,9 +85,17 @@ class ContentProcessor:
     def getResponse(self, obj):
         """
         Converts an obj to a response of specific type (json, XML, ...)
-        This is done using "render" method of specific type
+        This is done using "render" method of specific type, or "renderChunks" for
+        lists and generators if the processor supports streaming
         """
-        return http.HttpResponse(content=self.render(obj), content_type=self.mime_type + "; charset=utf-8")
+        contentType = self.mime_type + "; charset=utf-8"
+        if self.streaming and isinstance(obj, (list, tuple, types.GeneratorType)):
+            chunks = self.renderChunks(obj)
+            # First chunk (and so, the query behind a generator) is got here, so its errors
+            # are reported as an error response instead of a truncated one
+            first = next(chunks)
+            return http.StreamingHttpResponse(itertools.chain((first,), chunks), content_type=contentType)
+        return http.HttpResponse(content=self.render(obj), content_type=contentType)
 
     def render(self, obj: typing.Any):
         """
@@ -89,6 +103,13 @@ class ContentProcessor:
         """
         return str(obj)
 
+    def renderChunks(self, obj: typing.Iterable[typing.Any]) -> typing.Iterator[str]:
+        """
+        Renders a list (or generator) of objects in chunks, so it is not needed to keep
+        the whole rendered result in memory
+        """
+        yield self.render(obj)
+
     @staticmethod
     def procesForRender(obj: typing.Any):
         """
@@ -139,6 +160,24 @@ class MarshallerProcessor(ContentProcessor):
 # ---------------
 # Json Processor
 # ---------------
+class RESTEncoder(json.JSONEncoder):
+    """
+    Json encoder that converts, while encoding, the types that json does not know
+    the same way procesForRender does
+    """
+    def default(self, o: typing.Any) -> typing.Any:  # pylint: disable=method-hidden
+        if isinstance(o, (datetime.datetime, datetime.date)):
+            return int(time.mktime(o.timetuple()))
+
+        if isinstance(o, bytes):
+            return o.decode('utf-8')
+
+        if isinstance(o, types.GeneratorType):
+            return list(o)
+
+        return str(o)
+
+
 class JsonProcessor(MarshallerProcessor):
     """
     Provides JSON content processor
@@ -146,6 +185,36 @@ class JsonProcessor(MarshallerProcessor):
     mime_type = 'application/json'
     extensions = ['json']
     marshaller = json  # type: ignore
+    streaming = True
+
+    def render(self, obj: typing.Any) -> str:
+        return RESTEncoder().encode(obj)
+
+    def renderChunks(self, obj: typing.Iterable[typing.Any]) -> typing.Iterator[str]:
+        # Items are encoded one by one (as generators are consumed), and sent in chunks.
+        # Once something has been sent, errors can only be logged, and the list is closed
+        # so the response is still valid json
+        encoder = RESTEncoder()
+        chunk: typing.List[str] = ['[']
+        size = 0
+        sent = False
+        try:
+            for item in obj:
+                data = encoder.encode(item)
+                if size:
+                    chunk.append(encoder.item_separator)
+                chunk.append(data)
+                size += len(data) + 1
+                if size >= STREAM_CHUNK_SIZE:
+                    sent = True
+                    yield ''.join(chunk)
+                    chunk, size = [], 1
+        except Exception:
+            if not sent:
+                raise
+            logger.exception('Error streaming response, response truncated')
+        chunk.append(']')
+        yield ''.join(chunk)
 
 # ---------------
 # XML Processor
@@ -85,6 +85,10 @@ default_app_config = 'uds.UDSAppConfig'
 
 @receiver(connection_created)
 def extend_sqlite(connection=None, **kwargs):
+    # New connection (first one, reconnect or failover), database clock may have changed
+    from uds.models.util import DatabaseClock  # pylint: disable=import-outside-toplevel
+
+    DatabaseClock.reset()
     if connection.vendor == "sqlite":
         logger.debug('Connection vendor is sqlite, extending methods')
         cursor = connection.cursor()
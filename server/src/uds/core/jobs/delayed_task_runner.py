@@ -32,58 +32,99 @@ import time
 import codecs
 import pickle
 import threading
+import collections
 from socket import gethostname
-from datetime import timedelta
+from datetime import datetime, timedelta
 import logging
 import typing
 
-from django.db import connections
+from django.db import connection, connections
 from django.db import transaction
-from django.db.models import Q
+from django.db.models import Q, Min, Count
 
 from uds.models import DelayedTask as DBDelayedTask
 from uds.models import getSqlDatetime
 from uds.core.environment import Environment
+from uds.core.util.config import GlobalConfig
 
 from .delayed_task import DelayedTask
+from .worker_pool import WorkerPool
 
 logger = logging.getLogger(__name__)
 
 
-class DelayedTaskThread(threading.Thread):
+class DelayedTaskMetrics:
     """
-    Class responsible of executing a delayed task in its own thread
+    Queue depth, lag & throughput of the delayed task runner (for this server)
     """
-    _taskInstance: DelayedTask
 
-    def __init__(self, taskInstance: DelayedTask) -> None:
-        super().__init__()
-        self._taskInstance = taskInstance
+    WINDOW = 60  # Seconds used to compute lag & throughput
 
-    def run(self):
-        try:
-            self._taskInstance.execute()
-        except Exception as e:
-            logger.exception("Exception in thread %s: %s", e.__class__, e)
-        finally:
-            connections['default'].close()
+    _lock: threading.Lock
+    _executed: 'collections.deque[typing.Tuple[float, float]]'  # (monotonic time, lag)
+    total: int
+    queueDepth: int
+    nextExecution: typing.Optional[datetime]
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._executed = collections.deque()
+        self.total = 0
+        self.queueDepth = 0
+        self.nextExecution = None
+
+    def _purge(self, now: float) -> None:
+        while self._executed and self._executed[0][0] < now - DelayedTaskMetrics.WINDOW:
+            self._executed.popleft()
+
+    def claimed(self, lag: float) -> None:
+        now = time.monotonic()
+        with self._lock:
+            self.total += 1
+            self._executed.append((now, lag))
+            self._purge(now)
+
+    def asDict(self) -> typing.Dict[str, typing.Any]:
+        with self._lock:
+            self._purge(time.monotonic())
+            lags = [lag for _, lag in self._executed]
+            return {
+                'total': self.total,
+                'queue_depth': self.queueDepth,
+                'next_execution': self.nextExecution,
+                'throughput': len(lags) / DelayedTaskMetrics.WINDOW,
+                'lag_avg': sum(lags) / len(lags) if lags else 0.0,
+                'lag_max': max(lags) if lags else 0.0,
+            }
 
 
 class DelayedTaskRunner:
     """
     Delayed task runner class
     """
-    # How often tasks are checked
+    # Max time between checks. Runner sleeps until next task execution time, but no more than this
     granularity: int = 2
+    # Interval (seconds) between queue depth samples while there is a backlog
+    metricsInterval: int = 10
 
     # to keep singleton DelayedTaskRunner
     _runner: typing.ClassVar[typing.Optional['DelayedTaskRunner']] = None
     _hostname: str
     _keepRunning: bool
+    _pool: typing.Optional[WorkerPool]
+    _poolLock: threading.Lock
+    _wakeup: threading.Event
+    _lastSample: float
+    metrics: DelayedTaskMetrics
 
     def __init__(self):
         self._hostname = gethostname()
         self._keepRunning = True
+        self._pool = None
+        self._poolLock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._lastSample = 0.0
+        self.metrics = DelayedTaskMetrics()
         logger.debug("Initializing delayed task runner for host %s", self._hostname)
 
     def notifyTermination(self) -> None:
@@ -92,6 +133,7 @@ class DelayedTaskRunner:
         It will mark the thread to "stop" ASAP
         """
         self._keepRunning = False
+        self._wakeup.set()
 
     @staticmethod
     def runner() -> 'DelayedTaskRunner':
@@ -104,31 +146,99 @@ class DelayedTaskRunner:
             DelayedTaskRunner._runner = DelayedTaskRunner()
         return DelayedTaskRunner._runner
 
-    def executeOneDelayedTask(self) -> None:
-        now = getSqlDatetime()
-        filt = Q(execution_time__lt=now) | Q(insert_date__gt=now + timedelta(seconds=30))
-        # If next execution is before now or last execution is in the future (clock changed on this server, we take that task as executable)
+    @property
+    def pool(self) -> WorkerPool:
+        """
+        Workers pool, shared by all runner threads
+        """
+        with self._poolLock:
+            if self._pool is None:
+                self._pool = WorkerPool('DelayedTask', GlobalConfig.DELAYED_TASKS_WORKERS.getInt())
+            return self._pool
+
+    @staticmethod
+    def _execute(taskInstance: DelayedTask) -> None:
+        taskInstance.execute()
+
+    def getMetrics(self) -> typing.Dict[str, typing.Any]:
+        metrics = self.metrics.asDict()
+        pool = self.pool
+        metrics.update(workers=pool.size, in_flight=pool.inFlight)
+        return metrics
+
+    def _sampleQueue(self, now: datetime) -> typing.Optional[datetime]:
+        """
+        Updates queue depth metrics and returns next execution time
+        """
+        data = DBDelayedTask.objects.aggregate(
+            next=Min('execution_time'), due=Count('id', filter=Q(execution_time__lt=now))
+        )
+        self.metrics.queueDepth = data['due'] or 0
+        self.metrics.nextExecution = data['next']
+        self._lastSample = time.monotonic()
+        return data['next']
+
+    def executeDelayedTasks(self) -> float:
+        """
+        Claims (in a single transaction) as many due tasks as free workers are, and dispatches them.
+
+        Returns the number of seconds that the runner should wait before next claim
+        """
+        pool = self.pool
+        reserved = pool.reserve(pool.size)
+        if reserved == 0:  # All workers busy, wait for one to be available
+            pool.waitForSlot(self.granularity)
+            return 0
+
+        submitted = 0
+        tasks: typing.List[DBDelayedTask] = []
         try:
+            now = getSqlDatetime()
+            filt = Q(execution_time__lt=now) | Q(insert_date__gt=now + timedelta(seconds=30))
+            # If next execution is before now or last execution is in the future (clock changed on this server, we take that task as executable)
+            # Skip rows locked by other runners (threads or servers) if database supports it, so they do not wait for each other
+            lockArgs = {'skip_locked': True} if connection.features.has_select_for_update_skip_locked else {}
             with transaction.atomic():  # Encloses
-                # Throws exception if no delayed task is avilable
-                task = DBDelayedTask.objects.select_for_update().filter(filt).order_by('execution_time')[0]  # @UndefinedVariable
+                tasks = list(
+                    DBDelayedTask.objects.select_for_update(**lockArgs).filter(filt).order_by('execution_time')[:reserved]  # @UndefinedVariable
+                )
+                if tasks:
+                    DBDelayedTask.objects.filter(id__in=[task.id for task in tasks]).delete()  # @UndefinedVariable
+
+            for task in tasks:
                 if task.insert_date > now + timedelta(seconds=30):
                     logger.warning('Executed %s due to insert_date being in the future!', task.type)
-                taskInstanceDump = codecs.decode(task.instance.encode(), 'base64')
-                task.delete()
-            taskInstance = pickle.loads(taskInstanceDump)
-        except IndexError:
-            return  # No problem, there is no waiting delayed task
+                try:
+                    taskInstance = pickle.loads(codecs.decode(task.instance.encode(), 'base64'))
+                except Exception:
+                    # Note that is taskInstance can't be loaded, this task will not be run
+                    logger.exception('Loading delayed task %s', task.type)
+                    continue
+                if not taskInstance:
+                    continue
+
+                logger.debug('Executing delayedTask:>%s<', task)
+                taskInstance.env = Environment.getEnvForType(taskInstance.__class__)
+                self.metrics.claimed(max(0.0, (now - task.execution_time).total_seconds()))
+                pool.submit(DelayedTaskRunner._execute, taskInstance)
+                submitted += 1
+
+            if len(tasks) == reserved:  # There may be more tasks waiting, do not sleep
+                if time.monotonic() - self._lastSample > self.metricsInterval:
+                    self._sampleQueue(now)
+                return 0
+
+            nextExecution = self._sampleQueue(now)
         except Exception:
             # Transaction have been rolled back using the "with atomic", so here just return
-            # Note that is taskInstance can't be loaded, this task will not be run
-            logger.exception('Obtainint one task for execution')
-            return
+            logger.exception('Obtaining tasks for execution')
+            return self.granularity
+        finally:
+            pool.release(reserved - submitted)
 
-        if taskInstance:
-            logger.debug('Executing delayedTask:>%s<', task)
-            taskInstance.env = Environment.getEnvForType(taskInstance.__class__)
-            DelayedTaskThread(taskInstance).start()
+        if nextExecution is None:
+            return self.granularity
+        return min(max((nextExecution - now).total_seconds(), 0), self.granularity)
 
     def __insert(self, instance: DelayedTask, delay: int, tag: str) -> None:
         now = getSqlDatetime()
@@ -142,6 +252,10 @@ class DelayedTaskRunner:
         DBDelayedTask.objects.create(type=typeName, instance=instanceDump,  # @UndefinedVariable
                                      insert_date=now, execution_delay=delay, execution_time=exec_time, tag=tag)
 
+        # Wake up runners if this task should be executed before they are awaken
+        if delay < self.granularity:
+            self._wakeup.set()
+
     def insert(self, instance: DelayedTask, delay: int, tag: str = '') -> bool:
         retries = 3
         while retries > 0:
@@ -185,12 +299,14 @@ class DelayedTaskRunner:
         logger.debug("At loop")
         while self._keepRunning:
             try:
-                time.sleep(self.granularity)
-                self.executeOneDelayedTask()
+                wait = self.executeDelayedTasks()
+                if wait > 0 and self._wakeup.wait(wait):
+                    self._wakeup.clear()
             except Exception as e:
                 logger.error('Unexpected exception at run loop %s: %s', e.__class__, e)
                 try:
                     connections['default'].close()
                 except Exception:
                     logger.exception('Exception clossing connection at delayed task')
+                time.sleep(self.granularity)
         logger.info('Exiting DelayedTask Runner because stop has been requested')
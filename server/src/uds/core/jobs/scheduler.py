@@ -34,15 +34,18 @@ import typing
 import platform
 import threading
 import time
+import bisect
 import logging
 from datetime import timedelta
 
-from django.db import transaction, DatabaseError, connections
-from django.db.models import Q
+from django.db import transaction, DatabaseError, connection, connections
+from django.db.models import Q, Min
 
 from uds.models import Scheduler as DBScheduler, getSqlDatetime
 from uds.core.util.state import State
+from uds.core.util.config import GlobalConfig
 from .jobs_factory import JobsFactory
+from .worker_pool import WorkerPool
 
 logger = logging.getLogger(__name__)
 
@@ -51,63 +54,43 @@ if typing.TYPE_CHECKING:
     from .job import Job
 
 
-class JobThread(threading.Thread):
+class JobMetrics:
     """
-    Class responsible of executing one job.
-    This class:
-      Ensures that the job is executed in a controlled way (any exception will be catch & processed)
-      Ensures that the scheduler db entry is released after run
+    Runtime histogram and overrun counter of a job
     """
 
-    _jobInstance: 'Job'
-    _dbJobId: int
-    _freq: int
+    # Upper bounds (in seconds) of histogram buckets. Last bucket is "more than last bound"
+    BUCKETS: typing.ClassVar[typing.Tuple[float, ...]] = (0.1, 0.5, 1, 5, 10, 30, 60, 300)
 
-    def __init__(self, jobInstance: 'Job', dbJob: DBScheduler) -> None:
-        super(JobThread, self).__init__()
-        self._jobInstance = jobInstance
-        self._dbJobId = dbJob.id
-        self._freq = dbJob.frecuency
+    histogram: typing.List[int]
+    count: int
+    total: float
+    max: float
+    overruns: int
 
-    def run(self) -> None:
-        try:
-            self._jobInstance.execute()
-        except Exception:
-            logger.warning("Exception executing job %s", self._dbJobId)
-        finally:
-            self.jobDone()
-
-    def jobDone(self) -> None:
-        """
-        Invoked whenever a job is is finished (with or without exception)
-        """
-        done = False
-        while done is False:
-            try:
-                self.__updateDb()
-                done = True
-            except Exception:
-                # Databases locked, maybe because we are on a multitask environment, let's try again in a while
-                try:
-                    connections['default'].close()
-                except Exception as e:
-                    logger.error('On job executor, closing db connection: %s', e)
-                # logger.info('Database access failed... Retrying')
-                time.sleep(1)
+    def __init__(self) -> None:
+        self.histogram = [0] * (len(JobMetrics.BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.overruns = 0
 
-        # Ensures DB connection is released after job is done
-        connections['default'].close()
+    def add(self, runtime: float, overrun: bool) -> None:
+        self.histogram[bisect.bisect_left(JobMetrics.BUCKETS, runtime)] += 1
+        self.count += 1
+        self.total += runtime
+        self.max = max(self.max, runtime)
+        if overrun:
+            self.overruns += 1
 
-    def __updateDb(self) -> None:
-        """
-        Atomically updates the scheduler db to "release" this job
-        """
-        with transaction.atomic():
-            DBScheduler.objects.select_for_update().filter(id=self._dbJobId).update(
-                state=State.FOR_EXECUTE,
-                owner_server='',
-                next_execution=getSqlDatetime() + timedelta(self._freq),
-            )
+    def asDict(self) -> typing.Dict[str, typing.Any]:
+        return {
+            'histogram': dict(zip([str(b) for b in JobMetrics.BUCKETS] + ['+Inf'], self.histogram)),
+            'count': self.count,
+            'avg': self.total / self.count if self.count else 0.0,
+            'max': self.max,
+            'overruns': self.overruns,
+        }
 
 
 class Scheduler:
@@ -115,14 +98,30 @@ class Scheduler:
     Class responsible of maintain/execute scheduled jobs
     """
 
-    granularity = 2  # We check for cron jobs every THIS seconds
+    granularity = 2  # Max time between checks for cron jobs. Scheduler sleeps until next job execution, but no more than this
+    releaseRetries = 5  # Number of retries to release a job. If all fails, scheduler loop keeps retrying it
+    releaseBackoffMax = 60  # Max seconds between retries of jobs that could not be released
 
     # to keep singleton Scheduler
     _scheduler: typing.Optional['Scheduler'] = None
 
+    _pool: typing.Optional[WorkerPool]
+    _lock: threading.Lock
+    _metrics: typing.Dict[str, JobMetrics]
+    # Jobs that could not be released (job id -> frecuency), and when and how to retry them
+    _unreleased: typing.Dict[int, int]
+    _releaseRetryAt: float
+    _releaseBackoff: float
+
     def __init__(self) -> None:
         self._hostname = platform.node()
         self._keepRunning = True
+        self._pool = None
+        self._lock = threading.Lock()
+        self._metrics = {}
+        self._unreleased = {}
+        self._releaseRetryAt = 0.0
+        self._releaseBackoff = 0.0
         logger.info('Initialized scheduler for host "%s"', self._hostname)
 
     @staticmethod
@@ -140,45 +139,158 @@ class Scheduler:
         """
         self._keepRunning = False
 
-    def executeOneJob(self) -> None:
+    @property
+    def pool(self) -> WorkerPool:
+        """
+        Workers pool, shared by all scheduler threads
+        """
+        with self._lock:
+            if self._pool is None:
+                self._pool = WorkerPool('Scheduler', GlobalConfig.SCHEDULER_WORKERS.getInt())
+            return self._pool
+
+    def getMetrics(self) -> typing.Dict[str, typing.Dict[str, typing.Any]]:
+        """
+        Returns runtime metrics of executed jobs, by job name
+        """
+        with self._lock:
+            return {name: m.asDict() for name, m in self._metrics.items()}
+
+    def _recordRuntime(self, name: str, frecuency: int, runtime: float) -> None:
+        overrun = runtime > frecuency
+        if overrun:
+            logger.warning(
+                'Job %s took %.2f seconds, more than its frecuency (%s seconds)',
+                name,
+                runtime,
+                frecuency,
+            )
+        with self._lock:
+            self._metrics.setdefault(name, JobMetrics()).add(runtime, overrun)
+
+    def _runJob(self, jobInstance: 'Job', dbJobId: int, name: str, frecuency: int) -> None:
+        """
+        Executes one job on a pool worker, and releases it after run (with or without exception)
+        """
+        start = time.monotonic()
+        try:
+            jobInstance.execute()
+        except Exception:
+            logger.warning("Exception executing job %s", dbJobId)
+        finally:
+            self._recordRuntime(name, frecuency, time.monotonic() - start)
+            self._jobDone(dbJobId, frecuency)
+
+    @staticmethod
+    def _release(dbJobId: int, frecuency: int) -> None:
+        """
+        Atomically updates the scheduler db to "release" this job
+        """
+        with transaction.atomic():
+            DBScheduler.objects.select_for_update().filter(id=dbJobId).update(
+                state=State.FOR_EXECUTE,
+                owner_server='',
+                next_execution=getSqlDatetime() + timedelta(seconds=frecuency),
+            )
+
+    def _jobDone(self, dbJobId: int, frecuency: int) -> None:
+        """
+        Releases this job, retrying a few times. If it can not be released, it is left to
+        scheduler loop, that keeps retrying it (so the worker is not kept busy)
+        """
+        for retry in range(self.releaseRetries):
+            try:
+                self._release(dbJobId, frecuency)
+                return
+            except Exception:
+                # Databases locked, maybe because we are on a multitask environment, let's try again in a while
+                try:
+                    connections['default'].close()
+                except Exception as e:
+                    logger.error('On job executor, closing db connection: %s', e)
+                time.sleep(retry + 1)
+        logger.error('Could not release job %s, will keep retrying', dbJobId)
+        with self._lock:
+            self._unreleased[dbJobId] = frecuency
+
+    def releasePending(self) -> None:
+        """
+        Retries the release of jobs that could not be released, with a backoff (capped to releaseBackoffMax)
+        """
+        now = time.monotonic()
+        with self._lock:
+            if not self._unreleased or now < self._releaseRetryAt:
+                return
+            pending = list(self._unreleased.items())
+
+        for dbJobId, frecuency in pending:
+            try:
+                self._release(dbJobId, frecuency)
+            except Exception as e:
+                self._releaseBackoff = min(max(self._releaseBackoff * 2, self.granularity), self.releaseBackoffMax)
+                self._releaseRetryAt = now + self._releaseBackoff
+                logger.warning('Could not release job %s, retrying in %s seconds: %s', dbJobId, self._releaseBackoff, e)
+                return
+            logger.info('Released job %s', dbJobId)
+            with self._lock:
+                self._unreleased.pop(dbJobId, None)
+        self._releaseBackoff = 0.0
+
+    def executeJobs(self) -> float:
         """
-        Looks for the best waiting job and executes it
+        Claims all waiting jobs (as many as free workers) and executes them.
+
+        Returns the number of seconds that the scheduler should wait before next check
         """
-        jobInstance = None
+        pool = self.pool
+        reserved = pool.reserve(pool.size)
+        if reserved == 0:  # All workers busy
+            pool.waitForSlot(self.granularity)
+            return 0
+
+        submitted = 0
         try:
             now = getSqlDatetime()  # Datetimes are based on database server times
             fltr = Q(state=State.FOR_EXECUTE) & (
                 Q(last_execution__gt=now) | Q(next_execution__lt=now)
             )
+            lockArgs = {'skip_locked': True} if connection.features.has_select_for_update_skip_locked else {}
             with transaction.atomic():
                 # If next execution is before now or last execution is in the future (clock changed on this server, we take that task as executable)
                 # This params are all set inside fltr (look at __init__)
-                job: DBScheduler = (
-                    DBScheduler.objects.select_for_update()
+                jobs: typing.List[DBScheduler] = list(
+                    DBScheduler.objects.select_for_update(**lockArgs)
                     .filter(fltr)
-                    .order_by('next_execution')[0]
+                    .order_by('next_execution')[:reserved]
                 )
-                if job.last_execution > now:
-                    logger.warning(
-                        'EXecuted %s due to last_execution being in the future!',
-                        job.name,
+                for job in jobs:
+                    if job.last_execution > now:
+                        logger.warning(
+                            'EXecuted %s due to last_execution being in the future!',
+                            job.name,
+                        )
+                if jobs:
+                    DBScheduler.objects.filter(id__in=[job.id for job in jobs]).update(
+                        state=State.RUNNING, owner_server=self._hostname, last_execution=now
                     )
-                job.state = State.RUNNING
-                job.owner_server = self._hostname
-                job.last_execution = now
-                job.save(update_fields=['state', 'owner_server', 'last_execution'])
 
-            jobInstance = job.getInstance()
+            for job in jobs:
+                jobInstance = job.getInstance()
 
-            if jobInstance is None:
-                logger.error('Job instance can\'t be resolved for %s, removing it', job)
-                job.delete()
-                return
-            logger.debug('Executing job:>%s<', job.name)
-            JobThread(jobInstance, job).start()  # Do not instatiate thread, just run it
-        except IndexError:
-            # Do nothing, there is no jobs for execution
-            return
+                if jobInstance is None:
+                    logger.error('Job instance can\'t be resolved for %s, removing it', job)
+                    job.delete()
+                    continue
+                logger.debug('Executing job:>%s<', job.name)
+                pool.submit(self._runJob, jobInstance, job.id, job.name, job.frecuency)
+                submitted += 1
+
+            if len(jobs) == reserved:  # May be more jobs waiting
+                return 0
+
+            nextExecution = DBScheduler.objects.filter(state=State.FOR_EXECUTE).aggregate(
+                next=Min('next_execution')
+            )['next']
         except DatabaseError as e:
             # Whis will happen whenever a connection error or a deadlock error happens
             # This in fact means that we have to retry operation, and retry will happen on main loop
@@ -188,6 +300,12 @@ class Scheduler:
             raise DatabaseError(
                 'Database access problems. Retrying connection ({})'.format(e)
             )
+        finally:
+            pool.release(reserved - submitted)
+
+        if nextExecution is None:
+            return self.granularity
+        return min(max((nextExecution - now).total_seconds(), 0), self.granularity)
 
     @staticmethod
     def releaseOwnShedules() -> None:
@@ -221,9 +339,10 @@ class Scheduler:
         JobsFactory.factory().ensureJobsInDatabase()
         logger.debug("At loop")
         while self._keepRunning:
+            wait: float = self.granularity
             try:
-                time.sleep(self.granularity)
-                self.executeOneJob()
+                self.releasePending()
+                wait = self.executeJobs()
             except Exception as e:
                 # This can happen often on sqlite, and this is not problem at all as we recover it.
                 # The log is removed so we do not get increased workers.log file size with no information at all
@@ -235,5 +354,7 @@ class Scheduler:
                     connections['default'].close()
                 except Exception:
                     logger.exception('Exception clossing connection at delayed task')
+            if wait > 0:
+                time.sleep(wait)
         logger.info('Exiting Scheduler because stop has been requested')
         self.releaseOwnShedules()
@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2012-2020 Virtual Cable S.L.U.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without modification,
+# are permitted provided that the following conditions are met:
+#
+#    * Redistributions of source code must retain the above copyright notice,
+#      this list of conditions and the following disclaimer.
+#    * Redistributions in binary form must reproduce the above copyright notice,
+#      this list of conditions and the following disclaimer in the documentation
+#      and/or other materials provided with the distribution.
+#    * Neither the name of Virtual Cable S.L. nor the names of its contributors
+#      may be used to endorse or promote products derived from this software
+#      without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+@author: Adolfo Gómez, dkmaster at dkmon dot com
+"""
+import threading
+import queue
+import logging
+import typing
+
+from django.db import close_old_connections
+
+logger = logging.getLogger(__name__)
+
+
+class WorkerPool:
+    """
+    Fixed size pool of reusable worker threads, shared by the delayed task runner
+    and scheduler loops, so we do not spawn a new thread for each task/job.
+
+    Capacity is bounded: no more than "size" callables are in flight (queued or running)
+    at any time, so claimers can ask for the number of free slots before claiming work.
+    """
+
+    _name: str
+    _size: int
+    _queue: 'queue.Queue[typing.Optional[typing.Tuple[typing.Callable[..., typing.Any], typing.Tuple[typing.Any, ...]]]]'
+    _threads: typing.List[threading.Thread]
+    _inFlight: int
+    _lock: threading.Condition
+
+    def __init__(self, name: str, size: int) -> None:
+        self._name = name
+        self._size = max(1, size)
+        self._queue = queue.Queue()
+        self._threads = []
+        self._inFlight = 0
+        self._lock = threading.Condition()
+
+    def _ensureStarted(self) -> None:
+        # Must be called with lock held
+        if self._threads:
+            return
+        for i in range(self._size):
+            thread = threading.Thread(target=self._work, name='{}-{}'.format(self._name, i), daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def _work(self) -> None:
+        while True:
+            item = self._queue.get()
+            if item is None:  # Stop request
+                break
+            fnc, args = item
+            try:
+                fnc(*args)
+            except Exception as e:
+                logger.exception("Exception in worker %s: %s", e.__class__, e)
+            finally:
+                # Release db connection if not reusable (CONN_MAX_AGE) or broken
+                try:
+                    close_old_connections()
+                except Exception:
+                    logger.exception('Closing connections on worker')
+                with self._lock:
+                    self._inFlight -= 1
+                    self._lock.notify_all()
+
+    @property
+    def size(self) -> int:
+        return self._size
+
+    @property
+    def inFlight(self) -> int:
+        return self._inFlight
+
+    def available(self) -> int:
+        """
+        Number of callables that can be submitted right now without exceeding pool capacity
+        """
+        return max(0, self._size - self._inFlight)
+
+    def reserve(self, count: int) -> int:
+        """
+        Reserves up to "count" slots, returning how many have been reserved.
+        Each reserved slot must be consumed by a submit or given back with release
+        """
+        with self._lock:
+            self._ensureStarted()
+            reserved = min(count, self.available())
+            self._inFlight += reserved
+            return reserved
+
+    def release(self, count: int) -> None:
+        """
+        Gives back reserved slots that will not be used
+        """
+        if count <= 0:
+            return
+        with self._lock:
+            self._inFlight -= count
+            self._lock.notify_all()
+
+    def submit(self, fnc: typing.Callable[..., typing.Any], *args: typing.Any) -> None:
+        """
+        Executes fnc(*args) on a worker, consuming a previously reserved slot
+        """
+        self._queue.put((fnc, args))
+
+    def waitForSlot(self, timeout: float) -> bool:
+        """
+        Waits (up to timeout seconds) until there is at least one free slot.
+        """
+        with self._lock:
+            return self._lock.wait_for(lambda: self._inFlight < self._size, timeout)
+
+    def stop(self, timeout: typing.Optional[float] = None) -> None:
+        """
+        Waits for pending work to finish, and stops workers
+        """
+        with self._lock:
+            threads, self._threads = self._threads, []
+        for _ in threads:
+            self._queue.put(None)
+        for thread in threads:
+            thread.join(timeout)
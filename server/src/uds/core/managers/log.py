@@ -29,12 +29,16 @@
 """
 @author: Adolfo Gómez, dkmaster at dkmon dot com
 """
+import collections
 import logging
 import typing
 
+from django.db.models import Count, Q
+
 from uds import models
 
 from uds.core.util import log
+from uds.core.util.buffered_writer import BufferedWriter
 
 from uds.core.util.config import GlobalConfig
 
@@ -61,14 +65,29 @@ transDict: typing.Dict[typing.Type['Model'], int] = {
 }
 
 
+# Number of (owner, level, source) last messages remembered to avoid duplicates
+MAX_DUPLICATES_KEYS = 8192
+
+LogKey = typing.Tuple[int, int, int, str]  # owner_type, owner_id, level, source
+
+
 class LogManager:
     """
     Manager for logging (at database) events
+
+    Log entries are buffered in memory and written in batches by a background thread.
+    Trimming of logs to MAX_LOGS_PER_ELEMENT per owner is done periodically (see cleanUp).
+    Duplicates are detected against the last messages remembered in memory, so only within
+    one process: the same message logged from different processes (or nodes) is written once by each.
     """
     _manager: typing.Optional['LogManager'] = None
 
+    _writer: BufferedWriter
+    _lastMessages: 'collections.OrderedDict[LogKey, str]'
+
     def __init__(self):
-        pass
+        self._writer = BufferedWriter('Log', models.Log)
+        self._lastMessages = collections.OrderedDict()
 
     @staticmethod
     def manager() -> 'LogManager':
@@ -76,6 +95,30 @@ class LogManager:
             LogManager._manager = LogManager()
         return LogManager._manager
 
+    @property
+    def dropped(self) -> int:
+        return self._writer.dropped
+
+    @property
+    def written(self) -> int:
+        return self._writer.written
+
+    def _isDuplicate(self, key: LogKey, message: str) -> bool:
+        # Must be called with writer lock held
+        if self._lastMessages.get(key) == message:
+            return True
+        self._lastMessages[key] = message
+        self._lastMessages.move_to_end(key)
+        if len(self._lastMessages) > MAX_DUPLICATES_KEYS:
+            self._lastMessages.popitem(last=False)
+        return False
+
+    def flush(self) -> None:
+        """
+        Writes all buffered log entries to database (synchronously)
+        """
+        self._writer.flush()
+
     def __log(self, owner_type: int, owner_id: int, level: int, message: str, source: str, avoidDuplicates: bool):
         """
         Logs a message associated to owner
@@ -83,32 +126,38 @@ class LogManager:
         # Ensure message fits on space
         message = str(message)[:255]
 
-        qs = models.Log.objects.filter(owner_id=owner_id, owner_type=owner_type)
-        # First, ensure we do not have more than requested logs, and we can put one more log item
-        if qs.count() >= GlobalConfig.MAX_LOGS_PER_ELEMENT.getInt():
-            for i in qs.order_by('-created',)[GlobalConfig.MAX_LOGS_PER_ELEMENT.getInt() - 1:]:
-                i.delete()
+        with self._writer.lock:
+            # Duplicates are checked against last message with same owner, level and source
+            if self._isDuplicate((owner_type, owner_id, level, source), message) and avoidDuplicates is True:
+                return
 
-        if avoidDuplicates is True:
+        self._writer.add(
+            models.Log(owner_type=owner_type, owner_id=owner_id, created=models.getSqlDatetime(), source=source, level=level, data=message)
+        )
+
+    def cleanUp(self) -> None:
+        """
+        Removes the oldest logs of owners that have more than MAX_LOGS_PER_ELEMENT log entries
+        """
+        maxLogs = GlobalConfig.MAX_LOGS_PER_ELEMENT.getInt()
+        for owner in (
+            models.Log.objects.values('owner_type', 'owner_id')
+            .annotate(number=Count('id'))
+            .filter(number__gt=maxLogs)
+            .values('owner_type', 'owner_id')
+        ):
+            qs = models.Log.objects.filter(**owner)
             try:
-                lg = models.Log.objects.filter(owner_id=owner_id, owner_type=owner_type, level=level, source=source).order_by('-created', '-id')[0]
-                if lg.data == message:
-                    # Do not log again, already logged
-                    return
-            except Exception:  # Do not exists log
-                pass
-
-        # now, we add new log
-        try:
-            models.Log.objects.create(owner_type=owner_type, owner_id=owner_id, created=models.getSqlDatetime(), source=source, level=level, data=message)
-        except Exception:
-            # Some objects will not get logged, such as System administrator objects, but this is fine
-            pass
+                last = qs.order_by('-created', '-id').values('created', 'id')[maxLogs - 1]
+            except IndexError:
+                continue
+            qs.filter(Q(created__lt=last['created']) | Q(created=last['created'], id__lt=last['id'])).delete()
 
     def __getLogs(self, owner_type: int, owner_id: int, limit: int) -> typing.List[typing.Dict]:
         """
         Get all logs associated with an user service, ordered by date
         """
+        self.flush()  # Ensure pending entries are also returned
         qs = models.Log.objects.filter(owner_id=owner_id, owner_type=owner_type)
         return [{'date': x.created, 'level': x.level, 'source': x.source, 'message': x.data} for x in reversed(qs.order_by('-created', '-id')[:limit])]
 
@@ -116,6 +165,7 @@ class LogManager:
         """
         Clears all logs related to user service
         """
+        self._writer.discard(lambda e: e.owner_type == owner_type and e.owner_id == owner_id)  # type: ignore
         models.Log.objects.filter(owner_id=owner_id, owner_type=owner_type).delete()
 
     def doLog(self, wichObject: 'Model', level: int, message: str, source: str, avoidDuplicates: bool = True):
@@ -35,7 +35,9 @@ import logging
 import typing
 
 from uds.core.util.config import GlobalConfig
+from uds.core.util.buffered_writer import BufferedWriter
 from uds.models import StatsCounters
+from uds.models import StatsCountersRollup
 from uds.models import getSqlDatetime, getSqlDatetimeAsUnix
 from uds.models import StatsEvents
 
@@ -49,11 +51,17 @@ class StatsManager:
     Right now, we are going to provide an interface to "counter stats", that is, statistics
     that has counters (such as how many users is at a time active at platform, how many services
     are assigned, are in use, in cache, etc...
+
+    Counters and events are buffered in memory and written in batches by a background thread.
     """
     _manager: typing.Optional['StatsManager'] = None
 
+    _countersWriter: BufferedWriter
+    _eventsWriter: BufferedWriter
+
     def __init__(self):
-        pass
+        self._countersWriter = BufferedWriter('StatsCounters', StatsCounters)
+        self._eventsWriter = BufferedWriter('StatsEvents', StatsEvents)
 
     @staticmethod
     def manager():
@@ -61,9 +69,16 @@ class StatsManager:
             StatsManager._manager = StatsManager()
         return StatsManager._manager
 
-    def __doCleanup(self, model):
+    def __doCleanup(self, model, **exclude):
         minTime = time.mktime((getSqlDatetime() - datetime.timedelta(days=GlobalConfig.STATS_DURATION.getInt())).timetuple())
-        model.objects.filter(stamp__lt=minTime).delete()
+        model.objects.filter(stamp__lt=minTime).exclude(**exclude).delete()
+
+    def flush(self) -> None:
+        """
+        Writes all buffered counters and events to database (synchronously)
+        """
+        self._countersWriter.flush()
+        self._eventsWriter.flush()
 
     # Counter stats
     def addCounter(self, owner_type: int, owner_id: int, counterType: int, counterValue: int, stamp: typing.Optional[datetime.datetime] = None) -> bool:
@@ -89,11 +104,9 @@ class StatsManager:
         # To Unix epoch
         stampInt = int(time.mktime(stamp.timetuple()))  # pylint: disable=maybe-no-member
 
-        try:
-            StatsCounters.objects.create(owner_type=owner_type, owner_id=owner_id, counter_type=counterType, value=counterValue, stamp=stampInt)
+        if self._countersWriter.add(StatsCounters(owner_type=owner_type, owner_id=owner_id, counter_type=counterType, value=counterValue, stamp=stampInt)):
             return True
-        except Exception:
-            logger.error('Exception handling counter stats saving (maybe database is full?)')
+        logger.error('Counter stats buffer is full, counter dropped (maybe database is full?)')
         return False
 
     def getCounters(
@@ -127,6 +140,7 @@ class StatsManager:
         sinceInt = int(time.mktime(since.timetuple()))
         toInt = int(time.mktime(to.timetuple()))
 
+        self._countersWriter.flush()  # So pending counters are also returned
         return StatsCounters.get_grouped(
             ownerType,
             counterType,
@@ -144,6 +158,13 @@ class StatsManager:
         Removes all counters previous to configured max keep time for stat information from database.
         """
         self.__doCleanup(StatsCounters)
+        self.__doCleanup(StatsCountersRollup, granularity=StatsCountersRollup.WATERMARK)
+
+    def rollupCounters(self) -> None:
+        """
+        Updates the hourly and daily pre-aggregated counters with the new stored counters
+        """
+        StatsCountersRollup.rollup()
 
     def getEventFldFor(self, fld: str) -> str:
         '''
@@ -194,8 +215,9 @@ class StatsManager:
             fld3 = noneToEmpty(kwargs.get('fld3', kwargs.get('dstip', kwargs.get('version', ''))))
             fld4 = noneToEmpty(kwargs.get('fld4', kwargs.get('uniqueid', '')))
 
-            StatsEvents.objects.create(owner_type=owner_type, owner_id=owner_id, event_type=eventType, stamp=stamp, fld1=fld1, fld2=fld2, fld3=fld3, fld4=fld4)
-            return True
+            if self._eventsWriter.add(StatsEvents(owner_type=owner_type, owner_id=owner_id, event_type=eventType, stamp=stamp, fld1=fld1, fld2=fld2, fld3=fld3, fld4=fld4)):
+                return True
+            logger.error('Event stats buffer is full, event dropped (maybe database is full?)')
         except Exception:
             logger.exception('Exception handling event stats saving (maybe database is full?)')
         return False
@@ -215,6 +237,7 @@ class StatsManager:
 
             Iterator, containing (date, counter) each element
         """
+        self._eventsWriter.flush()  # So pending events are also returned
         return StatsEvents.get_stats(ownerType, eventType, **kwargs)
 
     def cleanupEvents(self):
@@ -141,4 +141,10 @@ class TaskManager:
         for thread in threads:
             thread.notifyTermination()
 
+        # Let running jobs and delayed tasks finish before exiting (workers are daemon threads)
+        for thread in threads:
+            thread.join()
+        Scheduler.scheduler().pool.stop()
+        DelayedTaskRunner.runner().pool.stop()
+
         # The join of threads will happen before termination, so its fine to just return here
@@ -468,6 +468,12 @@ class UserServiceManager:
     def sendMessage(self, userService: UserService, message: str) -> None:
         comms.sendMessage(userService, message)
 
+    def requestLogoffBulk(self, userServices: typing.Iterable[UserService]) -> None:
+        comms.requestLogoffBulk(userServices)
+
+    def sendMessageBulk(self, userServices: typing.Iterable[UserService], message: str) -> None:
+        comms.sendMessageBulk(userServices, message)
+
     def checkForRemoval(self, userService: UserService) -> None:
         """
         This method is used by UserService when a request for setInUse(False) is made
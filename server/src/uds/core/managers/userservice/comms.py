@@ -28,14 +28,19 @@
 """
 .. moduleauthor:: Adolfo Gómez, dkmaster at dkmon dot com
 """
-import os
+import ssl
 import json
 import base64
-import tempfile
+import hashlib
+import threading
+import collections
 import logging
 import typing
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
 
 import requests
+import requests.adapters
 
 if typing.TYPE_CHECKING:
     from uds.models import UserService, Proxy
@@ -43,6 +48,13 @@ if typing.TYPE_CHECKING:
 logger = logging.getLogger(__name__)
 
 TIMEOUT = 2
+# Max number of keep-alive sessions kept (one per actor url & certificate)
+MAX_SESSIONS = 512
+# Max number of concurrent requests on bulk operations
+BULK_CONCURRENCY = 32
+
+# Properties of an user service needed to talk with its actor
+ACTOR_PROPERTIES = ('comms_url', 'actor_version', 'cert')
 
 
 class NoActorComms(Exception):
@@ -53,19 +65,128 @@ class OldActorVersion(NoActorComms):
     pass
 
 
-def _requestActor(
+class ActorRequest(typing.NamedTuple):
+    """
+    Everything needed to make a request to an actor, resolved beforehand
+    so no database access is needed while doing the request
+    """
+
+    url: str
+    version: str
+    cert: str
+    proxy: typing.Optional['Proxy']
+
+
+class _SSLContextAdapter(requests.adapters.HTTPAdapter):
+    """
+    Adapter that uses an already built ssl context (from in-memory certificates)
+    """
+
+    def __init__(self, sslContext: ssl.SSLContext, **kwargs) -> None:
+        self._sslContext = sslContext
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):  # pylint: disable=arguments-differ
+        kwargs['ssl_context'] = self._sslContext
+        return super().init_poolmanager(*args, **kwargs)
+
+    def cert_verify(self, conn, url, verify, cert):
+        # Verification is done by our ssl context, do not let requests override it
+        super().cert_verify(conn, url, False, cert)
+        conn.cert_reqs = 'CERT_REQUIRED'
+
+
+class _Sessions:
+    """
+    Keeps keep-alive sessions to actors, keyed by actor host and certificate fingerprint,
+    and verified ssl contexts built from in-memory certificates, keyed by certificate fingerprint
+    """
+
+    _lock: threading.Lock
+    _sessions: 'collections.OrderedDict[typing.Tuple[str, str], requests.Session]'
+    _contexts: typing.Dict[str, ssl.SSLContext]
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._sessions = collections.OrderedDict()
+        self._contexts = {}
+
+    def _sslContext(self, fingerprint: str, cert: str) -> ssl.SSLContext:
+        # Must be called with lock held
+        context = self._contexts.get(fingerprint)
+        if context is None:
+            context = ssl.create_default_context(cadata=cert)
+            # Hostname is checked by urllib3 using the connection url
+            context.check_hostname = False
+            self._contexts[fingerprint] = context
+        return context
+
+    def get(self, url: str, cert: str) -> requests.Session:
+        fingerprint = hashlib.sha256(cert.encode()).hexdigest() if cert else ''
+        key = (urlsplit(url).netloc, fingerprint)
+        with self._lock:
+            session = self._sessions.get(key)
+            if session is not None:
+                self._sessions.move_to_end(key)
+                return session
+
+            session = requests.Session()
+            # Certificate verification (if any) is done by the adapter ssl context
+            session.verify = False
+            if cert:
+                session.mount('https://', _SSLContextAdapter(self._sslContext(fingerprint, cert)))
+            self._sessions[key] = session
+            while len(self._sessions) > MAX_SESSIONS:
+                _, old = self._sessions.popitem(last=False)
+                old.close()
+            # Remove contexts no longer in use
+            if len(self._contexts) > MAX_SESSIONS:
+                inUse = {k[1] for k in self._sessions}
+                for fp in [fp for fp in self._contexts if fp not in inUse]:
+                    del self._contexts[fp]
+            return session
+
+    def remove(self, url: str, cert: str) -> None:
+        fingerprint = hashlib.sha256(cert.encode()).hexdigest() if cert else ''
+        with self._lock:
+            session = self._sessions.pop((urlsplit(url).netloc, fingerprint), None)
+        if session:
+            session.close()
+
+
+_sessions = _Sessions()
+
+
+def _getProperties(
+    userServices: typing.Iterable['UserService'],
+) -> typing.Dict[int, typing.Dict[str, str]]:
+    """
+    Gets the actor related properties of all user services using just one query
+    """
+    from uds.models import UserServiceProperty  # pylint: disable=import-outside-toplevel
+
+    props: typing.Dict[int, typing.Dict[str, str]] = collections.defaultdict(dict)
+    for userServiceId, name, value in UserServiceProperty.objects.filter(
+        user_service__in=[us.id for us in userServices], name__in=ACTOR_PROPERTIES
+    ).values_list('user_service_id', 'name', 'value'):
+        props[userServiceId][name] = value
+    return props
+
+
+def _prepareRequest(
     userService: 'UserService',
     method: str,
-    data: typing.Optional[typing.MutableMapping[str, typing.Any]] = None,
     minVersion: typing.Optional[str] = None,
-) -> typing.Any:
+    properties: typing.Optional[typing.Mapping[str, str]] = None,
+) -> ActorRequest:
     """
-    Makes a request to actor using "method"
-    if data is None, request is done using GET, else POST
+    Resolves url, version, certificate and proxy for a request to the actor of an user service
     if no communications url is provided or no min version, raises a "NoActorComms" exception (or OldActorVersion, derived from NoActorComms)
-    Returns request response value interpreted as json
     """
-    url = userService.getCommsUrl()
+    if properties is None:
+        properties = _getProperties([userService]).get(userService.id, {})
+
+    url = properties.get('comms_url')
     if not url:
         # logger.warning('No notification is made because agent does not supports notifications: %s', userService.friendly_name)
         raise NoActorComms(
@@ -73,7 +194,7 @@ def _requestActor(
         )
 
     minVersion = minVersion or '2.0.0'
-    version = userService.getProperty('actor_version') or '0.0.0'
+    version = properties.get('actor_version') or '0.0.0'
     if '-' in version or version < minVersion:
         logger.warning(
             'Pool %s has old actors (%s)', userService.deployed_service.name, version
@@ -82,41 +203,47 @@ def _requestActor(
             'Old actor version {} for {}'.format(version, userService.friendly_name)
         )
 
-    url += '/' + method
+    return ActorRequest(
+        url=url + '/' + method,
+        version=version,
+        cert=properties.get('cert') or '',
+        proxy=userService.deployed_service.proxy,
+    )
+
 
-    proxy = userService.deployed_service.proxy
+def _executeRequest(
+    request: ActorRequest,
+    method: str,
+    data: typing.Optional[typing.MutableMapping[str, typing.Any]] = None,
+) -> typing.Any:
+    """
+    Makes the request (no database access is done here)
+    if data is None, request is done using GET, else POST
+    Returns request response value interpreted as json
+    """
+    url = request.url
     try:
-        if proxy:
-            r = proxy.doProxyRequest(url=url, data=data, timeout=TIMEOUT)
+        if request.proxy:
+            r = request.proxy.doProxyRequest(url=url, data=data, timeout=TIMEOUT)
         else:
-            verify: typing.Union[bool, str]
-            cert = userService.getProperty('cert')
-            # cert = ''  # Untils more tests, keep as previous....  TODO: Fix this when fully tested
-            if cert:
-                # Generate temp file, and delete it after
-                verify = tempfile.mktemp('udscrt')
-                with open(verify, 'wb') as f:
-                    f.write(cert.encode())  # Save cert
-            else:
-                verify = False
-            if data is None:
-                r = requests.get(url, verify=verify, timeout=TIMEOUT)
-            else:
-                r = requests.post(
-                    url,
-                    data=json.dumps(data),
-                    headers={'content-type': 'application/json'},
-                    verify=verify,
-                    timeout=TIMEOUT,
-                )
-            if verify:
-                try:
-                    os.remove(typing.cast(str, verify))
-                except Exception:
-                    logger.exception('removing verify')
+            session = _sessions.get(url, request.cert)
+            try:
+                if data is None:
+                    r = session.get(url, timeout=TIMEOUT)
+                else:
+                    r = session.post(
+                        url,
+                        data=json.dumps(data),
+                        headers={'content-type': 'application/json'},
+                        timeout=TIMEOUT,
+                    )
+            except Exception:
+                # Do not keep (possibly) broken connections to this actor
+                _sessions.remove(url, request.cert)
+                raise
         js = r.json()
 
-        if version >= '3.0.0':
+        if request.version >= '3.0.0':
             js = js['result']
         logger.debug('Requested %s to actor. Url=%s', method, url)
     except Exception as e:
@@ -131,6 +258,65 @@ def _requestActor(
     return js
 
 
+def _requestActor(
+    userService: 'UserService',
+    method: str,
+    data: typing.Optional[typing.MutableMapping[str, typing.Any]] = None,
+    minVersion: typing.Optional[str] = None,
+) -> typing.Any:
+    """
+    Makes a request to actor using "method"
+    if data is None, request is done using GET, else POST
+    if no communications url is provided or no min version, raises a "NoActorComms" exception (or OldActorVersion, derived from NoActorComms)
+    Returns request response value interpreted as json
+    """
+    return _executeRequest(_prepareRequest(userService, method, minVersion), method, data)
+
+
+def _requestActors(
+    userServices: typing.Iterable['UserService'],
+    method: str,
+    data: typing.Optional[typing.MutableMapping[str, typing.Any]] = None,
+    minVersion: typing.Optional[str] = None,
+    concurrency: int = BULK_CONCURRENCY,
+) -> typing.Dict[int, typing.Any]:
+    """
+    Makes the same request to the actors of several user services, concurrently (up to concurrency requests at once)
+    User services with no actor comms (or with old actors) are skipped.
+    Returns a dictionary of user service id -> request response value interpreted as json
+    """
+    from uds.models import UserService  # pylint: disable=import-outside-toplevel
+
+    # Pools and proxies of all user services are got on the same query, and properties on another one
+    userServices = list(
+        UserService.objects.filter(id__in=[us.id for us in userServices]).select_related(
+            'deployed_service__service__proxy'
+        )
+    )
+    properties = _getProperties(userServices)
+    actorRequests: typing.Dict[int, ActorRequest] = {}
+    for userService in userServices:
+        try:
+            actorRequests[userService.id] = _prepareRequest(
+                userService, method, minVersion, properties.get(userService.id, {})
+            )
+        except NoActorComms:
+            pass
+
+    if not actorRequests:
+        return {}
+
+    with ThreadPoolExecutor(
+        max_workers=max(1, min(concurrency, len(actorRequests))),
+        thread_name_prefix='ActorComms',
+    ) as executor:
+        futures = {
+            usId: executor.submit(_executeRequest, request, method, data)
+            for usId, request in actorRequests.items()
+        }
+        return {usId: future.result() for usId, future in futures.items()}
+
+
 def notifyPreconnect(userService: 'UserService', userName: str, protocol: str) -> None:
     """
     Notifies a preconnect to an user service
@@ -214,3 +400,19 @@ def sendMessage(userService: 'UserService', message: str) -> None:
         _requestActor(userService, 'message', data={'message': message})
     except NoActorComms:
         pass
+
+
+def requestLogoffBulk(userServices: typing.Iterable['UserService'], concurrency: int = BULK_CONCURRENCY) -> None:
+    """
+    Ask clients of several user services to logoff user, concurrently
+    """
+    _requestActors(userServices, 'logout', data={}, concurrency=concurrency)
+
+
+def sendMessageBulk(
+    userServices: typing.Iterable['UserService'], message: str, concurrency: int = BULK_CONCURRENCY
+) -> None:
+    """
+    Sends an screen message to clients of several user services, concurrently
+    """
+    _requestActors(userServices, 'message', data={'message': message}, concurrency=concurrency)
@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2012-2020 Virtual Cable S.L.U.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without modification,
+# are permitted provided that the following conditions are met:
+#
+#    * Redistributions of source code must retain the above copyright notice,
+#      this list of conditions and the following disclaimer.
+#    * Redistributions in binary form must reproduce the above copyright notice,
+#      this list of conditions and the following disclaimer in the documentation
+#      and/or other materials provided with the distribution.
+#    * Neither the name of Virtual Cable S.L. nor the names of its contributors
+#      may be used to endorse or promote products derived from this software
+#      without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+@author: Adolfo Gómez, dkmaster at dkmon dot com
+"""
+import atexit
+import threading
+import logging
+import typing
+
+from django.db import close_old_connections, InterfaceError, OperationalError
+
+# Not imported at runtime, just for type checking
+if typing.TYPE_CHECKING:
+    from django.db.models import Model
+
+logger = logging.getLogger(__name__)
+
+
+class BufferedWriter:
+    """
+    Buffers model instances in memory and writes them in batches (bulk_create)
+    from a background thread, every flushInterval seconds or as soon as there are
+    flushSize instances waiting.
+
+    Buffer is bounded: if it is full, new instances are dropped (and counted).
+    If a batch can not be written, it is retried row by row, so only failing rows are lost.
+    Pending instances are written on process exit.
+    """
+
+    _name: str
+    _model: typing.Type['Model']
+    _maxBuffered: int
+    _flushInterval: float
+    _flushSize: int
+    _lock: threading.Condition
+    _buffer: typing.List['Model']
+    _flusher: typing.Optional[threading.Thread]
+    dropped: int
+    written: int
+
+    def __init__(
+        self,
+        name: str,
+        model: typing.Type['Model'],
+        maxBuffered: int = 10000,
+        flushInterval: float = 1.0,
+        flushSize: int = 500,
+    ) -> None:
+        self._name = name
+        self._model = model
+        self._maxBuffered = maxBuffered
+        self._flushInterval = flushInterval
+        self._flushSize = flushSize
+        self._lock = threading.Condition()
+        self._buffer = []
+        self._flusher = None
+        self.dropped = 0
+        self.written = 0
+        atexit.register(self.flush)
+
+    @property
+    def lock(self) -> threading.Condition:
+        """
+        Lock used to protect the buffer, so callers can do extra checks atomically with add
+        """
+        return self._lock
+
+    def _ensureFlusher(self) -> None:
+        # Must be called with lock held
+        if self._flusher is None or not self._flusher.is_alive():
+            self._flusher = threading.Thread(target=self._flushLoop, name=self._name + 'Flusher', daemon=True)
+            self._flusher.start()
+
+    def _flushLoop(self) -> None:
+        while True:
+            with self._lock:
+                self._lock.wait_for(lambda: len(self._buffer) >= self._flushSize, self._flushInterval)
+            try:
+                self.flush()
+            except Exception:
+                logger.exception('Flushing %s', self._name)
+
+    def add(self, instance: 'Model') -> bool:
+        """
+        Adds an instance to be written. Returns False if it has been dropped because buffer is full
+        """
+        with self._lock:
+            if len(self._buffer) >= self._maxBuffered:
+                self.dropped += 1
+                return False
+            self._buffer.append(instance)
+            self._ensureFlusher()
+            if len(self._buffer) >= self._flushSize:
+                self._lock.notify_all()
+        return True
+
+    def discard(self, fnc: typing.Callable[['Model'], bool]) -> None:
+        """
+        Removes, without writing them, the pending instances for which fnc returns True
+        """
+        with self._lock:
+            self._buffer = [i for i in self._buffer if not fnc(i)]
+
+    def _writeOneByOne(self, instances: typing.List['Model']) -> None:
+        for n, instance in enumerate(instances):
+            try:
+                instance.save(force_insert=True)
+                self.written += 1
+            except (InterfaceError, OperationalError) as e:
+                # Database is not usable, so the rest would fail too
+                logger.warning('Could not write %s %s entries: %s', len(instances) - n, self._name, e)
+                self.dropped += len(instances) - n
+                return
+            except Exception as e:
+                logger.warning('Could not write %s entry %s: %s', self._name, instance, e)
+                self.dropped += 1
+
+    def flush(self) -> None:
+        """
+        Writes all pending instances to database (synchronously)
+        """
+        with self._lock:
+            instances, self._buffer = self._buffer, []
+        if not instances:
+            return
+        try:
+            self._model.objects.bulk_create(instances, batch_size=self._flushSize)  # type: ignore
+            self.written += len(instances)
+        except Exception as e:
+            # bulk_create is atomic, so nothing has been written
+            logger.warning('Could not write %s %s entries at once, writing them one by one: %s', len(instances), self._name, e)
+            self._writeOneByOne(instances)
+        finally:
+            # Flusher thread db connection is released if it is not reusable
+            if threading.current_thread() is self._flusher:
+                close_old_connections()
@@ -33,29 +33,247 @@ import datetime
 import hashlib
 import codecs
 import pickle
+import threading
+import time
+import collections
 import typing
 import logging
 
 from django.db import transaction
+from django.conf import settings
 from uds.models.cache import Cache as DBCache
 from uds.models.util import getSqlDatetime
 
 logger = logging.getLogger(__name__)
 
+# Configurable (via django settings) tuning of the in-process and shared tiers
+# Max number of entries kept on the per-process LRU
+LOCAL_CACHE_SIZE: int = getattr(settings, 'UDS_CACHE_LOCAL_SIZE', 8192)
+# Max time an entry is kept on the per-process LRU. Changes done on other processes/nodes
+# will be visible at most after this time (entry validity will be used if lower), except for
+# caches created with local=False (counters and invalidation keys), that never use it
+LOCAL_CACHE_MAX_TTL: int = getattr(settings, 'UDS_CACHE_LOCAL_TTL', 5)
+# Name of the django cache to be used as shared tier (None or missing cache disables it)
+SHARED_CACHE_NAME: typing.Optional[str] = getattr(settings, 'UDS_CACHE_SHARED', None)
+
+
+class CacheCounters:
+    """
+    Hits/misses/evictions counters of a cache owner
+    """
+
+    __slots__ = ('hits', 'local_hits', 'shared_hits', 'misses', 'evictions')
+
+    hits: int
+    local_hits: int
+    shared_hits: int
+    misses: int
+    evictions: int
+
+    def __init__(self) -> None:
+        self.hits = self.local_hits = self.shared_hits = self.misses = self.evictions = 0
+
+    def asDict(self) -> typing.Dict[str, int]:
+        return {k: getattr(self, k) for k in CacheCounters.__slots__}
+
+
+class LocalCacheBackend:
+    """
+    Bounded, per process, LRU cache with TTL. Values are stored pickled, so
+    callers always get a fresh copy of the cached object (same as from DB).
+    """
+
+    _size: int
+    _maxTTL: int
+    _lock: threading.Lock
+    # key -> (owner, expiration (monotonic), pickled value)
+    _data: 'collections.OrderedDict[str, typing.Tuple[str, float, bytes]]'
+
+    def __init__(self, size: int, maxTTL: int):
+        self._size = size
+        self._maxTTL = maxTTL
+        self._lock = threading.Lock()
+        self._data = collections.OrderedDict()
+
+    @property
+    def enabled(self) -> bool:
+        return self._size > 0 and self._maxTTL > 0
+
+    def get(self, key: str) -> typing.Optional[bytes]:
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            if item[1] < time.monotonic():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return item[2]
+
+    def put(self, owner: str, key: str, value: bytes, validity: int) -> None:
+        if not self.enabled:
+            return
+        expires = time.monotonic() + min(validity, self._maxTTL)
+        with self._lock:
+            self._data[key] = (owner, expires, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self._size:
+                _, (evictedOwner, _, _) = self._data.popitem(last=False)
+                ownerCounters(evictedOwner).evictions += 1
+
+    def remove(self, key: str) -> None:
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self, owner: typing.Optional[str] = None) -> None:
+        with self._lock:
+            if owner is None:
+                self._data.clear()
+            else:
+                for k in [k for k, v in self._data.items() if v[0] == owner]:
+                    del self._data[k]
+
+
+class SharedCacheBackend:
+    """
+    Shared tier over a django cache (memcached, redis, ...).
+    Because django caches do not allow removing by "prefix", owners (and the whole cache)
+    are invalidated using generation counters, stored along with the values and checked on
+    read on the same round trip.
+    Values are stored with its expiration time, so readers know its remaining validity.
+    """
+
+    PREFIX = 'uds_c_'
+    GLOBAL_GEN = PREFIX + 'gen'
+
+    _cacheName: typing.Optional[str]
+    _cache: typing.Any
+
+    def __init__(self, cacheName: typing.Optional[str]):
+        self._cacheName = cacheName
+        self._cache = None
+
+    @property
+    def cache(self) -> typing.Any:
+        # Lazy initialization, so django settings can be fully loaded
+        if self._cache is None and self._cacheName:
+            from django.core.cache import caches  # pylint: disable=import-outside-toplevel
+
+            try:
+                self._cache = caches[self._cacheName]
+            except Exception:
+                logger.warning('Shared cache %s is not available, disabling it', self._cacheName)
+                self._cacheName = None
+        return self._cache
+
+    def _ownerGenKey(self, owner: str) -> str:
+        return SharedCacheBackend.PREFIX + 'gen_' + hashlib.md5(owner.encode('utf8')).hexdigest()
+
+    def get(self, owner: str, key: str) -> typing.Optional[typing.Tuple[bytes, int]]:
+        """
+        Returns the pickled value and its remaining validity, or None if not found
+        """
+        cache = self.cache
+        if cache is None:
+            return None
+        try:
+            ownerGen = self._ownerGenKey(owner)
+            data = cache.get_many([SharedCacheBackend.GLOBAL_GEN, ownerGen, SharedCacheBackend.PREFIX + key])
+            stored = data.get(SharedCacheBackend.PREFIX + key)
+            if stored is None:
+                return None
+            gen, expires, value = stored
+            if gen != (data.get(SharedCacheBackend.GLOBAL_GEN, 0), data.get(ownerGen, 0)):
+                return None
+            remaining = int(expires - time.time())
+            if remaining < 0:
+                return None
+            return value, remaining
+        except Exception as e:
+            logger.debug('Shared cache get failed: %s', e)
+            return None
+
+    def put(self, owner: str, key: str, value: bytes, validity: int) -> None:
+        cache = self.cache
+        if cache is None:
+            return
+        try:
+            ownerGen = self._ownerGenKey(owner)
+            data = cache.get_many([SharedCacheBackend.GLOBAL_GEN, ownerGen])
+            gen = (data.get(SharedCacheBackend.GLOBAL_GEN, 0), data.get(ownerGen, 0))
+            cache.set(SharedCacheBackend.PREFIX + key, (gen, time.time() + validity, value), validity)
+        except Exception as e:
+            logger.debug('Shared cache put failed: %s', e)
+
+    def remove(self, key: str) -> None:
+        cache = self.cache
+        if cache is None:
+            return
+        try:
+            cache.delete(SharedCacheBackend.PREFIX + key)
+        except Exception as e:
+            logger.debug('Shared cache remove failed: %s', e)
+
+    def clear(self, owner: typing.Optional[str] = None) -> None:
+        cache = self.cache
+        if cache is None:
+            return
+        genKey = SharedCacheBackend.GLOBAL_GEN if owner is None else self._ownerGenKey(owner)
+        try:
+            # Generations do not expire (None timeout), so they are consistent for the whole cache life
+            if not cache.add(genKey, 1, None):
+                cache.incr(genKey)
+        except Exception as e:
+            logger.debug('Shared cache clear failed: %s', e)
+
+
+_counters: typing.Dict[str, CacheCounters] = {}
+_countersLock = threading.Lock()
+
+
+def ownerCounters(owner: str) -> CacheCounters:
+    """
+    Returns the counters for an owner, creating them if needed
+    """
+    c = _counters.get(owner)
+    if c is None:
+        with _countersLock:
+            c = _counters.setdefault(owner, CacheCounters())
+    return c
+
 
 class Cache:
-    # Simple hits vs missses counters
-    hits = 0
-    misses = 0
+    """
+    Cache with three tiers:
+      * A bounded per process LRU (with a short TTL, so other nodes changes are seen soon)
+      * An optional shared cache (django cache framework), if configured in settings
+      * The database, that is the durable store and the fallback for everything else
+
+    Values are written through all the tiers, and read from the first one that has it.
+    Owners whose values must be seen at once by every process (counters, as login failures,
+    or keys used to invalidate other data) must be created with local=False, so the per
+    process tier is not used for them.
+    """
 
     DEFAULT_VALIDITY = 60
 
+    local: typing.ClassVar[LocalCacheBackend] = LocalCacheBackend(LOCAL_CACHE_SIZE, LOCAL_CACHE_MAX_TTL)
+    shared: typing.ClassVar[SharedCacheBackend] = SharedCacheBackend(SHARED_CACHE_NAME)
+
     _owner: str
     _bowner: bytes
+    _local: bool
+    _counters: CacheCounters
 
-    def __init__(self, owner: typing.Union[str, bytes]):
+    def __init__(self, owner: typing.Union[str, bytes], local: bool = True):
         self._owner = owner.decode('utf-8') if isinstance(owner, bytes) else owner
         self._bowner = self._owner.encode('utf8')
+        self._local = local
+        self._counters = ownerCounters(self._owner)
+
+    def _putLocal(self, key: str, value: bytes, validity: int) -> None:
+        if self._local:
+            Cache.local.put(self._owner, key, value, validity)
 
     def __getKey(self, key: typing.Union[str, bytes]) -> str:
         h = hashlib.md5()
@@ -64,37 +282,57 @@ class Cache:
         h.update(self._bowner + key)
         return h.hexdigest()
 
+    def _fromDB(self, key: str) -> typing.Optional[typing.Tuple[bytes, int]]:
+        """
+        Returns the pickled value and the remaining validity of a DB stored item, or None if not found
+        """
+        now = getSqlDatetime()
+        try:
+            c: DBCache = DBCache.objects.get(pk=key)  # @UndefinedVariable
+        except DBCache.DoesNotExist:  # @UndefinedVariable
+            return None
+        # If expired
+        remaining = int((c.created + datetime.timedelta(seconds=c.validity) - now).total_seconds())
+        if remaining < 0:
+            return None
+
+        return typing.cast(bytes, codecs.decode(c.value.encode(), 'base64')), remaining
+
     def get(
         self, skey: typing.Union[str, bytes], defValue: typing.Any = None
     ) -> typing.Any:
-        now = getSqlDatetime()
         # logger.debug('Requesting key "%s" for cache "%s"', skey, self._owner)
+        key = self.__getKey(skey)
         try:
-            key = self.__getKey(skey)
-            # logger.debug('Key: %s', key)
-            c: DBCache = DBCache.objects.get(pk=key)  # @UndefinedVariable
-            # If expired
-            if now > c.created + datetime.timedelta(seconds=c.validity):
-                return defValue
+            counter: typing.Optional[str] = 'local_hits'
+            data = Cache.local.get(key) if self._local else None
+            if data is None:
+                counter = 'shared_hits'
+                fromTier = Cache.shared.get(self._owner, key)
+                if fromTier is None:
+                    counter = None
+                    fromTier = self._fromDB(key)
+                    if fromTier is None:
+                        self._counters.misses += 1
+                        return defValue
+                    Cache.shared.put(self._owner, key, fromTier[0], fromTier[1])
+                data, remaining = fromTier
+                self._putLocal(key, data, remaining)
 
             try:
                 # logger.debug('value: %s', c.value)
-                val = pickle.loads(
-                    typing.cast(bytes, codecs.decode(c.value.encode(), 'base64'))
-                )
+                val = pickle.loads(data)
             except Exception:  # If invalid, simple do no tuse it
                 logger.exception('Invalid pickle from cache. Removing it.')
-                c.delete()
+                self.remove(skey)
                 return defValue
 
-            Cache.hits += 1
+            self._counters.hits += 1
+            if counter:
+                setattr(self._counters, counter, getattr(self._counters, counter) + 1)
             return val
-        except DBCache.DoesNotExist:  # @UndefinedVariable
-            Cache.misses += 1
-            # logger.debug('key not found: %s', skey)
-            return defValue
         except Exception:
-            Cache.misses += 1
+            self._counters.misses += 1
             # logger.debug('Cache inaccesible: %s:%s', skey, e)
             return defValue
 
@@ -104,8 +342,10 @@ class Cache:
         If cached item does not exists, nothing happens (no exception thrown)
         """
         # logger.debug('Removing key "%s" for uService "%s"' % (skey, self._owner))
+        key = self.__getKey(skey)
+        Cache.local.remove(key)
+        Cache.shared.remove(key)
         try:
-            key = self.__getKey(skey)
             DBCache.objects.get(pk=key).delete()  # @UndefinedVariable
             return True
         except DBCache.DoesNotExist:  # @UndefinedVariable
@@ -125,7 +365,8 @@ class Cache:
         if validity is None:
             validity = Cache.DEFAULT_VALIDITY
         key = self.__getKey(skey)
-        strValue: str = codecs.encode(pickle.dumps(value), 'base64').decode()
+        pickled = pickle.dumps(value)
+        strValue: str = codecs.encode(pickled, 'base64').decode()
         now = getSqlDatetime()
         try:
             DBCache.objects.create(
@@ -143,6 +384,12 @@ class Cache:
                 c.save()
             except transaction.TransactionManagementError:
                 logger.debug('Transaction in course, cannot store value')
+                # Not stored on DB, so do not keep it on upper tiers either
+                Cache.local.remove(key)
+                Cache.shared.remove(key)
+                return
+        self._putLocal(key, pickled, validity)
+        Cache.shared.put(self._owner, key, pickled, validity)
 
     def refresh(self, skey: typing.Union[str, bytes]) -> None:
         # logger.debug('Refreshing key "%s" for cache "%s"' % (skey, self._owner,))
@@ -151,12 +398,18 @@ class Cache:
             c = DBCache.objects.get(pk=key)  # @UndefinedVariable
             c.created = getSqlDatetime()
             c.save()
+            # Upper tiers are refreshed with the new validity
+            pickled = typing.cast(bytes, codecs.decode(c.value.encode(), 'base64'))
+            self._putLocal(key, pickled, c.validity)
+            Cache.shared.put(self._owner, key, pickled, c.validity)
         except DBCache.DoesNotExist:  # @UndefinedVariable
             logger.debug('Can\'t refresh cache key %s because it doesn\'t exists', skey)
             return
 
     @staticmethod
     def purge() -> None:
+        Cache.local.clear()
+        Cache.shared.clear()
         DBCache.objects.all().delete()  # @UndefinedVariable
 
     @staticmethod
@@ -166,8 +419,17 @@ class Cache:
     @staticmethod
     def delete(owner: typing.Optional[str] = None) -> None:
         # logger.info("Deleting cache items")
+        Cache.local.clear(owner)
+        Cache.shared.clear(owner)
         if owner is None:
             objects = DBCache.objects.all()  # @UndefinedVariable
         else:
             objects = DBCache.objects.filter(owner=owner)  # @UndefinedVariable
         objects.delete()
+
+    @staticmethod
+    def stats() -> typing.Dict[str, typing.Dict[str, int]]:
+        """
+        Returns a snapshot of hits/misses/evictions counters, per owner
+        """
+        return {owner: c.asDict() for owner, c in list(_counters.items())}
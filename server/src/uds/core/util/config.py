@@ -30,8 +30,10 @@
 @author: Adolfo Gómez, dkmaster at dkmon dot com
 """
 import sys
+import time
 import typing
 import logging
+import threading
 
 from django.apps import apps
 from uds.models.config import Config as DBConfig
@@ -51,6 +53,61 @@ _getLater = []
 # For custom params (for choices mainly)
 _configParams = {}
 
+# Hidden row used as version stamp of the whole configuration. Any change on a config value updates it,
+# so other nodes can know that their cached values are outdated
+VERSION_SECTION: str = '__internal'
+VERSION_KEY: str = 'configVersion'
+# Seconds between checks of version stamp. Changes made on other nodes are visible after, at most, this time
+VERSION_CHECK_INTERVAL: int = 10
+
+
+class _ConfigVersion:
+    """
+    Keeps track of configuration changes, local or made by other nodes.
+
+    "generation" is increased every time cached config values must be discarded.
+    """
+    _lock = threading.Lock()
+    generation: int = 0
+    stamp: typing.Optional[str] = None
+    lastCheck: float = 0.0
+
+    @staticmethod
+    def current() -> int:
+        """
+        Returns current generation, checking (at most once every VERSION_CHECK_INTERVAL) the stamp on db
+        """
+        now = time.monotonic()
+        if now - _ConfigVersion.lastCheck < VERSION_CHECK_INTERVAL:
+            return _ConfigVersion.generation
+
+        with _ConfigVersion._lock:
+            if now - _ConfigVersion.lastCheck >= VERSION_CHECK_INTERVAL:
+                _ConfigVersion.lastCheck = now
+                try:
+                    stamp = DBConfig.objects.filter(section=VERSION_SECTION, key=VERSION_KEY).values_list('value', flat=True).first()
+                except Exception:  # No table yet? (migrating...)
+                    return _ConfigVersion.generation
+                if stamp != _ConfigVersion.stamp:
+                    _ConfigVersion.stamp = stamp
+                    _ConfigVersion.generation += 1
+        return _ConfigVersion.generation
+
+    @staticmethod
+    def changed() -> None:
+        """
+        Invalidates cached values on this process, and notifies other nodes about the change
+        """
+        stamp = cryptoManager().uuid()
+        with _ConfigVersion._lock:
+            _ConfigVersion.stamp = stamp
+            _ConfigVersion.generation += 1
+        try:
+            if not DBConfig.objects.filter(section=VERSION_SECTION, key=VERSION_KEY).update(value=stamp):
+                DBConfig.objects.create(section=VERSION_SECTION, key=VERSION_KEY, value=stamp, field_type=Config.HIDDEN_FIELD)
+        except Exception:
+            logger.info('Could not update configuration version stamp')
+
 
 class Config:
     # Fields types, so inputs get more "beautiful"
@@ -77,8 +134,16 @@ class Config:
             else:
                 self._default = cryptoManager().encrypt(default)
             self._data: typing.Optional[str] = None
+            self._plain: typing.Optional[str] = None  # Decrypted value, if crypted
+            self._generation: int = -1
 
         def get(self, force: bool = False) -> str:
+            """
+            Returns the value. Values are cached, and cached values are discarded when any
+            config value changes (on this or other nodes, see _ConfigVersion).
+
+            "force" is kept for compatibility, but values read are, at most, VERSION_CHECK_INTERVAL seconds old.
+            """
             # Ensures DB contains configuration values
             # From Django 1.7, DB can only be accessed AFTER all apps are initialized (and ofc, not migrating...)
             if apps.ready is True:
@@ -89,10 +154,13 @@ class Config:
                 _getLater.append(self)
                 return self._default
 
+            generation = _ConfigVersion.current()
             try:
-                if force or self._data is None:
+                if self._data is None or self._generation != generation:
                     # logger.debug('Accessing db config {0}.{1}'.format(self._section.name(), self._key))
+                    self._generation = generation
                     readed = DBConfig.objects.get(section=self._section.name(), key=self._key)  # @UndefinedVariable
+                    self._plain = None
                     self._data = readed.value
                     self._crypt = [self._crypt, True][readed.crypt]  # True has "higher" precedende than False
                     self._longText = readed.long
@@ -106,10 +174,14 @@ class Config:
                     self.set(cryptoManager().decrypt(self._default))
                 elif not self._crypt:
                     self.set(self._default)
+                self._plain = None
                 self._data = self._default
 
             if self._crypt is True:
-                return cryptoManager().decrypt(typing.cast(str, self._data))
+                # Decrypted only once per change
+                if self._plain is None:
+                    self._plain = cryptoManager().decrypt(typing.cast(str, self._data))
+                return self._plain
             return typing.cast(str, self._data)
 
         def setParams(self, params: typing.Any) -> None:
@@ -164,6 +236,7 @@ class Config:
                 obj, _ = DBConfig.objects.get_or_create(section=self._section.name(), key=self._key)  # @UndefinedVariable
                 obj.value, obj.crypt, obj.long, obj.field_type = value, self._crypt, self._longText, self._type
                 obj.save()
+                _ConfigVersion.changed()
             except Exception:
                 if 'migrate' in sys.argv:  # During migration, set could be saved as part of initialization...
                     return
@@ -224,6 +297,7 @@ class Config:
                 value = cryptoManager().encrypt(value)
             cfg.value = value
             cfg.save()
+            _ConfigVersion.changed()
             logger.debug('Updated value for %s.%s to %s', section, key, value)
             return True
         except Exception:
@@ -239,8 +313,12 @@ class GlobalConfig:
     CACHE_CHECK_DELAY: Config.Value = Config.section(GLOBAL_SECTION).value('cacheCheckDelay', '19', type=Config.NUMERIC_FIELD)
     # Delayed task number of threads PER SERVER, with higher number of threads, deplayed task will complete sooner, but it will give more load to overall system
     DELAYED_TASKS_THREADS: Config.Value = Config.section(GLOBAL_SECTION).value('delayedTasksThreads', '4', type=Config.NUMERIC_FIELD)
+    # Delayed task workers PER SERVER. Delayed task threads claim tasks in batches, and this workers (shared by all threads) executes them
+    DELAYED_TASKS_WORKERS: Config.Value = Config.section(GLOBAL_SECTION).value('delayedTasksWorkers', '16', type=Config.NUMERIC_FIELD)
     # Number of scheduler threads running PER SERVER, with higher number of threads, deplayed task will complete sooner, but it will give more load to overall system
     SCHEDULER_THREADS: Config.Value = Config.section(GLOBAL_SECTION).value('schedulerThreads', '3', type=Config.NUMERIC_FIELD)
+    # Scheduler workers PER SERVER. Scheduler threads claims all due jobs at once, and this workers (shared by all threads) executes them
+    SCHEDULER_WORKERS: Config.Value = Config.section(GLOBAL_SECTION).value('schedulerWorkers', '8', type=Config.NUMERIC_FIELD)
     # Waiting time before removing "errored" and "removed" publications, cache, and user assigned machines. Time is in seconds
     CLEANUP_CHECK: Config.Value = Config.section(GLOBAL_SECTION).value('cleanupCheck', '3607', type=Config.NUMERIC_FIELD)
     # Time to maintaing "info state" items before removing it, in seconds
@@ -31,6 +31,8 @@
 @author: Adolfo Gómez, dkmaster at dkmon dot com
 """
 import re
+import bisect
+import ipaddress
 import logging
 import typing
 
@@ -62,10 +64,33 @@ def ipToLong(ip: str) -> int:
         return 0  # Invalid values will map to "0.0.0.0" --> 0
 
 
-def longToIp(n: int) -> str:
+def ipToLongAndVersion(ip: str) -> typing.Tuple[int, int]:
     """
-    convert long int to dotted quad string
+    convert an ip (decimal dotted quad or ipv6) string to (long integer, ip version).
+    IPv4 mapped ipv6 addresses are converted to their ipv4
     """
+    if ':' not in ip:
+        return ipToLong(ip), 4
+    try:
+        addr = ipaddress.IPv6Address(ip.strip())
+        if addr.ipv4_mapped:
+            return int(addr.ipv4_mapped), 4
+        return int(addr), 6
+    except Exception as e:
+        logger.error('Ivalid value: %s (%s)', ip, e)
+        return 0, 4  # Invalid values will map to "0.0.0.0" --> 0
+
+
+def isIpv6Network(strNet: str) -> bool:
+    return ':' in strNet
+
+
+def longToIp(n: int, version: int = 4) -> str:
+    """
+    convert long int to dotted quad string (or ipv6 string if version is 6)
+    """
+    if version == 6:
+        return str(ipaddress.IPv6Address(n))
     try:
         d = 1 << 24
         q = []
@@ -186,6 +211,27 @@ def networksFromString(strNets: str, allowMultipleNetworks: bool = True) -> typi
         raise ValueError(inputString)
 
 
+def ipv6NetworkFromString(strNet: str) -> NetworkType:
+    """
+    Parses an IPv6 subnet, range or host (i.e. 2001:db8::/32, 2001:db8::1-2001:db8::ff or 2001:db8::1)
+    Its range overlaps ipv4 ones, so it must not be mixed with them (i.e. on ipInNetwork)
+    """
+    try:
+        strNet = strNet.replace(' ', '')
+        if '-' in strNet:
+            start, end = strNet.split('-')
+            val = int(ipaddress.IPv6Address(start))
+            val2 = int(ipaddress.IPv6Address(end))
+            if val2 < val:
+                raise Exception()
+            return val, val2
+        ipv6Net = ipaddress.IPv6Network(strNet, strict=False)
+        return int(ipv6Net.network_address), int(ipv6Net.broadcast_address)
+    except Exception as e:
+        logger.error('Invalid network found: %s %s', strNet, e)
+        raise ValueError(strNet)
+
+
 def ipInNetwork(ip: typing.Union[str, int], network: typing.Union[str, NetworklistType]) -> bool:
     if isinstance(ip, str):
         ip = ipToLong(ip)
@@ -196,3 +242,53 @@ def ipInNetwork(ip: typing.Union[str, int], network: typing.Union[str, Networkli
         if net[0] <= ip <= net[1]:
             return True
     return False
+
+
+class NetworksMatcher:
+    """
+    Index of (possibly overlapping) ipv4 and ipv6 networks ranges, that returns the networks
+    that contains an ip in O(log n).
+
+    Ranges are splitted on sorted, non overlapping, intervals (each one starting at a bound),
+    and every interval keeps the keys of the networks that fully contains it.
+    """
+
+    # version -> sorted interval starts, and keys of networks containing each interval
+    _bounds: typing.Dict[int, typing.List[int]]
+    _keys: typing.Dict[int, typing.List[typing.Tuple[int, ...]]]
+
+    def __init__(self, ranges: typing.Iterable[typing.Tuple[int, int, int, int]]):
+        """
+        ranges are tuples of (version, start, end, key)
+        """
+        # Positions where networks starts (+key) or ends (-key)
+        events: typing.Dict[int, typing.Dict[int, typing.List[typing.Tuple[bool, int]]]] = {4: {}, 6: {}}
+        for version, start, end, key in ranges:
+            events[version].setdefault(start, []).append((True, key))
+            events[version].setdefault(end + 1, []).append((False, key))
+
+        self._bounds, self._keys = {}, {}
+        for version, versionEvents in events.items():
+            bounds: typing.List[int] = []
+            keys: typing.List[typing.Tuple[int, ...]] = []
+            active: typing.Set[int] = set()
+            for pos in sorted(versionEvents):
+                for starts, key in versionEvents[pos]:
+                    if starts:
+                        active.add(key)
+                    else:
+                        active.discard(key)
+                current = tuple(sorted(active))
+                if keys and keys[-1] == current:  # Same networks as previous interval
+                    continue
+                bounds.append(pos)
+                keys.append(current)
+            self._bounds[version], self._keys[version] = bounds, keys
+
+    def match(self, ip: str) -> typing.Tuple[int, ...]:
+        """
+        Returns the keys of the networks that contains the ip
+        """
+        value, version = ipToLongAndVersion(ip)
+        pos = bisect.bisect_right(self._bounds[version], value) - 1
+        return self._keys[version][pos] if pos >= 0 else ()
@@ -34,12 +34,15 @@ import logging
 import typing
 from uds.REST.methods.permissions import Permissions
 
+from django.db.models import Q
+
 from uds import models
 from uds.core.util import ot
+from uds.core.util.cache import Cache
 
 # Not imported at runtime, just for type checking
 if typing.TYPE_CHECKING:
-    from django.db.models import Model
+    from django.db.models import Model, QuerySet
 
 logger = logging.getLogger(__name__)
 
@@ -48,6 +51,10 @@ PERMISSION_READ = models.Permissions.PERMISSION_READ
 PERMISSION_MANAGEMENT = models.Permissions.PERMISSION_MANAGEMENT
 PERMISSION_NONE = models.Permissions.PERMISSION_NONE
 
+# Cache of users permissions, invalidated (as a whole) when any permission or group membership changes
+CACHE_OWNER = models.Permissions.CACHE_OWNER
+CACHE_VALIDITY = 600
+
 
 def clean(obj: 'Model') -> None:
     models.Permissions.cleanPermissions(ot.getObjectType(obj), obj.pk)
@@ -101,3 +108,87 @@ def revokePermissionById(permUUID: str) -> None:
         models.Permissions.objects.get(uuid=permUUID).delete()
     except Exception:
         pass
+
+
+class UserPermissions:
+    """
+    Effective permissions of an user (own ones and those of its groups), loaded with one query
+    per object type, so checks over lists of objects do not need any query per object.
+    Same rules as getEffectivePermission are applied.
+
+    Loaded permissions are cached per session (if session key is provided), until any
+    permission or group membership changes.
+    """
+
+    _user: 'models.User'
+    _key: typing.Optional[str]
+    # object type -> (permission over all objects of the type, {object id: permission})
+    _types: typing.Dict[int, typing.Tuple[int, typing.Dict[int, int]]]
+
+    def __init__(self, user: 'models.User', sessionKey: typing.Optional[str] = None) -> None:
+        self._user = user
+        self._key = '{}:{}'.format(user.uuid, sessionKey) if sessionKey else None
+        self._types = {}
+
+    def _forType(self, objType: int) -> typing.Tuple[int, typing.Dict[int, int]]:
+        if objType in self._types:
+            return self._types[objType]
+
+        cache = Cache(CACHE_OWNER, local=False)
+        key = '{}:{}'.format(self._key, objType) if self._key else None
+        perms: typing.Optional[typing.Tuple[int, typing.Dict[int, int]]] = (
+            cache.get(key) if key else None
+        )
+        if perms is None:
+            typePerm, objects = PERMISSION_NONE, {}
+            for objectId, perm in models.Permissions.objects.filter(
+                Q(user=self._user) | Q(group__in=self._user.groups.all()),
+                object_type=objType,
+            ).values_list('object_id', 'permission'):
+                if objectId is None:
+                    typePerm = max(typePerm, perm)
+                else:
+                    objects[objectId] = max(objects.get(objectId, PERMISSION_NONE), perm)
+            perms = (typePerm, objects)
+            if key:
+                cache.put(key, perms, CACHE_VALIDITY)
+
+        self._types[objType] = perms
+        return perms
+
+    def getEffectivePermission(self, obj: 'Model', root: bool = False) -> int:
+        try:
+            if self._user.is_admin is True:
+                return PERMISSION_ALL
+
+            if self._user.staff_member is False:
+                return PERMISSION_NONE
+
+            objType = ot.getObjectType(obj)
+            if objType is None:
+                return PERMISSION_NONE
+            typePerm, objects = self._forType(objType)
+            if root is False:
+                return max(typePerm, objects.get(obj.pk, PERMISSION_NONE))
+            return typePerm
+        except Exception:
+            return PERMISSION_NONE
+
+    def checkPermissions(self, obj: 'Model', permission: int = PERMISSION_ALL, root: bool = False) -> bool:
+        return self.getEffectivePermission(obj, root) >= permission
+
+    def filterQuery(self, query: 'QuerySet', permission: int = PERMISSION_READ) -> 'QuerySet':
+        """
+        Restricts query to the objects with, at least, the requested permission
+        """
+        if self._user.is_admin is True:
+            return query
+
+        objType = ot.objTypeDict.get(query.model)
+        if self._user.staff_member is False or objType is None:
+            return query.none()
+
+        typePerm, objects = self._forType(objType)
+        if typePerm >= permission:
+            return query
+        return query.filter(pk__in=[k for k, v in objects.items() if v >= permission])
@@ -31,14 +31,15 @@
 """
 import logging
 import typing
+from datetime import timedelta
 
 from django.db import transaction
-from django.db.models import Q
+from django.db.models import Q, Count
 from uds.core.util.config import GlobalConfig
 from uds.core.util.state import State
 from uds.core.managers import userServiceManager
 from uds.core.services.exceptions import MaxServicesReachedError
-from uds.models import ServicePool, ServicePoolPublication, UserService
+from uds.models import ServicePool, ServicePoolPublication, UserService, getSqlDatetime
 from uds.core import services
 from uds.core.util import log
 from uds.core.jobs import Job
@@ -80,26 +81,76 @@ class ServiceCacheUpdater(Job):
         # State filter for cached and inAssigned objects
         # First we get all deployed services that could need cache generation
         # We start filtering out the deployed services that do not need caching at all.
-        servicePoolsNeedingCaching: typing.Iterable[ServicePool] = (
+        # All counters are obtained for all service pools at once, using conditional aggregations
+        stateFilter = Q(userServices__state__in=[State.PREPARING, State.USABLE])
+        restraintTime = GlobalConfig.RESTRAINT_TIME.getInt()
+        restraintCount = GlobalConfig.RESTRAINT_COUNT.getInt()
+        errorsSince = getSqlDatetime() - timedelta(seconds=max(restraintTime, 0))
+        servicePoolsNeedingCaching: typing.List[ServicePool] = list(
             ServicePool.objects.filter(Q(initial_srvs__gte=0) | Q(cache_l1_srvs__gte=0))
             .filter(
                 max_srvs__gt=0,
                 state=State.ACTIVE,
                 service__provider__maintenance_mode=False,
             )
-            .iterator()
+            .select_related('service', 'service__provider')
+            .annotate(
+                l1_count=Count(
+                    'userServices',
+                    filter=stateFilter & Q(userServices__cache_level=services.UserDeployment.L1_CACHE),
+                ),
+                l2_count=Count(
+                    'userServices',
+                    filter=stateFilter & Q(userServices__cache_level=services.UserDeployment.L2_CACHE),
+                ),
+                assigned_count=Count(
+                    'userServices', filter=stateFilter & Q(userServices__cache_level=0)
+                ),
+                preparing_count=Count(
+                    'userServices', filter=Q(userServices__state=State.PREPARING)
+                ),
+                errors_count=Count(
+                    'userServices',
+                    filter=Q(userServices__state=State.ERROR, userServices__state_date__gt=errorsSince),
+                ),
+            )
         )
+        if not servicePoolsNeedingCaching:
+            return []
+
+        poolIds = [servicePool.id for servicePool in servicePoolsNeedingCaching]
+
+        # L1 elements marked for destroy after finishing preparation are not counted
+        destroyAfter: typing.Dict[int, int] = dict(
+            UserService.objects.filter(
+                userServiceManager().getCacheStateFilter(services.UserDeployment.L1_CACHE),
+                deployed_service_id__in=poolIds,
+                properties__name='destroy_after',
+                properties__value='y',
+            )
+            .values('deployed_service_id')
+            .annotate(number=Count('id', distinct=True))
+            .values_list('deployed_service_id', 'number')
+        )
+
+        # Usable and preparing publications of the service pools
+        publications: typing.Dict[typing.Tuple[int, str], int] = {
+            (poolId, state): number
+            for poolId, state, number in ServicePoolPublication.objects.filter(
+                deployed_service_id__in=poolIds, state__in=[State.USABLE, State.PREPARING]
+            )
+            .values('deployed_service_id', 'state')
+            .annotate(number=Count('id'))
+            .values_list('deployed_service_id', 'state', 'number')
+        }
 
         # We will get the one that proportionally needs more cache
         servicesPools: typing.List[typing.Tuple[ServicePool, int, int, int]] = []
         for servicePool in servicePoolsNeedingCaching:
-            servicePool.userServices.update()  # Cleans cached queries
             # If this deployedService don't have a publication active and needs it, ignore it
-            spServiceInstance = servicePool.service.getInstance()
-
             if (
-                servicePool.activePublication() is None
-                and spServiceInstance.publicationType is not None
+                publications.get((servicePool.id, State.USABLE), 0) == 0
+                and servicePool.service.getType().publicationType is not None
             ):
                 logger.debug(
                     'Skipping. %s Needs publication but do not have one',
@@ -107,14 +158,14 @@ class ServiceCacheUpdater(Job):
                 )
                 continue
             # If it has any running publication, do not generate cache anymore
-            if servicePool.publications.filter(state=State.PREPARING).count() > 0:
+            if publications.get((servicePool.id, State.PREPARING), 0) > 0:
                 logger.debug(
                     'Skipping cache generation for service pool with publication running: %s',
                     servicePool.name,
                 )
                 continue
 
-            if servicePool.isRestrained():
+            if restraintTime > 0 and servicePool.errors_count >= restraintCount:  # type: ignore  # Annotated field
                 logger.debug(
                     'StopSkippingped cache generation for restrained service pool: %s',
                     servicePool.name,
@@ -123,107 +174,90 @@ class ServiceCacheUpdater(Job):
                 continue
 
             # Get data related to actual state of cache
-            inCacheL1: int = (
-                servicePool.cachedUserServices()
-                .filter(
-                    userServiceManager().getCacheStateFilter(
-                        services.UserDeployment.L1_CACHE
-                    )
-                )
-                .exclude(Q(properties__name='destroy_after') & Q(properties__value='y'))
-                .count()
-            )
-            inCacheL2: int = (
-                servicePool.cachedUserServices()
-                .filter(
-                    userServiceManager().getCacheStateFilter(
-                        services.UserDeployment.L2_CACHE
-                    )
-                )
-                .count()
-            )
-            inAssigned: int = (
-                servicePool.assignedUserServices()
-                .filter(userServiceManager().getStateFilter())
-                .count()
-            )
+            inCacheL1: int = servicePool.l1_count - destroyAfter.get(servicePool.id, 0)  # type: ignore  # Annotated field
+            inCacheL2: int = servicePool.l2_count  # type: ignore  # Annotated field
+            inAssigned: int = servicePool.assigned_count  # type: ignore  # Annotated field
             # if we bypasses max cache, we will reduce it in first place. This is so because this will free resources on service provider
             logger.debug(
-                "Examining %s with %s in cache L1 and %s in cache L2, %s inAssigned",
+                "Examining %s with %s in cache L1 and %s in cache L2, %s inAssigned, %s preparing",
                 servicePool.name,
                 inCacheL1,
                 inCacheL2,
                 inAssigned,
+                servicePool.preparing_count,  # type: ignore  # Annotated field
             )
             totalL1Assigned = inCacheL1 + inAssigned
 
             # We have more than we want
-            if totalL1Assigned > servicePool.max_srvs:
-                logger.debug('We have more services than max configured. skipping.')
-                servicesPools.append((servicePool, inCacheL1, inCacheL2, inAssigned))
-                continue
             # We have more in L1 cache than needed
+            # If we have more in L2 cache than needed, decrease L2 cache
+            # If wee need to grow l2 cache, annotate it
+            # Or we need to grow L1 cache (and we are not already at max)
+            # Provider limits are checked at planning, so all pools that needs changes are returned
             if (
-                totalL1Assigned > servicePool.initial_srvs
-                and inCacheL1 > servicePool.cache_l1_srvs
-            ):
-                logger.debug(
-                    'We have more services in cache L1 than configured, appending'
-                )
-                servicesPools.append((servicePool, inCacheL1, inCacheL2, inAssigned))
-                continue
-
-            # If we have more in L2 cache than needed, decrease L2 cache, but int this case, we continue checking cause L2 cache removal
-            # has less priority than l1 creations or removals, but higher. In this case, we will simply take last l2 oversized found and reduce it
-            if inCacheL2 > servicePool.cache_l2_srvs:
-                logger.debug(
-                    'We have more services in L2 cache than configured, appending'
+                totalL1Assigned > servicePool.max_srvs
+                or (
+                    totalL1Assigned > servicePool.initial_srvs
+                    and inCacheL1 > servicePool.cache_l1_srvs
                 )
-                servicesPools.append((servicePool, inCacheL1, inCacheL2, inAssigned))
-                continue
-
-            # If this service don't allows more starting user services, continue
-            if (
-                userServiceManager().canInitiateServiceFromDeployedService(servicePool)
-                is False
-            ):
-                logger.debug(
-                    'This provider has the max allowed starting services running: %s',
-                    servicePool,
+                or inCacheL2 != servicePool.cache_l2_srvs
+                or (
+                    totalL1Assigned < servicePool.max_srvs
+                    and (
+                        totalL1Assigned < servicePool.initial_srvs
+                        or inCacheL1 < servicePool.cache_l1_srvs
+                    )
                 )
-                continue
-
-            # If wee need to grow l2 cache, annotate it
-            # Whe check this before checking the total, because the l2 cache is independent of max services or l1 cache.
-            # It reflects a value that must be keeped in cache for futre fast use.
-            if inCacheL2 < servicePool.cache_l2_srvs:
-                logger.debug('Needs to grow L2 cache for %s', servicePool)
-                servicesPools.append((servicePool, inCacheL1, inCacheL2, inAssigned))
-                continue
-
-            # We skip it if already at max
-            if totalL1Assigned == servicePool.max_srvs:
-                continue
-
-            if (
-                totalL1Assigned < servicePool.initial_srvs
-                or inCacheL1 < servicePool.cache_l1_srvs
             ):
-                logger.debug('Needs to grow L1 cache for %s', servicePool)
                 servicesPools.append((servicePool, inCacheL1, inCacheL2, inAssigned))
 
         # We also return calculated values so we can reuse then
         return servicesPools
 
+    @staticmethod
+    def providersCreationBudget(
+        servicesPools: typing.Iterable[ServicePool],
+    ) -> typing.Dict[int, typing.Optional[int]]:
+        """
+        Returns, for each provider of the service pools, how many new user services can be started
+        right now (honoring max preparing services), or None if limits are ignored.
+        """
+        providers = {sp.service.provider.id: sp.service.provider for sp in servicesPools}
+        if not providers:
+            return {}
+        preparing: typing.Dict[int, int] = dict(
+            UserService.objects.filter(
+                deployed_service__service__provider__id__in=list(providers.keys()),
+                state=State.PREPARING,
+            )
+            .values('deployed_service__service__provider__id')
+            .annotate(number=Count('id'))
+            .values_list('deployed_service__service__provider__id', 'number')
+        )
+        budget: typing.Dict[int, typing.Optional[int]] = {}
+        for providerId, provider in providers.items():
+            providerInstance = provider.getInstance()
+            if providerInstance.getIgnoreLimits():
+                budget[providerId] = None
+            else:
+                budget[providerId] = max(
+                    0,
+                    providerInstance.getMaxPreparingServices()
+                    - preparing.get(providerId, 0),
+                )
+        return budget
+
     def growL1Cache(
-        self, servicePool: ServicePool, cacheL1: int, cacheL2: int, assigned: int
-    ) -> None:
+        self, servicePool: ServicePool, cacheL1: int, cacheL2: int, assigned: int, canCreate: bool = True
+    ) -> typing.Optional[typing.Tuple[int, int]]:
         """
         This method tries to enlarge L1 cache.
 
         If for some reason the number of deployed services (Counting all, ACTIVE
         and PREPARING, assigned, L1 and L2) is over max allowed service deployments,
         this method will not grow the L1 cache
+
+        Returns the new (cacheL1, cacheL2) values, or None if the cache could not be grown
         """
         logger.debug('Growing L1 cache creating a new service for %s', servicePool.name)
         # First, we try to assign from L2 cache
@@ -252,13 +286,17 @@ class ServiceCacheUpdater(Job):
 
             if valid is not None:
                 valid.moveToLevel(services.UserDeployment.L1_CACHE)
-                return
+                return cacheL1 + 1, cacheL2 - 1
+
+        if not canCreate:
+            return None
         try:
             # This has a velid publication, or it will not be here
             userServiceManager().createCacheFor(
                 typing.cast(ServicePoolPublication, servicePool.activePublication()),
                 services.UserDeployment.L1_CACHE,
             )
+            return cacheL1 + 1, cacheL2
         except MaxServicesReachedError:
             log.doLog(
                 servicePool,
@@ -273,16 +311,19 @@ class ServiceCacheUpdater(Job):
             )
         except Exception:
             logger.exception('Exception')
+        return None
 
     def growL2Cache(
         self, servicePool: ServicePool, cacheL1: int, cacheL2: int, assigned: int
-    ) -> None:
+    ) -> typing.Optional[typing.Tuple[int, int]]:
         """
         Tries to grow L2 cache of service.
 
         If for some reason the number of deployed services (Counting all, ACTIVE
         and PREPARING, assigned, L1 and L2) is over max allowed service deployments,
         this method will not grow the L1 cache
+
+        Returns the new (cacheL1, cacheL2) values, or None if the cache could not be grown
         """
         logger.debug("Growing L2 cache creating a new service for %s", servicePool.name)
         try:
@@ -291,6 +332,7 @@ class ServiceCacheUpdater(Job):
                 typing.cast(ServicePoolPublication, servicePool.activePublication()),
                 services.UserDeployment.L2_CACHE,
             )
+            return cacheL1, cacheL2 + 1
         except MaxServicesReachedError:
             logger.warning(
                 'Max user services reached for %s: %s. Cache not created',
@@ -298,10 +340,16 @@ class ServiceCacheUpdater(Job):
                 servicePool.max_srvs,
             )
             # TODO: When alerts are ready, notify this
+        except Exception:
+            logger.exception('Exception')
+        return None
 
     def reduceL1Cache(
         self, servicePool: ServicePool, cacheL1: int, cacheL2: int, assigned: int
-    ):
+    ) -> typing.Optional[typing.Tuple[int, int]]:
+        """
+        Returns the new (cacheL1, cacheL2) values, or None if the cache could not be reduced
+        """
         logger.debug("Reducing L1 cache erasing a service in cache for %s", servicePool)
         # We will try to destroy the newest cacheL1 element that is USABLE if the deployer can't cancel a new service creation
         cacheItems: typing.List[UserService] = list(
@@ -320,7 +368,7 @@ class ServiceCacheUpdater(Job):
             logger.debug(
                 'There is more services than max configured, but could not reduce cache L1 cause its already empty'
             )
-            return
+            return None
 
         if cacheL2 < servicePool.cache_l2_srvs:
             valid = None
@@ -335,14 +383,18 @@ class ServiceCacheUpdater(Job):
 
             if valid is not None:
                 valid.moveToLevel(services.UserDeployment.L2_CACHE)
-                return
+                return cacheL1 - 1, cacheL2 + 1
 
         cache = cacheItems[0]
         cache.removeOrCancel()
+        return cacheL1 - 1, cacheL2
 
     def reduceL2Cache(
         self, servicePool: ServicePool, cacheL1: int, cacheL2: int, assigned: int
-    ):
+    ) -> typing.Optional[typing.Tuple[int, int]]:
+        """
+        Returns the new (cacheL1, cacheL2) values, or None if the cache could not be reduced
+        """
         logger.debug(
             "Reducing L2 cache erasing a service in cache for %s", servicePool.name
         )
@@ -359,39 +411,84 @@ class ServiceCacheUpdater(Job):
             # TODO: Look first for non finished cache items and cancel them?
             cache = cacheItems[0]
             cache.removeOrCancel()
+            return cacheL1, cacheL2 - 1
+        return None
+
+    def updateOnce(
+        self,
+        servicePool: ServicePool,
+        cacheL1: int,
+        cacheL2: int,
+        assigned: int,
+        budget: typing.Dict[int, typing.Optional[int]],
+    ) -> typing.Optional[typing.Tuple[int, int]]:
+        """
+        Executes one cache operation (create, move or remove) on the service pool.
+
+        Returns the new (cacheL1, cacheL2) values, or None if nothing else can be done on this pass
+        """
+        totalL1Assigned = cacheL1 + assigned
+        providerId = servicePool.service.provider.id
+        remaining = budget.get(providerId)
+        canCreate = remaining is None or remaining > 0
+
+        # We try first to reduce cache before tring to increase it.
+        # This means that if there is excesive number of user deployments
+        # for L1 or L2 cache, this will be reduced untill they have good numbers.
+        # This is so because service can have limited the number of services and,
+        # if we try to increase cache before having reduced whatever needed
+        # first, the service will get lock until someone removes something.
+        if totalL1Assigned > servicePool.max_srvs:
+            return self.reduceL1Cache(servicePool, cacheL1, cacheL2, assigned)
+        if (
+            totalL1Assigned > servicePool.initial_srvs
+            and cacheL1 > servicePool.cache_l1_srvs
+        ):
+            return self.reduceL1Cache(servicePool, cacheL1, cacheL2, assigned)
+        if cacheL2 > servicePool.cache_l2_srvs:  # We have excesives L2 items
+            return self.reduceL2Cache(servicePool, cacheL1, cacheL2, assigned)
+        result: typing.Optional[typing.Tuple[int, int]] = None
+        if totalL1Assigned < servicePool.max_srvs and (
+            totalL1Assigned < servicePool.initial_srvs
+            or cacheL1 < servicePool.cache_l1_srvs
+        ):  # We need more services
+            result = self.growL1Cache(servicePool, cacheL1, cacheL2, assigned, canCreate)
+            # Moving from L2 to L1 do not starts a new service
+            created = result is not None and result[1] == cacheL2
+        elif cacheL2 < servicePool.cache_l2_srvs and canCreate:  # We need more L2 items
+            result = self.growL2Cache(servicePool, cacheL1, cacheL2, assigned)
+            created = result is not None
+        else:
+            if not canCreate:
+                logger.debug(
+                    'This provider has the max allowed starting services running: %s',
+                    servicePool,
+                )
+            return None
+
+        if created and remaining is not None:
+            budget[providerId] = remaining - 1
+        return result
 
     def run(self):
         logger.debug('Starting cache checking')
         # We need to get
         servicesThatNeedsUpdate = self.servicesPoolsNeedingCacheUpdate()
-        for servicePool, cacheL1, cacheL2, assigned in servicesThatNeedsUpdate:
-            # We have cache to update??
-            logger.debug("Updating cache for %s", servicePool)
-            totalL1Assigned = cacheL1 + assigned
-
-            # We try first to reduce cache before tring to increase it.
-            # This means that if there is excesive number of user deployments
-            # for L1 or L2 cache, this will be reduced untill they have good numbers.
-            # This is so because service can have limited the number of services and,
-            # if we try to increase cache before having reduced whatever needed
-            # first, the service will get lock until someone removes something.
-            if totalL1Assigned > servicePool.max_srvs:
-                self.reduceL1Cache(servicePool, cacheL1, cacheL2, assigned)
-            elif (
-                totalL1Assigned > servicePool.initial_srvs
-                and cacheL1 > servicePool.cache_l1_srvs
-            ):
-                self.reduceL1Cache(servicePool, cacheL1, cacheL2, assigned)
-            elif cacheL2 > servicePool.cache_l2_srvs:  # We have excesives L2 items
-                self.reduceL2Cache(servicePool, cacheL1, cacheL2, assigned)
-            elif totalL1Assigned < servicePool.max_srvs and (
-                totalL1Assigned < servicePool.initial_srvs
-                or cacheL1 < servicePool.cache_l1_srvs
-            ):  # We need more services
-                self.growL1Cache(servicePool, cacheL1, cacheL2, assigned)
-            elif cacheL2 < servicePool.cache_l2_srvs:  # We need more L2 items
-                self.growL2Cache(servicePool, cacheL1, cacheL2, assigned)
-            else:
-                logger.warning(
-                    "We have more services than max requested for %s", servicePool.name
-                )
+        budget = self.providersCreationBudget(sp for sp, _, _, _ in servicesThatNeedsUpdate)
+
+        # Operations are executed in rounds (one operation per service pool and round), so the
+        # creation budget of the providers is shared fairly among their service pools
+        pending = servicesThatNeedsUpdate
+        while pending:
+            nextRound: typing.List[typing.Tuple[ServicePool, int, int, int]] = []
+            for servicePool, cacheL1, cacheL2, assigned in pending:
+                # We have cache to update??
+                logger.debug("Updating cache for %s", servicePool)
+                try:
+                    result = self.updateOnce(servicePool, cacheL1, cacheL2, assigned, budget)
+                except Exception:
+                    logger.exception('Updating cache for %s', servicePool)
+                    continue
+                if result is not None:
+                    nextRound.append((servicePool, result[0], result[1], assigned))
+            pending = nextRound
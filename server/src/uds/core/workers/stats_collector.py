@@ -88,6 +88,23 @@ class DeployedServiceStatsCollector(Job):
         logger.debug('Done Deployed service stats collector')
 
 
+class StatsRollupUpdater(Job):
+    """
+    This Job keeps the pre-aggregated (hourly & daily) counters updated
+    """
+
+    frecuency = 907  # Once every fifteen minutes (prime)
+    friendly_name = 'Statistic counters rollup'
+
+    def run(self):
+        logger.debug('Starting statistic counters rollup')
+        try:
+            statsManager().rollupCounters()
+        except Exception:
+            logger.exception('Rolling up counters')
+        logger.debug('Done statistic counters rollup')
+
+
 class StatsCleaner(Job):
     """
     This Job is responsible of housekeeping of stats tables.
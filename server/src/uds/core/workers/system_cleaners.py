@@ -37,6 +37,7 @@ import typing
 from django.conf import settings
 from uds.core.util.cache import Cache
 from uds.core.jobs import Job
+from uds.core.managers import logManager
 from uds.models import TicketStore
 
 logger = logging.getLogger(__name__)
@@ -64,6 +65,17 @@ class TicketStoreCleaner(Job):
         logger.debug('Done ticket storage cleanup')
 
 
+class LogCleaner(Job):
+
+    frecuency = 600  # every ten minutes
+    friendly_name = 'Logs cleaner'
+
+    def run(self):
+        logger.debug('Starting logs cleanup')
+        logManager().cleanUp()
+        logger.debug('Done logs cleanup')
+
+
 class SessionsCleaner(Job):
 
     frecuency = 3600 * 24 * 7  # Once a week will be enough
@@ -0,0 +1,31 @@
+# Generated by Django 3.1.2 on 2026-10-17 10:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('uds', '0039_auto_20201111_1329'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StatsCountersRollup',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('granularity', models.IntegerField(default=3600)),
+                ('owner_id', models.IntegerField(default=0)),
+                ('owner_type', models.SmallIntegerField(default=0)),
+                ('counter_type', models.SmallIntegerField(default=0)),
+                ('stamp', models.IntegerField(default=0)),
+                ('v_count', models.IntegerField(default=0)),
+                ('v_sum', models.BigIntegerField(default=0)),
+                ('v_max', models.IntegerField(default=0)),
+            ],
+            options={
+                'db_table': 'uds_stats_c_rollup',
+                'index_together': {('granularity', 'counter_type', 'owner_type', 'stamp')},
+            },
+        ),
+    ]
@@ -72,6 +72,7 @@ from .log import Log
 # Stats
 from .stats_counters import StatsCounters
 from .stats_events import StatsEvents
+from .stats_counters_rollup import StatsCountersRollup
 
 # General utility models, such as a database cache (for caching remote content of slow connections to external services providers for example)
 # We could use django cache (and maybe we do it in a near future), but we need to clean up things when objecs owning them are deleted
@@ -113,4 +114,7 @@ from .dbfile import DBFile
 # Actor tokens
 from .actor_token import ActorToken
 
+# Services catalogue invalidation, once all models are loaded
+from .services_catalogue import ServicesCatalogue
+
 logger = logging.getLogger(__name__)
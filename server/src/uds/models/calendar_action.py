@@ -305,9 +305,14 @@ class CalendarAction(UUIDModel):
             self.service_pool.ignores_unused = params['state'] in ('true', '1', True)
         elif CALENDAR_ACTION_REMOVE_USERSERVICES['id'] == self.action:
             # 1.- Remove usable assigned services (Ignore "creating ones", just for created)
-            for userService in self.service_pool.assignedUserServices().filter(
-                state=state.State.USABLE
-            ):
+            userServices = list(
+                self.service_pool.assignedUserServices().filter(state=state.State.USABLE)
+            )
+            # Users are asked to logoff (all at once), as when they release the service
+            from uds.core.managers import userServiceManager
+
+            userServiceManager().requestLogoffBulk(userServices)
+            for userService in userServices:
                 userService.remove()
         else:
             caTransports = (
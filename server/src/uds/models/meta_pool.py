@@ -186,7 +186,6 @@ class MetaPool(UUIDModel, TaggingMixin):  # type: ignore
             'members__pool__service__provider',
             'members__pool__image',
             'members__pool__transports',
-            'members__pool__transports__networks',
             'calendarAccess',
             'calendarAccess__calendar',
             'calendarAccess__calendar__rules',
@@ -31,9 +31,12 @@
 .. moduleauthor:: Adolfo Gómez, dkmaster at dkmon dot com
 """
 import logging
+import threading
+import time
 import typing
+import uuid
 
-from django.db import models
+from django.db import models, transaction
 
 from uds.core.util import net
 
@@ -72,10 +75,22 @@ class Network(UUIDModel, TaggingMixin):  # type: ignore
     @staticmethod
     def networksFor(ip: str) -> typing.Iterable['Network']:
         """
-        Returns the networks that are valid for specified ip in dotted quad (xxx.xxx.xxx.xxx)
+        Returns the networks that are valid for specified ip (in dotted quad or ipv6 format)
+        Networks are got from the in memory index, so they must not be modified
         """
-        ipInt = net.ipToLong(ip)
-        return Network.objects.filter(net_start__lte=ipInt, net_end__gte=ipInt)
+        index = NetworksIndex.get()
+        return [index.networks[i] for i in index.matcher.match(ip)]
+
+    @staticmethod
+    def storedRange(netRange: str) -> net.NetworkType:
+        """
+        Returns the net_start and net_end to store for a network range.
+        IPv6 ranges does not fit on them, so they are stored as 0 (and its range is got from net_string)
+        """
+        if net.isIpv6Network(netRange):
+            net.ipv6NetworkFromString(netRange)  # Just validates it
+            return 0, 0
+        return net.networkFromString(netRange)
 
     @staticmethod
     def create(name: str, netRange: str) -> 'Network':
@@ -87,30 +102,43 @@ class Network(UUIDModel, TaggingMixin):  # type: ignore
 
             netEnd: Network end
         """
-        nr = net.networkFromString(netRange)
+        nr = Network.storedRange(netRange)
         return Network.objects.create(
             name=name, net_start=nr[0], net_end=nr[1], net_string=netRange
         )
 
+    @property
+    def version(self) -> int:
+        return 6 if net.isIpv6Network(self.net_string) else 4
+
+    @property
+    def netRange(self) -> net.NetworkType:
+        """
+        Range of this network, as integers
+        """
+        if self.version == 6:
+            return net.ipv6NetworkFromString(self.net_string)
+        return self.net_start, self.net_end
+
     @property
     def netStart(self) -> str:
         """
-        Property to access the quad dotted format of the stored network start
+        Property to access the quad dotted (or ipv6) format of the network start
 
         Returns:
             string representing the dotted quad of this network start
         """
-        return net.longToIp(self.net_start)
+        return net.longToIp(self.netRange[0], self.version)
 
     @property
     def netEnd(self) -> str:
         """
-        Property to access the quad dotted format of the stored network end
+        Property to access the quad dotted (or ipv6) format of the network end
 
         Returns:
             string representing the dotted quad of this network end
         """
-        return net.longToIp(self.net_end)
+        return net.longToIp(self.netRange[1], self.version)
 
     def update(self, name: str, netRange: str):
         """
@@ -124,7 +152,7 @@ class Network(UUIDModel, TaggingMixin):  # type: ignore
             netEnd: new Network end (quad dotted)
         """
         self.name = name
-        nr = net.networkFromString(netRange)
+        nr = Network.storedRange(netRange)
         self.net_start = nr[0]
         self.net_end = nr[1]
         self.net_string = netRange
@@ -134,8 +162,8 @@ class Network(UUIDModel, TaggingMixin):  # type: ignore
         return u'Network {} ({}) from {} to {}'.format(
             self.name,
             self.net_string,
-            net.longToIp(self.net_start),
-            net.longToIp(self.net_end),
+            self.netStart,
+            self.netEnd,
         )
 
     @staticmethod
@@ -150,5 +178,99 @@ class Network(UUIDModel, TaggingMixin):  # type: ignore
         clean(toDelete)
 
 
+class NetworksIndex:
+    """
+    In memory index of all networks, and the networks of every transport, so ips can be checked
+    against them without any database access.
+
+    Index is versioned. Version is kept on cache, and changed on every networks (or its transports)
+    change, so every process rebuilds its own index when it notices the new version.
+    Version is checked at most once every VERSION_CHECK_INTERVAL seconds (changes done on this
+    process are noticed at once).
+    """
+
+    CACHE_OWNER: typing.ClassVar[str] = 'networksIndex'
+    VERSION_KEY: typing.ClassVar[str] = 'version'
+    VERSION_VALIDITY: typing.ClassVar[int] = 86400
+    VERSION_CHECK_INTERVAL: typing.ClassVar[int] = 10
+
+    _lock: typing.ClassVar[threading.Lock] = threading.Lock()
+    _current: typing.ClassVar[typing.Optional['NetworksIndex']] = None
+    _lastCheck: typing.ClassVar[float] = 0.0
+
+    version: str
+    matcher: net.NetworksMatcher
+    # Networks by id, and transport id -> ids of its networks
+    networks: typing.Dict[int, Network]
+    transports: typing.Dict[int, typing.FrozenSet[int]]
+
+    def __init__(self, version: str) -> None:
+        self.version = version
+        self.networks = {n.id: n for n in Network.objects.all()}
+        ranges = []
+        for n in self.networks.values():
+            try:
+                start, end = n.netRange
+            except ValueError:  # Invalid stored ipv6 network, skip it
+                continue
+            ranges.append((n.version, start, end, n.id))
+        self.matcher = net.NetworksMatcher(ranges)
+
+        transports: typing.Dict[int, typing.Set[int]] = {}
+        for networkId, transportId in Network.transports.through.objects.values_list(
+            'network_id', 'transport_id'
+        ):
+            transports.setdefault(transportId, set()).add(networkId)
+        self.transports = {k: frozenset(v) for k, v in transports.items()}
+
+    @staticmethod
+    def get() -> 'NetworksIndex':
+        """
+        Returns current index, rebuilding it if it is outdated
+        """
+        from uds.core.util.cache import Cache  # pylint: disable=import-outside-toplevel
+
+        now = time.monotonic()
+        index = NetworksIndex._current
+        if index is not None and now - NetworksIndex._lastCheck < NetworksIndex.VERSION_CHECK_INTERVAL:
+            return index
+
+        cache = Cache(NetworksIndex.CACHE_OWNER, local=False)
+        version = cache.get(NetworksIndex.VERSION_KEY)
+        NetworksIndex._lastCheck = now
+        if index is not None and index.version == version:
+            return index
+
+        with NetworksIndex._lock:
+            index = NetworksIndex._current
+            if index is None or index.version != version:
+                if version is None:  # No version yet (or expired), so set a new one
+                    version = uuid.uuid4().hex
+                    cache.put(NetworksIndex.VERSION_KEY, version, NetworksIndex.VERSION_VALIDITY)
+                logger.debug('Building networks index, version %s', version)
+                index = NetworksIndex(version)
+                NetworksIndex._current = index
+        return index
+
+    @staticmethod
+    def afterChange(sender, **kwargs) -> None:
+        """
+        Sets a new index version (once committed, so indexes are not rebuilt with old data)
+        """
+        from uds.core.util.cache import Cache  # pylint: disable=import-outside-toplevel
+
+        def changed() -> None:
+            Cache(NetworksIndex.CACHE_OWNER, local=False).put(
+                NetworksIndex.VERSION_KEY, uuid.uuid4().hex, NetworksIndex.VERSION_VALIDITY
+            )
+            NetworksIndex._lastCheck = 0.0  # So this process sees it at once
+
+        transaction.on_commit(changed)
+
+
 # Connects a pre deletion signal to Authenticator
 models.signals.pre_delete.connect(Network.beforeDelete, sender=Network)
+models.signals.post_save.connect(NetworksIndex.afterChange, sender=Network)
+models.signals.post_delete.connect(NetworksIndex.afterChange, sender=Network)
+models.signals.m2m_changed.connect(NetworksIndex.afterChange, sender=Network.transports.through)
+models.signals.post_delete.connect(NetworksIndex.afterChange, sender=Transport)
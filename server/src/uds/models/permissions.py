@@ -56,6 +56,9 @@ class Permissions(UUIDModel):
     PERMISSION_MANAGEMENT = 64
     PERMISSION_ALL = 96
 
+    # Cache owner of users effective permissions (see uds.core.util.permissions.UserPermissions)
+    CACHE_OWNER = 'permissions'
+
     created = models.DateTimeField(db_index=True)
     ends = models.DateTimeField(
         db_index=True, null=True, blank=True, default=None
@@ -211,3 +214,17 @@ class Permissions(UUIDModel):
             self.object_id,
             Permissions.permissionAsString(self.permission),
         )
+
+    @staticmethod
+    def afterChange(sender, **kwargs) -> None:
+        """
+        Used to invalidate cached users permissions after permissions (or groups membership) changes
+        """
+        from uds.core.util.cache import Cache  # pylint: disable=import-outside-toplevel
+
+        Cache.delete(Permissions.CACHE_OWNER)
+
+
+models.signals.post_save.connect(Permissions.afterChange, sender=Permissions)
+models.signals.post_delete.connect(Permissions.afterChange, sender=Permissions)
+models.signals.m2m_changed.connect(Permissions.afterChange, sender=Group.users.through)
@@ -572,7 +572,6 @@ class ServicePool(UUIDModel, TaggingMixin):  #  type: ignore
             )
             .prefetch_related(
                 'transports',
-                'transports__networks',
                 'memberOfMeta',
                 'osmanager',
                 'publications',
@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2012-2021 Virtual Cable S.L.U.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without modification,
+# are permitted provided that the following conditions are met:
+#
+#    * Redistributions of source code must retain the above copyright notice,
+#      this list of conditions and the following disclaimer.
+#    * Redistributions in binary form must reproduce the above copyright notice,
+#      this list of conditions and the following disclaimer in the documentation
+#      and/or other materials provided with the distribution.
+#    * Neither the name of Virtual Cable S.L. nor the names of its contributors
+#      may be used to endorse or promote products derived from this software
+#      without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+'''
+.. moduleauthor:: Adolfo Gómez, dkmaster at dkmon dot com
+'''
+import logging
+import typing
+
+from django.db import models, transaction
+
+from .service_pool import ServicePool
+from .service_pool_publication import ServicePoolPublication
+from .service_pool_group import ServicePoolGroup
+from .meta_pool import MetaPool, MetaPoolMember
+from .transport import Transport
+from .network import Network
+from .group import Group
+from .provider import Provider
+from .calendar import Calendar
+from .calendar_rule import CalendarRule
+from .calendar_access import CalendarAccess, CalendarAccessMeta
+
+logger = logging.getLogger(__name__)
+
+
+class ServicesCatalogue:
+    """
+    Catalogue of visible services (pools, meta pools and its transports) for a group set, os and networks,
+    kept on cache (see uds.web.util.services.getCatalogue).
+    It is invalidated as a whole when any of the models it is built from changes, and anyway at the end
+    of current minute (calendars, maintenance and usage counters are evaluated when built).
+    Signals are connected here, so changes made from any process (web or task manager) invalidate it.
+    """
+
+    CACHE_OWNER: typing.ClassVar[str] = 'servicesCatalogue'
+
+    @staticmethod
+    def invalidate(sender, **kwargs) -> None:  # pylint: disable=unused-argument
+        """
+        Invalidates the catalogue once committed, so it is not rebuilt (and cached) with old data
+        """
+        from uds.core.util.cache import Cache  # pylint: disable=import-outside-toplevel
+
+        transaction.on_commit(lambda: Cache.delete(ServicesCatalogue.CACHE_OWNER))
+
+
+for _model in (
+    ServicePool,
+    ServicePoolPublication,
+    ServicePoolGroup,
+    MetaPool,
+    MetaPoolMember,
+    Transport,
+    Network,
+    Group,
+    Provider,
+    Calendar,
+    CalendarRule,
+    CalendarAccess,
+    CalendarAccessMeta,
+):
+    models.signals.post_save.connect(ServicesCatalogue.invalidate, sender=_model)
+    models.signals.post_delete.connect(ServicesCatalogue.invalidate, sender=_model)
+
+for _through in (
+    ServicePool.transports.through,
+    ServicePool.assignedGroups.through,
+    MetaPool.assignedGroups.through,
+    Transport.networks.through,
+):
+    models.signals.m2m_changed.connect(ServicesCatalogue.invalidate, sender=_through)
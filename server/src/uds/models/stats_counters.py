@@ -66,31 +66,57 @@ class StatsCounters(models.Model):
         db_table = 'uds_stats_c'
         app_label = 'uds'
 
+    @staticmethod
+    def _stampsInfo(
+        table: str, filt: str, since: int, to: int, countFnc: str = 'COUNT(*)'
+    ) -> typing.Tuple[int, typing.Optional[int], typing.Optional[int]]:
+        """
+        Returns number of counters, first & last stamp of counters on table in [since, to)
+        """
+        from django.db import connection  # pylint: disable=import-outside-toplevel
+
+        with connection.cursor() as cursor:
+            cursor.execute(
+                'SELECT {}, MIN(stamp), MAX(stamp) FROM {} WHERE {} AND stamp>={} AND stamp<{}'.format(
+                    countFnc, table, filt, since, to
+                )
+            )
+            count, first, last = cursor.fetchone()
+        return int(count or 0), first, last
+
+    @staticmethod
+    def _endOfSlot(stamp: int, interval: int) -> int:
+        """
+        End of the interval slot that contains stamp (stamp itself if it is a multiple of interval)
+        """
+        return stamp + (interval - stamp % interval) % interval
+
     @staticmethod
     def get_grouped(
         owner_type: typing.Union[int, typing.Iterable[int]], counter_type: int, **kwargs
-    ) -> 'models.QuerySet[StatsCounters]':  # pylint: disable=too-many-locals
+    ) -> typing.List['StatsCounters']:  # pylint: disable=too-many-locals
         """
         Returns the average stats grouped by interval for owner_type and owner_id (optional)
 
-        Note: if someone cant get this more optimized, please, contribute it!
+        Pre-aggregated counters (see StatsCountersRollup) are used if the interval allows it, and raw
+        counters are only used for those not yet added to rollups (merged by interval).
         """
+        from .stats_counters_rollup import StatsCountersRollup  # pylint: disable=import-outside-toplevel
 
-        filt = 'owner_type'
         if isinstance(owner_type, (list, tuple, types.GeneratorType)):
-            filt += ' in (' + ','.join((str(x) for x in owner_type)) + ')'
+            filt = 'owner_type in (' + ','.join(str(int(x)) for x in owner_type) + ')'
         else:
-            filt += '=' + str(owner_type)
+            filt = 'owner_type=' + str(int(owner_type))
 
         owner_id = kwargs.get('owner_id', None)
         if owner_id:
-            filt += ' AND OWNER_ID'
+            filt += ' AND owner_id'
             if isinstance(owner_id, (list, tuple, types.GeneratorType)):
-                filt += ' in (' + ','.join(str(x) for x in owner_id) + ')'
+                filt += ' in (' + ','.join(str(int(x)) for x in owner_id) + ')'
             else:
-                filt += '=' + str(owner_id)
+                filt += '=' + str(int(owner_id))
 
-        filt += ' AND counter_type=' + str(counter_type)
+        filt += ' AND counter_type=' + str(int(counter_type))
 
         since = kwargs.get('since', None)
         to = kwargs.get('to', None)
@@ -106,64 +132,114 @@ class StatsCounters(models.Model):
 
         limit = kwargs.get('limit')
 
+        rawTable = StatsCounters._meta.db_table
+        rollupTable = StatsCountersRollup._meta.db_table
+        # Raw counters not yet added to rollups
+        rawFilt = filt + ' AND id>{}'.format(StatsCountersRollup.rolledId())
+
         if max_intervals:
             # Protect against division by "elements-1" a few lines below
             max_intervals = int(max_intervals) if int(max_intervals) > 1 else 2
 
-            if owner_id is None:
-                q = StatsCounters.objects.filter(stamp__gte=since, stamp__lte=to)
-            else:
-                if isinstance(owner_id, (list, tuple, types.GeneratorType)):
-                    q = StatsCounters.objects.filter(
-                        owner_id__in=owner_id, stamp__gte=since, stamp__lte=to
-                    )
-                else:
-                    q = StatsCounters.objects.filter(
-                        owner_id=owner_id, stamp__gte=since, stamp__lte=to
-                    )
-
-            if isinstance(owner_type, (list, tuple, types.GeneratorType)):
-                q = q.filter(owner_type__in=owner_type)
-            else:
-                q = q.filter(owner_type=owner_type)
-
-            if q.count() > max_intervals:
-                first = q.order_by('stamp')[0].stamp
-                last = q.order_by('stamp').reverse()[0].stamp
-                interval = int((last - first) / (max_intervals - 1))
-
-        stampValue = '{ceil}(stamp/{interval})'.format(
-            ceil=getSqlFnc('CEIL'), interval=interval
+            # Rolled up counters are obtained from hourly rollups, and the rest from raw ones
+            count, first, last = StatsCounters._stampsInfo(
+                rollupTable,
+                filt + ' AND granularity={}'.format(StatsCountersRollup.HOURLY),
+                since,
+                to + 1,
+                'SUM(v_count)',
+            )
+            rawCount, rawFirst, rawLast = StatsCounters._stampsInfo(
+                rawTable, rawFilt, since, to + 1
+            )
+            count += rawCount
+            first = min((v for v in (first, rawFirst) if v is not None), default=None)
+            last = max((v for v in (last, rawLast) if v is not None), default=None)
+
+            if count > max_intervals and first is not None and last is not None:
+                interval = max(int((last - first) / (max_intervals - 1)), 1)
+                # Rounded up to whole hours, so hourly rollups can be used
+                if interval > StatsCountersRollup.HOURLY:
+                    interval = StatsCounters._endOfSlot(interval, StatsCountersRollup.HOURLY)
+
+        # Coarsest rollup that can be used for this interval (its rows must fit whole in the intervals)
+        granularity = max(
+            (g for g in StatsCountersRollup.INTERVALS if g <= interval and interval % g == 0),
+            default=0,
         )
-        filt += ' AND stamp>={since} AND stamp<={to} GROUP BY {stampValue} ORDER BY stamp'.format(
-            since=since, to=to, stampValue=stampValue
-        )
-
-        if limit:
-            filt += ' LIMIT {}'.format(limit)
-
-        if kwargs.get('use_max', False):
+        # Rollup rows used must be fully inside [since, to]: a row with stamp S holds (S - granularity, S]
+        if granularity:
+            rollupSince = StatsCounters._endOfSlot(since - 1 + granularity, granularity)
+            rollupTo = to - to % granularity
+            if rollupSince > rollupTo:
+                granularity = 0
+
+        # End of the interval of each stamp (CEIL(stamp/interval)*interval, with integer arithmetic,
+        # so it is the same on every database, and the same used by StatsCountersRollup)
+        stampValue = '(stamp + ({interval} - stamp % {interval}) % {interval})'.format(interval=interval)
+
+        def query(
+            table: str, fltr: str, fnc: str, sumCount: str, fromStamp: int, toStamp: int
+        ) -> typing.List['StatsCounters']:
+            fltr += ' AND stamp>={since} AND stamp<={to} GROUP BY {stampValue} ORDER BY stamp'.format(
+                since=fromStamp, to=toStamp, stampValue=stampValue
+            )
+            if limit:
+                fltr += ' LIMIT {}'.format(limit)
+
+            sql = (
+                'SELECT -1 as id,-1 as owner_id,-1 as owner_type,-1 as counter_type, '
+                + stampValue
+                + ' AS stamp, '
+                + '{} AS value, {} '
+                'FROM {} WHERE {}'
+            ).format(fnc, sumCount, table, fltr)
+
+            logger.debug('Stats query: %s', sql)
+            return list(StatsCounters.objects.raw(sql))
+
+        useMax = kwargs.get('use_max', False)
+        # Values of an interval are merged from rollups and raw counters, so sum and count are also needed
+        result: typing.Dict[int, 'StatsCounters'] = {}
+        if granularity:
+            if useMax:
+                fnc = getSqlFnc('MAX') + '(v_max)'
+            else:
+                fnc = getSqlFnc('CEIL') + '(SUM(v_sum) * 1.0 / SUM(v_count))'
+            for counter in query(
+                rollupTable,
+                filt + ' AND granularity={}'.format(granularity),
+                fnc,
+                'SUM(v_sum) AS v_sum, SUM(v_count) AS v_count',
+                rollupSince,
+                rollupTo,
+            ):
+                result[counter.stamp] = counter
+            # Raw counters not covered by the rollup rows used are also needed
+            rawFilt = filt + ' AND (id>{} OR stamp<={} OR stamp>{})'.format(
+                StatsCountersRollup.rolledId(), rollupSince - granularity, rollupTo
+            )
+        else:  # No rollups used, so all raw counters are needed
+            rawFilt = filt
+
+        if useMax:
             fnc = getSqlFnc('MAX') + ('(value)')
         else:
             fnc = getSqlFnc('CEIL') + '({}(value))'.format(getSqlFnc('AVG'))
 
-        # fnc = getSqlFnc('MAX' if kwargs.get('use_max', False) else 'AVG')
-
-        query = (
-            'SELECT -1 as id,-1 as owner_id,-1 as owner_type,-1 as counter_type, '
-            + stampValue
-            + '*{}'.format(interval)
-            + ' AS stamp, '
-            + '{} AS value '
-            'FROM {} WHERE {}'
-        ).format(fnc, StatsCounters._meta.db_table, filt)
-
-        logger.debug('Stats query: %s', query)
+        for counter in query(rawTable, rawFilt, fnc, 'SUM(value) AS v_sum, COUNT(*) AS v_count', since, to):
+            current = result.get(counter.stamp)
+            if current is None:
+                result[counter.stamp] = counter
+            elif useMax:
+                current.value = max(current.value, counter.value)
+            else:
+                current.v_sum = int(current.v_sum) + int(counter.v_sum)
+                current.v_count = int(current.v_count) + int(counter.v_count)
+                current.value = -(-current.v_sum // current.v_count)  # Ceil of weighted average
 
-        # We use result as an iterator
-        return typing.cast(
-            'models.QuerySet[StatsCounters]', StatsCounters.objects.raw(query)
-        )
+        counters = sorted(result.values(), key=lambda c: c.stamp)
+        return counters[:limit] if limit else counters
 
     def __str__(self):
         return u"Counter of {}({}): {} - {} - {}".format(
@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+
+#
+# Copyright (c) 2012-2020 Virtual Cable S.L.U.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without modification,
+# are permitted provided that the following conditions are met:
+#
+#    * Redistributions of source code must retain the above copyright notice,
+#      this list of conditions and the following disclaimer.
+#    * Redistributions in binary form must reproduce the above copyright notice,
+#      this list of conditions and the following disclaimer in the documentation
+#      and/or other materials provided with the distribution.
+#    * Neither the name of Virtual Cable S.L. nor the names of its contributors
+#      may be used to endorse or promote products derived from this software
+#      without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+.. moduleauthor:: Adolfo Gómez, dkmaster at dkmon dot com
+"""
+import typing
+import logging
+
+from django.db import models, transaction
+from django.db.models import Count, Sum, Max, F, Value, ExpressionWrapper, IntegerField
+from django.db.models.functions import Mod
+
+from .stats_counters import StatsCounters
+
+
+logger = logging.getLogger(__name__)
+
+
+class StatsCountersRollup(models.Model):
+    """
+    Pre-aggregated (hourly and daily) statistics counters, per owner and counter type.
+
+    stamp is the end of the interval (unix time, multiple of the interval length), and the
+    interval contains the counters with stamp in (stamp - interval, stamp], the same grouping
+    used by StatsCounters.get_grouped.
+
+    Rollup progress is kept on a row with granularity WATERMARK: v_sum is the id of the last raw
+    counter already added to rollups, and v_count the last raw counter id seen on the previous run.
+    """
+
+    HOURLY = 3600
+    DAILY = 3600 * 24
+    INTERVALS = (HOURLY, DAILY)  # Finer to coarser
+    WATERMARK = 0
+
+    # Max number of raw counters added to rollups on a single transaction
+    CHUNK_SIZE = 50000
+
+    granularity = models.IntegerField(default=HOURLY)
+    owner_id = models.IntegerField(default=0)
+    owner_type = models.SmallIntegerField(default=0)
+    counter_type = models.SmallIntegerField(default=0)
+    stamp = models.IntegerField(default=0)
+    v_count = models.IntegerField(default=0)
+    v_sum = models.BigIntegerField(default=0)
+    v_max = models.IntegerField(default=0)
+
+    # "fake" declarations for type checking
+    objects: 'models.BaseManager[StatsCountersRollup]'
+
+    class Meta:
+        """
+        Meta class to declare db table
+        """
+
+        db_table = 'uds_stats_c_rollup'
+        app_label = 'uds'
+        index_together = (('granularity', 'counter_type', 'owner_type', 'stamp'),)
+
+    @staticmethod
+    def rolledId() -> int:
+        """
+        Returns the id of the last raw counter added to rollups (0 if none)
+        """
+        return (
+            StatsCountersRollup.objects.filter(granularity=StatsCountersRollup.WATERMARK)
+            .values_list('v_sum', flat=True)
+            .first()
+            or 0
+        )
+
+    @staticmethod
+    def _add(counters: 'models.QuerySet[StatsCounters]') -> None:
+        """
+        Adds the raw counters to the hourly and daily rollups of their intervals
+        """
+        for interval in StatsCountersRollup.INTERVALS:
+            # CEIL(stamp/interval)*interval, with integer arithmetic
+            slot = ExpressionWrapper(
+                F('stamp') + Mod(Value(interval) - Mod('stamp', Value(interval)), Value(interval)),
+                output_field=IntegerField(),
+            )
+            values = list(
+                counters.annotate(slot=slot)
+                .values('owner_type', 'owner_id', 'counter_type', 'slot')
+                .annotate(n=Count('id'), total=Sum('value'), maximum=Max('value'))
+                .order_by()
+            )
+            existing = {
+                (r.owner_type, r.owner_id, r.counter_type, r.stamp): r
+                for r in StatsCountersRollup.objects.filter(
+                    granularity=interval, stamp__in={v['slot'] for v in values}
+                )
+            }
+            updated, created = [], []
+            for v in values:
+                r = existing.get((v['owner_type'], v['owner_id'], v['counter_type'], v['slot']))
+                if r is None:
+                    created.append(
+                        StatsCountersRollup(
+                            granularity=interval,
+                            owner_type=v['owner_type'],
+                            owner_id=v['owner_id'],
+                            counter_type=v['counter_type'],
+                            stamp=v['slot'],
+                            v_count=v['n'],
+                            v_sum=v['total'] or 0,
+                            v_max=v['maximum'] or 0,
+                        )
+                    )
+                    continue
+                r.v_count += v['n']
+                r.v_sum += v['total'] or 0
+                r.v_max = max(r.v_max, v['maximum'] or 0)
+                updated.append(r)
+
+            StatsCountersRollup.objects.bulk_update(updated, ['v_count', 'v_sum', 'v_max'], batch_size=1000)
+            StatsCountersRollup.objects.bulk_create(created, batch_size=1000)
+
+    @staticmethod
+    def rollup(chunkSize: int = CHUNK_SIZE) -> None:
+        """
+        Incrementally adds to the rollups the raw counters stored since last run.
+
+        Progress is kept by raw counter id (that is, insertion order) instead of by stamp, so counters
+        stored late (buffered writes, delayed collectors...) are also added to the rollups of their intervals.
+        Only counters up to the last id seen on previous run are added, so rows of transactions not yet
+        committed at that moment are not skipped, and every chunkSize counters are added on its own transaction.
+        """
+        lastId = StatsCounters.objects.aggregate(last=Max('id'))['last'] or 0
+        while True:
+            with transaction.atomic():
+                progress, _ = StatsCountersRollup.objects.select_for_update().get_or_create(
+                    granularity=StatsCountersRollup.WATERMARK
+                )
+                start = progress.v_sum
+                end = min(progress.v_count, start + chunkSize)
+                if start >= end:
+                    # Done, counters until lastId will be rolled up on next run
+                    progress.v_count = max(progress.v_count, lastId)
+                    progress.save(update_fields=['v_count'])
+                    return
+
+                StatsCountersRollup._add(StatsCounters.objects.filter(id__gt=start, id__lte=end))
+                progress.v_sum = end
+                progress.save(update_fields=['v_sum'])
+            logger.debug('Rolled up counters with id from %s to %s', start + 1, end)
+
+    def __str__(self):
+        return u"Counter rollup ({}) of {}({}): {} - {} - {}/{}/{}".format(
+            self.granularity, self.owner_type, self.owner_id, self.stamp, self.counter_type, self.v_count, self.v_sum, self.v_max
+        )
@@ -33,7 +33,7 @@ import pickle
 import logging
 import typing
 
-from django.db import models
+from django.db import models, DatabaseError
 
 from uds.core.managers import cryptoManager
 
@@ -222,6 +222,8 @@ class TicketStore(UUIDModel):
         Returns the ticket for a tunneled connection
         The returned value is a tuple:
           (User, UserService, Host (nullable), Port, Extra Dict)
+        Raises InvalidTicket only if the ticket is malformed, unknown or no longer valid,
+        any other failure (database, service ip, ...) is raised as is
         """
         try:
             if len(ticket) != 48:
@@ -234,15 +236,17 @@ class TicketStore(UUIDModel):
             # if not found any, will raise an execption
             user = User.objects.get(uuid=data['u'])
             userService = UserService.objects.get(uuid=data['s'], user=user)
-            host = data['h']
-
-            if not host:
-                host = userService.getInstance().getIp()
-
-            return (user, userService, host, data['p'], data['e'])
+        except (TicketStore.InvalidTicket, DatabaseError):
+            raise
         except Exception as e:
             raise TicketStore.InvalidTicket(str(e))
 
+        host = data['h']
+        if not host:
+            host = userService.getInstance().getIp()
+
+        return (user, userService, host, data['p'], data['e'])
+
     @staticmethod
     def cleanup() -> None:
         now = getSqlDatetime()
@@ -37,7 +37,6 @@ from django.db import models
 
 from uds.core import transports
 
-from uds.core.util import net
 
 from .managed_object_model import ManagedObjectModel
 from .tag import TaggingMixin
@@ -103,7 +102,7 @@ class Transport(ManagedObjectModel, TaggingMixin):
         Checks if this transport is valid for the specified IP.
 
         Args:
-           ip: Numeric ip address to check validity for. (xxx.xxx.xxx.xxx).
+           ip: ip address to check validity for. (xxx.xxx.xxx.xxx or ipv6).
 
         Returns:
             True if the ip can access this Transport.
@@ -119,14 +118,16 @@ class Transport(ManagedObjectModel, TaggingMixin):
 
         Raises:
 
-        :note: Ip addresses has been only tested with IPv4 addresses
+        :note: Networks are got from the in memory networks index, so no database access is done
         """
-        if self.networks.count() == 0:
+        from .network import NetworksIndex  # pylint: disable=import-outside-toplevel
+
+        index = NetworksIndex.get()
+        networks = index.transports.get(self.id)
+        if not networks:
             return True
-        ip = net.ipToLong(ipStr)
-        if self.nets_positive:
-            return self.networks.filter(net_start__lte=ip, net_end__gte=ip).count() > 0
-        return self.networks.filter(net_start__lte=ip, net_end__gte=ip).count() == 0
+        found = not networks.isdisjoint(index.matcher.match(ipStr))
+        return found if self.nets_positive else not found
 
     def validForOs(self, os: str) -> bool:
         logger.debug('Checkin if os "%s" is in "%s"', os, self.allowed_oss)
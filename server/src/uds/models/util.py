@@ -31,9 +31,12 @@
 .. moduleauthor:: Adolfo Gómez, dkmaster at dkmon dot com
 """
 import logging
+import threading
+import time
+import typing
 from time import mktime
 
-from datetime import datetime
+from datetime import datetime, timedelta
 from django.db import models
 from django.db import connection
 
@@ -42,6 +45,12 @@ logger = logging.getLogger(__name__)
 NEVER = datetime(1972, 7, 1)
 NEVER_UNIX = int(mktime(NEVER.timetuple()))
 
+# Seconds between database clock resyncs
+CLOCK_SYNC_INTERVAL = 120
+# Max local clock jump (in seconds, measured against monotonic clock) allowed before forcing a resync
+CLOCK_MAX_DRIFT = 2
+
+
 class UnsavedForeignKey(models.ForeignKey):
     """
     From 1.8 of django, we need to point to "saved" objects.
@@ -52,21 +61,92 @@ class UnsavedForeignKey(models.ForeignKey):
     # Allows pointing to an unsaved object
     allow_unsaved_instance_assignment = True
 
-def getSqlDatetime() -> datetime:
+
+class DatabaseClock:
+    """
+    Keeps the offset between local clock and database server clock, so
+    we do not need to query the database every time we need "database time".
+
+    The offset is resynced periodically, if the local clock jumps (ntp adjust, suspend...)
+    or if a new database connection is created (reconnects, failovers, see uds.extend_sqlite).
+    """
+
+    _lock: typing.ClassVar[threading.Lock] = threading.Lock()
+    _offset: typing.ClassVar[timedelta] = timedelta(0)
+    _syncedWall: typing.ClassVar[float] = 0.0
+    _syncedMonotonic: typing.ClassVar[float] = -1.0
+
+    @staticmethod
+    def queryDatabase() -> datetime:
+        """
+        Executes the query that gets the database server time
+        """
+        cursor = connection.cursor()
+        sentence = 'SELECT NOW()' if connection.vendor == 'mysql' else 'SELECT CURRENT_TIMESTAMP'
+        cursor.execute(sentence)
+        return cursor.fetchone()[0]
+
+    @staticmethod
+    def needsSync() -> bool:
+        if DatabaseClock._syncedMonotonic < 0:
+            return True
+        elapsed = time.monotonic() - DatabaseClock._syncedMonotonic
+        if elapsed > CLOCK_SYNC_INTERVAL:
+            return True
+        # Local wall clock has jumped?
+        return abs((time.time() - DatabaseClock._syncedWall) - elapsed) > CLOCK_MAX_DRIFT
+
+    @staticmethod
+    def sync() -> datetime:
+        """
+        Samples database clock, updates the offset and returns the sampled database time
+        """
+        before = datetime.now()
+        date = DatabaseClock.queryDatabase()
+        after = datetime.now()
+        # Assume query has been executed at the middle of the round trip
+        local = before + (after - before) / 2
+        with DatabaseClock._lock:
+            DatabaseClock._offset = date - local
+            DatabaseClock._syncedWall = time.time()
+            DatabaseClock._syncedMonotonic = time.monotonic()
+        logger.debug('Database clock offset: %s', DatabaseClock._offset)
+        return date
+
+    @staticmethod
+    def reset() -> None:
+        """
+        Forces a resync on next access
+        """
+        with DatabaseClock._lock:
+            DatabaseClock._syncedMonotonic = -1.0
+
+    @staticmethod
+    def now(strict: bool = False) -> datetime:
+        if strict or DatabaseClock.needsSync():
+            try:
+                return DatabaseClock.sync()
+            except Exception:
+                DatabaseClock.reset()
+                raise
+        return datetime.now() + DatabaseClock._offset
+
+
+def getSqlDatetime(strict: bool = False) -> datetime:
     """
     Returns the current date/time of the database server.
 
     We use this time as method of keeping all operations betwen different servers in sync.
 
+    Database time is obtained as local time corrected with the offset to database clock (see DatabaseClock).
+    If strict is True, the database is always queried (and the offset updated).
+
     We support get database datetime for:
       * mysql
       * sqlite
     """
     if connection.vendor in ('mysql', 'microsoft'):
-        cursor = connection.cursor()
-        sentence = 'SELECT NOW()' if connection.vendor == 'mysql' else 'SELECT CURRENT_TIMESTAMP'
-        cursor.execute(sentence)
-        date = cursor.fetchone()[0]
+        date = DatabaseClock.now(strict)
     else:
         date = datetime.now()  # If not know how to get database datetime, returns local datetime (this is fine for sqlite, which is local)
 
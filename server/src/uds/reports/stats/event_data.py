@@ -0,0 +1,231 @@
+# -*- coding: utf-8 -*-
+
+#
+# Copyright (c) 2020 Virtual Cable S.L.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without modification,
+# are permitted provided that the following conditions are met:
+#
+#    * Redistributions of source code must retain the above copyright notice,
+#      this list of conditions and the following disclaimer.
+#    * Redistributions in binary form must reproduce the above copyright notice,
+#      this list of conditions and the following disclaimer in the documentation
+#      and/or other materials provided with the distribution.
+#    * Neither the name of Virtual Cable S.L. nor the names of its contributors
+#      may be used to endorse or promote products derived from this software
+#      without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+.. moduleauthor:: Adolfo Gómez, dkmaster at dkmon dot com
+"""
+import array
+import datetime
+import logging
+import typing
+
+import numpy as np
+
+from uds.core.util.stats import events
+
+logger = logging.getLogger(__name__)
+
+# Rows fetched from database on each round trip while streaming events
+CHUNK_SIZE = 4096
+# Local time offsets are always multiple of 15 minutes, so grouping stamps
+# on this blocks allows converting to local time only once per block
+LOCALTIME_BLOCK = 900
+
+
+def samplingIntervals(start: int, end: int, samplingPoints: int) -> typing.List[typing.Tuple[int, int]]:
+    """
+    Splits [start, end) in consecutive intervals, as used by charts
+    """
+    step = max(int((end - start) / (samplingPoints + 1)), 1)
+    intervals: typing.List[typing.Tuple[int, int]] = []
+    prevVal = None
+    for val in range(start, end, step):
+        if prevVal is not None:
+            intervals.append((prevVal, val))
+        prevVal = val
+    return intervals
+
+
+class EventsData:
+    """
+    Columnar, in memory, representation of a set of events.
+
+    Events are read from database in just one streamed query, and stored as numpy arrays.
+    Text fields are stored as integer codes (indexes on "strings"), so repeated values
+    (usernames, ips, ...) are only kept once in memory.
+    """
+
+    stamp: np.ndarray
+    owner: np.ndarray
+    event: np.ndarray
+    codes: typing.Dict[str, np.ndarray]
+    strings: typing.Dict[str, typing.List[str]]
+
+    def __init__(self, fields: typing.Iterable[str] = ()) -> None:
+        self.fields = tuple(fields)
+        self.stamp = np.zeros(0, dtype=np.int64)
+        self.owner = np.zeros(0, dtype=np.int64)
+        self.event = np.zeros(0, dtype=np.int64)
+        self.codes = {f: np.zeros(0, dtype=np.int64) for f in self.fields}
+        self.strings = {f: [] for f in self.fields}
+
+    def __len__(self) -> int:
+        return len(self.stamp)
+
+    @staticmethod
+    def load(
+        ownerType: typing.Union[int, typing.Iterable[int]],
+        eventType: typing.Union[int, typing.Iterable[int]],
+        since: int,
+        to: int,
+        ownerIds: typing.Optional[typing.Iterable[int]] = None,
+        fields: typing.Iterable[str] = (),
+    ) -> 'EventsData':
+        """
+        Loads events for all owners and the whole range in a single query.
+
+        Args:
+            ownerType: Owner type (or types) of events (events.OT_...)
+            eventType: Event type (or types) to load (events.ET_...)
+            since: Initial stamp (included)
+            to: Final stamp (excluded)
+            ownerIds: If not None, owners ids to restrict events to
+            fields: Text fields (fld1, ..., fld4) to load with events
+        """
+        data = EventsData(fields)
+        kwargs: typing.Dict[str, typing.Any] = {'since': since, 'to': to}
+        if ownerIds is not None:
+            kwargs['owner_id'] = [int(i) for i in ownerIds]
+            if not kwargs['owner_id']:
+                return data
+
+        stamps = array.array('q')
+        owners = array.array('q')
+        evs = array.array('q')
+        codes = {f: array.array('q') for f in data.fields}
+        indexes: typing.Dict[str, typing.Dict[str, int]] = {f: {} for f in data.fields}
+
+        qs = (
+            events.statsManager()
+            .getEvents(ownerType, eventType, **kwargs)
+            .values_list('stamp', 'owner_id', 'event_type', *data.fields)
+        )
+        for row in qs.iterator(chunk_size=CHUNK_SIZE):
+            stamps.append(row[0])
+            owners.append(row[1])
+            evs.append(row[2])
+            for pos, f in enumerate(data.fields, 3):
+                idx = indexes[f]
+                value = row[pos] or ''
+                code = idx.get(value)
+                if code is None:
+                    code = idx[value] = len(data.strings[f])
+                    data.strings[f].append(value)
+                codes[f].append(code)
+
+        data.stamp = np.frombuffer(stamps, dtype=np.int64)
+        data.owner = np.frombuffer(owners, dtype=np.int64)
+        data.event = np.frombuffer(evs, dtype=np.int64)
+        data.codes = {f: np.frombuffer(codes[f], dtype=np.int64) for f in data.fields}
+
+        logger.debug('Loaded %s events from %s to %s', len(data), since, to)
+
+        return data
+
+    def bins(self, intervals: typing.Sequence[typing.Tuple[int, int]]) -> np.ndarray:
+        """
+        Returns, for every event, the index of the (consecutive) interval it belongs to,
+        or -1 if it is outside all of them.
+        """
+        if not intervals:
+            return np.full(len(self), -1, dtype=np.int64)
+        edges = np.array([i[0] for i in intervals] + [intervals[-1][1]], dtype=np.int64)
+        idx = np.searchsorted(edges, self.stamp, side='right') - 1
+        idx[idx >= len(intervals)] = -1
+        return idx
+
+    def ownerIndex(self, ownerIds: typing.Sequence[int]) -> np.ndarray:
+        """
+        Returns, for every event, the position of its owner on "ownerIds", or -1 if not present.
+        """
+        result = np.full(len(self), -1, dtype=np.int64)
+        ids = np.array(ownerIds, dtype=np.int64)
+        if not len(ids):
+            return result
+        order = np.argsort(ids)
+        sortedIds = ids[order]
+        pos = np.clip(np.searchsorted(sortedIds, self.owner), 0, len(ids) - 1)
+        found = sortedIds[pos] == self.owner
+        result[found] = order[pos[found]]
+        return result
+
+    def countBy(
+        self, ownerIds: typing.Sequence[int], intervals: typing.Sequence[typing.Tuple[int, int]], distinct: typing.Optional[str] = None
+    ) -> np.ndarray:
+        """
+        Returns a matrix (owners x intervals) with number of events (or number of distinct "distinct" field values)
+        """
+        width = len(intervals)
+        owner = self.ownerIndex(ownerIds)
+        interval = self.bins(intervals)
+        valid = (owner >= 0) & (interval >= 0)
+        cell = owner[valid] * width + interval[valid]
+        if distinct is not None:
+            base = max(len(self.strings[distinct]), 1)
+            # Unique (cell, value) pairs, then count them per cell
+            cell = np.unique(cell * base + self.codes[distinct][valid]) // base
+        return np.bincount(cell, minlength=len(ownerIds) * width).reshape(len(ownerIds), width)
+
+    def sessions(self, key: str, login: int = events.ET_LOGIN, logout: int = events.ET_LOGOUT) -> typing.Tuple[np.ndarray, np.ndarray]:
+        """
+        Pairs login & logout events of same owner and same "key" field.
+
+        A logout is paired with the login just before it (for same owner and key), and only
+        if there is no other logout between them. Unpaired events are ignored.
+
+        Returns:
+            A tuple with the positions (on this data arrays) of logins and of its matching logouts
+        """
+        if len(self) < 2:
+            empty = np.zeros(0, dtype=np.int64)
+            return empty, empty
+        keyCodes = self.codes[key]
+        # Sort by owner, key and stamp (lexsort uses last key as primary one)
+        order = np.lexsort((self.stamp, keyCodes, self.owner))
+        owner, keyCodes, event = self.owner[order], keyCodes[order], self.event[order]
+        matches = (
+            (event[1:] == logout)
+            & (event[:-1] == login)
+            & (owner[1:] == owner[:-1])
+            & (keyCodes[1:] == keyCodes[:-1])
+        )
+        pos = np.nonzero(matches)[0]
+        return order[pos], order[pos + 1]
+
+    def weekHourCounts(self) -> np.ndarray:
+        """
+        Returns a matrix (7 x 24) with number of events by local weekday and hour
+        """
+        result = np.zeros((7, 24), dtype=np.int64)
+        blocks, counts = np.unique(self.stamp // LOCALTIME_BLOCK, return_counts=True)
+        # Converted to local time once per block
+        for block, count in zip(blocks.tolist(), counts.tolist()):
+            s = datetime.datetime.fromtimestamp(block * LOCALTIME_BLOCK)
+            result[s.weekday(), s.hour] += count
+        return result
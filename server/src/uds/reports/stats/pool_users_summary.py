@@ -35,6 +35,7 @@ import datetime
 import logging
 import typing
 
+import numpy as np
 from django.utils.translation import ugettext, ugettext_lazy as _
 
 from uds.core.ui import gui
@@ -42,6 +43,7 @@ from uds.core.util.stats import events
 from uds.models import ServicePool
 
 from .base import StatsReport
+from . import event_data
 
 logger = logging.getLogger(__name__)
 
@@ -88,30 +90,19 @@ class UsageSummaryByUsersPool(StatsReport):
         end = self.endDate.stamp()
         logger.debug(self.pool.value)
 
-        items = events.statsManager().getEvents(events.OT_DEPLOYED, (events.ET_LOGIN, events.ET_LOGOUT), owner_id=pool.id, since=start, to=end).order_by('stamp')
-
-        logins: typing.Dict[str, int] = {}
-        users: typing.Dict[str, typing.Dict] = {}
-        for i in items:
-            # if '\\' in i.fld1:
-            #    continue
-            username = i.fld4
-            if i.event_type == events.ET_LOGIN:
-                logins[username] = i.stamp
-            else:
-                if username in logins:
-                    stamp = logins[username]
-                    del logins[username]
-                    total = i.stamp - stamp
-                    if username not in users:
-                        users[username] = {'sessions': 0, 'time': 0}
-                    users[username]['sessions'] += 1
-                    users[username]['time'] += total
-                    # data.append({
-                    #    'name': i.fld4,
-                    #    'date': datetime.datetime.fromtimestamp(stamp),
-                    #    'time': total
-                    # })
+        items = event_data.EventsData.load(
+            events.OT_DEPLOYED, (events.ET_LOGIN, events.ET_LOGOUT), since=start, to=end, ownerIds=(pool.id,), fields=('fld4',)
+        )
+        logins, logouts = items.sessions('fld4')
+
+        # Sessions and total time, per user
+        userCodes = items.codes['fld4'][logouts]
+        sessions = np.bincount(userCodes, minlength=len(items.strings['fld4']))
+        times = np.bincount(userCodes, weights=items.stamp[logouts] - items.stamp[logins], minlength=len(items.strings['fld4']))
+        users: typing.Dict[str, typing.Dict] = {
+            items.strings['fld4'][code]: {'sessions': int(sessions[code]), 'time': float(times[code])}
+            for code in np.nonzero(sessions)[0].tolist()
+        }
 
         # Extract different number of users
         data = [{
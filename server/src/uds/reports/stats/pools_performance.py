@@ -37,7 +37,6 @@ import logging
 import typing
 
 from django.utils.translation import ugettext, ugettext_lazy as _
-from django.db.models import Count
 import django.template.defaultfilters as filters
 
 from uds.core.ui import gui
@@ -47,6 +46,7 @@ from uds.core.reports import graphs
 from uds.models import ServicePool
 
 from .base import StatsReport
+from . import event_data
 
 logger = logging.getLogger(__name__)
 
@@ -121,7 +121,7 @@ class PoolPerformanceReport(StatsReport):
 
         samplingPoints = self.samplingPoints.num()
 
-        pools = self.getPools()
+        pools = list(self.getPools())
 
         if not pools:
             raise Exception(_('Select at least a service pool for the report'))
@@ -134,61 +134,50 @@ class PoolPerformanceReport(StatsReport):
         else:
             xLabelFormat = 'SHORT_DATETIME_FORMAT'
 
-        # Generate samplings interval
-        samplingIntervals: typing.List[typing.Tuple[int, int]] = []
-        prevVal = None
-        for val in range(start, end, int((end - start) / (samplingPoints + 1))):
-            if prevVal is None:
-                prevVal = val
-                continue
-            samplingIntervals.append((prevVal, val))
-            prevVal = val
+        intervals = event_data.samplingIntervals(start, end, samplingPoints)
+        ownerIds = [int(p[0]) for p in pools]
+        fld = events.statsManager().getEventFldFor('username')
+
+        # All pools and whole range are fetched at once
+        data = event_data.EventsData.load(
+            events.OT_DEPLOYED,
+            events.ET_ACCESS,
+            since=start,
+            to=end,
+            ownerIds=ownerIds,
+            fields=(fld,),
+        )
+        accesses = data.countBy(ownerIds, intervals)
+        users = data.countBy(ownerIds, intervals, distinct=fld)
+        keys = [(interval[0] + interval[1]) / 2 for interval in intervals]
+        dates = [
+            tools.timestampAsStr(interval[0], xLabelFormat)
+            + ' - '
+            + tools.timestampAsStr(interval[1], xLabelFormat)
+            for interval in intervals
+        ]
 
         # Store dataUsers for all pools
         poolsData = []
-
-        fld = events.statsManager().getEventFldFor('username')
-
         reportData = []
-        for p in pools:
-            dataUsers = []
-            dataAccesses = []
-            for interval in samplingIntervals:
-                key = (interval[0] + interval[1]) / 2
-                q = (
-                    events.statsManager()
-                    .getEvents(
-                        events.OT_DEPLOYED,
-                        events.ET_ACCESS,
-                        since=interval[0],
-                        to=interval[1],
-                        owner_id=p[0],
-                    )
-                    .values(fld)
-                    .annotate(cnt=Count(fld))
-                )
-                accesses = 0
-                for v in q:
-                    accesses += v['cnt']
-
-                dataUsers.append((key, len(q)))  # @UndefinedVariable
-                dataAccesses.append((key, accesses))
+        for row, p in enumerate(pools):
+            poolUsers = users[row].tolist()
+            poolAccesses = accesses[row].tolist()
+            for col, date in enumerate(dates):
                 reportData.append(
                     {
                         'name': p[1],
-                        'date': tools.timestampAsStr(interval[0], xLabelFormat)
-                        + ' - '
-                        + tools.timestampAsStr(interval[1], xLabelFormat),
-                        'users': len(q),
-                        'accesses': accesses,
+                        'date': date,
+                        'users': poolUsers[col],
+                        'accesses': poolAccesses[col],
                     }
                 )
             poolsData.append(
                 {
                     'pool': p[0],
                     'name': p[1],
-                    'dataUsers': dataUsers,
-                    'dataAccesses': dataAccesses,
+                    'dataUsers': list(zip(keys, poolUsers)),
+                    'dataAccesses': list(zip(keys, poolAccesses)),
                 }
             )
 
@@ -35,6 +35,7 @@ import datetime
 import logging
 import typing
 
+import numpy as np
 from django.utils.translation import ugettext, ugettext_lazy as _
 
 from uds.core.ui import gui
@@ -42,6 +43,7 @@ from uds.core.util.stats import events
 from uds.models import ServicePool
 
 from .base import StatsReport
+from . import event_data
 
 
 logger = logging.getLogger(__name__)
@@ -94,43 +96,46 @@ class UsageByPool(StatsReport):
             pools = ServicePool.objects.all()
         else:
             pools = ServicePool.objects.filter(uuid__in=self.pool.value)
+        pools = list(pools)
+        poolsById = {pool.id: pool for pool in pools}
+
+        items = event_data.EventsData.load(
+            events.OT_DEPLOYED,
+            (events.ET_LOGIN, events.ET_LOGOUT),
+            since=start,
+            to=end,
+            ownerIds=poolsById.keys(),
+            fields=('fld2', 'fld4'),
+        )
+        logins, logouts = items.sessions('fld4')
+        # Sessions grouped by pool, and sorted by logout inside each pool
+        order = np.lexsort(
+            (items.stamp[logouts], items.ownerIndex(list(poolsById.keys()))[logouts])
+        )
+        logins, logouts = logins[order], logouts[order]
+
+        names = items.strings['fld4']
+        origins = [v.split(':')[0] for v in items.strings['fld2']]
         data = []
-        for pool in pools:
-            items = (
-                events.statsManager()
-                .getEvents(
-                    events.OT_DEPLOYED,
-                    (events.ET_LOGIN, events.ET_LOGOUT),
-                    owner_id=pool.id,
-                    since=start,
-                    to=end,
-                )
-                .order_by('stamp')
+        for loginStamp, logoutStamp, owner, name, origin in zip(
+            items.stamp[logins].tolist(),
+            items.stamp[logouts].tolist(),
+            items.owner[logouts].tolist(),
+            items.codes['fld4'][logouts].tolist(),
+            items.codes['fld2'][logouts].tolist(),
+        ):
+            pool = poolsById[owner]
+            data.append(
+                {
+                    'name': names[name],
+                    'origin': origins[origin],
+                    'date': datetime.datetime.fromtimestamp(loginStamp),
+                    'time': logoutStamp - loginStamp,
+                    'pool': pool.uuid,
+                    'pool_name': pool.name,
+                }
             )
 
-            logins = {}
-            for i in items:
-                # if '\\' in i.fld1:
-                #    continue
-
-                if i.event_type == events.ET_LOGIN:
-                    logins[i.fld4] = i.stamp
-                else:
-                    if i.fld4 in logins:
-                        stamp = logins[i.fld4]
-                        del logins[i.fld4]
-                        total = i.stamp - stamp
-                        data.append(
-                            {
-                                'name': i.fld4,
-                                'origin': i.fld2.split(':')[0],
-                                'date': datetime.datetime.fromtimestamp(stamp),
-                                'time': total,
-                                'pool': pool.uuid,
-                                'pool_name': pool.name,
-                            }
-                        )
-
         return data, ','.join([p.name for p in pools])
 
     def generate(self):
@@ -35,6 +35,7 @@ import datetime
 import logging
 import typing
 
+import numpy as np
 from django.utils.translation import ugettext, ugettext_lazy as _
 import django.template.defaultfilters as filters
 
@@ -44,6 +45,7 @@ from uds.core.util import tools
 from uds.core.reports import graphs
 
 from .base import StatsReport
+from . import event_data
 
 
 logger = logging.getLogger(__name__)
@@ -112,30 +114,20 @@ class StatsReportLogin(StatsReport):
         else:
             xLabelFormat = 'SHORT_DATETIME_FORMAT'
 
-        samplingIntervals: typing.List[typing.Tuple[int, int]] = []
-        prevVal = None
-        for val in range(start, end, int((end - start) / (samplingPoints + 1))):
-            if prevVal is None:
-                prevVal = val
-                continue
-            samplingIntervals.append((prevVal, val))
-            prevVal = val
+        samplingIntervals = event_data.samplingIntervals(start, end, samplingPoints)
+        items = event_data.EventsData.load(
+            events.OT_AUTHENTICATOR, events.ET_LOGIN, since=start, to=end
+        )
+        bins = items.bins(samplingIntervals)
+        counts = np.bincount(
+            bins[bins >= 0], minlength=len(samplingIntervals)
+        ).tolist()
 
         data = []
         reportData = []
-        for interval in samplingIntervals:
+        for interval, val in zip(samplingIntervals, counts):
             key = (interval[0] + interval[1]) / 2
-            val = (
-                events.statsManager()
-                .getEvents(
-                    events.OT_AUTHENTICATOR,
-                    events.ET_LOGIN,
-                    since=interval[0],
-                    to=interval[1],
-                )
-                .count()
-            )
-            data.append((key, val))  # @UndefinedVariable
+            data.append((key, val))
             reportData.append(
                 {
                     'date': tools.timestampAsStr(interval[0], xLabelFormat)
@@ -151,17 +143,12 @@ class StatsReportLogin(StatsReport):
         start = self.startDate.stamp()
         end = self.endDate.stamp()
 
-        dataWeek = [0] * 7
-        dataHour = [0] * 24
-        dataWeekHour = [[0] * 24 for _ in range(7)]
-        for val in events.statsManager().getEvents(
+        weekHour = event_data.EventsData.load(
             events.OT_AUTHENTICATOR, events.ET_LOGIN, since=start, to=end
-        ):
-            s = datetime.datetime.fromtimestamp(val.stamp)
-            dataWeek[s.weekday()] += 1
-            dataHour[s.hour] += 1
-            dataWeekHour[s.weekday()][s.hour] += 1
-            logger.debug('Data: %s %s', s.weekday(), s.hour)
+        ).weekHourCounts()
+        dataWeek = weekHour.sum(axis=1).tolist()
+        dataHour = weekHour.sum(axis=0).tolist()
+        dataWeekHour = weekHour.tolist()
 
         return dataWeek, dataHour, dataWeekHour
 
@@ -88,7 +88,7 @@ def checkLogin(  # pylint: disable=too-many-branches, too-many-statements
         if GlobalConfig.LOWERCASE_USERNAME.getBool(True) is True:
             userName = userName.lower()
 
-        cache = Cache('auth')
+        cache = Cache('auth', local=False)
         cacheKey = str(authenticator.id) + userName
         tries = cache.get(cacheKey) or 0
         triesByIp = (cache.get(request.ip) or 0) if GlobalConfig.LOGIN_BLOCK_IP.getBool() else 0
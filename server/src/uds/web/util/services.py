@@ -39,12 +39,17 @@ from uds.models import (
     ServicePool,
     Transport,
     Network,
+    Group,
     ServicePoolGroup,
     MetaPool,
+    UserService,
+    ServicesCatalogue,
     getSqlDatetime,
 )
 from uds.core.util.config import GlobalConfig
+from uds.core.util.cache import Cache
 from uds.core.util import html
+from uds.core.util import states
 
 # Not imported at runtime, just for type checking
 if typing.TYPE_CHECKING:
@@ -55,6 +60,155 @@ if typing.TYPE_CHECKING:
 logger = logging.getLogger(__name__)
 
 
+def getCatalogue(
+    groups: typing.List[Group], osName: str, ip: str
+) -> typing.List[typing.Dict[str, typing.Any]]:
+    """Obtains the services visible for a set of groups, from an os and ip, without any user related data.
+
+    Arguments:
+        groups {typing.List[Group]} -- groups of the user
+        osName {str} -- os of the client
+        ip {str} -- ip of the client. Transports visibility depends only on the networks it belongs to
+
+    Returns:
+        typing.List[typing.Dict[str, typing.Any]] -- Sorted entries, with keys:
+            'service': service data (without user related fields)
+            'transports': list of (id, name, priority, ownLink)
+            'pools': ids of the pools that user services can belong to
+            'publication': id of the active publication of the pool, if it has one
+    """
+    now = getSqlDatetime()
+    key = '{}:{}:{}'.format(
+        ','.join(str(i) for i in sorted({g.id for g in groups})),
+        osName,
+        ','.join(str(i) for i in sorted(n.id for n in Network.networksFor(ip))),
+    )
+    cache = Cache(ServicesCatalogue.CACHE_OWNER, local=False)
+    catalogue: typing.Optional[typing.List[typing.Dict[str, typing.Any]]] = cache.get(key)
+    if catalogue is not None:
+        return catalogue
+
+    def validTransport(t: Transport) -> bool:
+        try:
+            typeTrans = t.getType()
+        except Exception:
+            return False
+        return bool(
+            typeTrans
+            and t.validForIp(ip)
+            and typeTrans.supportsOs(osName)
+            and t.validForOs(osName)
+        )
+
+    catalogue = []
+
+    # Meta pools are visible if any of its pools has, at least, one usable transport
+    for meta in MetaPool.getForGroups(groups):
+        members = list(meta.members.all())
+        if not any(
+            validTransport(t) for member in members for t in member.pool.transports.all()
+        ):
+            continue
+
+        catalogue.append(
+            {
+                'service': {
+                    'id': 'M' + meta.uuid,
+                    'name': meta.name,
+                    'visual_name': meta.visual_name,
+                    'description': meta.comments,
+                    'group': meta.servicesPoolGroup.as_dict
+                    if meta.servicesPoolGroup
+                    else None,
+                    'imageId': meta.image and meta.image.uuid or 'x',
+                    'show_transports': False,
+                    'allow_users_remove': False,
+                    'allow_users_reset': False,
+                    'maintenance': meta.isInMaintenance(),
+                    'not_accesible': not meta.isAccessAllowed(now),
+                    'custom_calendar_text': meta.calendar_message,
+                },
+                'transports': [('meta', 'meta', 0, None)],
+                'pools': [member.pool_id for member in members],
+                'publication': None,
+            }
+        )
+
+    for sPool in ServicePool.getDeployedServicesForGroups(groups):
+        # Skip pools that are part of meta pools
+        if sPool.owned_by_meta:
+            continue
+
+        trans = [
+            (t.uuid, t.name, t.priority, t.getType().ownLink)
+            for t in sorted(
+                sPool.transports.all(), key=lambda x: x.priority
+            )  # In memory sort, allows reuse prefetched and not too big array
+            if validTransport(t)
+        ]
+        # If empty transports, do not include it on list
+        if not trans:
+            continue
+
+        use_percent = str(sPool.usage(sPool.usage_count)) + '%'
+        use_count = str(sPool.usage_count)
+        left_count = str(sPool.max_srvs - sPool.usage_count)
+        # Calculate max deployed
+        maxDeployed = str(sPool.max_srvs)
+
+        def datator(x) -> str:
+            return (
+                x.replace('{use}', use_percent)
+                .replace('{total}', str(sPool.max_srvs))
+                .replace('{usec}', use_count)
+                .replace('{left}', left_count)
+            )
+
+        # Active publication (from prefetched ones), used to know if user services are to be replaced
+        publication = None
+        if typing.cast(typing.Any, sPool).pubs_active > 0:
+            publication = next(
+                (
+                    p.id
+                    for p in sPool.publications.all()
+                    if p.state == states.publication.USABLE
+                ),
+                None,
+            )
+
+        catalogue.append(
+            {
+                'service': {
+                    'id': 'F' + sPool.uuid,
+                    'name': datator(sPool.name),
+                    'visual_name': datator(
+                        sPool.visual_name.replace('{use}', use_percent).replace(
+                            '{total}', maxDeployed
+                        )
+                    ),
+                    'description': sPool.comments,
+                    'group': sPool.servicesPoolGroup.as_dict
+                    if sPool.servicesPoolGroup
+                    else None,
+                    'imageId': sPool.image.uuid if sPool.image else 'x',
+                    'show_transports': sPool.show_transports,
+                    'allow_users_remove': sPool.allow_users_remove,
+                    'allow_users_reset': sPool.allow_users_reset,
+                    'maintenance': sPool.isInMaintenance(),
+                    'not_accesible': not sPool.isAccessAllowed(now),
+                    'custom_calendar_text': sPool.calendar_message,
+                },
+                'transports': trans,
+                'pools': [sPool.id],
+                'publication': publication,
+            }
+        )
+
+    catalogue.sort(key=lambda e: e['service']['name'].upper())
+    cache.put(key, catalogue, 60 - now.second)
+    return catalogue
+
+
 def getServicesData(
     request: 'ExtendedHttpRequestWithUser',
 ) -> typing.Dict[
@@ -76,13 +230,6 @@ def getServicesData(
     """
     # We look for services for this authenticator groups. User is logged in in just 1 authenticator, so his groups must coincide with those assigned to ds
     groups = list(request.user.getGroups())
-    availServicePools = list(
-        ServicePool.getDeployedServicesForGroups(groups, request.user)
-    )  # Pass in user to get "number_assigned" to optimize
-    availMetaPools = list(
-        MetaPool.getForGroups(groups, request.user)
-    )  # Pass in user to get "number_assigned" to optimize
-    now = getSqlDatetime()
 
     # Information for administrators
     nets = ''
@@ -95,142 +242,66 @@ def getServicesData(
         nets = ','.join([n.name for n in Network.networksFor(request.ip)])
         tt = []
         t: Transport
-        for t in Transport.objects.all().prefetch_related('networks'):
+        for t in Transport.objects.all():
             if t.validForIp(request.ip):
                 tt.append(t.name)
         validTrans = ','.join(tt)
 
-    logger.debug('Checking meta pools: %s', availMetaPools)
-    services = []
-    # Preload all assigned user services for this user
-
-    # Add meta pools data first
-    for meta in availMetaPools:
-        # Check that we have access to at least one transport on some of its children
-        hasUsablePools = False
-        in_use = (
-            typing.cast(typing.Any, meta).number_in_use > 0
-        )  # Override, because we used hear annotations
-        for member in meta.members.all():
-            # if pool.isInMaintenance():
-            #    continue
-            for t in member.pool.transports.all():
-                typeTrans = t.getType()
-                if (
-                    t.getType()
-                    and t.validForIp(request.ip)
-                    and typeTrans.supportsOs(osName)
-                    and t.validForOs(osName)
-                ):
-                    hasUsablePools = True
-                    break
-
-            # if not in_use and meta.number_in_use:  # Only look for assignation on possible used
-            #     assignedUserService = userServiceManager().getExistingAssignationForUser(pool, request.user)
-            #     if assignedUserService:
-            #         in_use = assignedUserService.in_use
-
-            # Stop when 1 usable pool is found
-            if hasUsablePools:
-                break
-
-        # If no usable pools, this is not visible
-        if hasUsablePools:
-            group = (
-                meta.servicesPoolGroup.as_dict
-                if meta.servicesPoolGroup
-                else ServicePoolGroup.default().as_dict
+    catalogue = getCatalogue(groups, osName, request.ip)
+
+    # User services of this user on catalogue pools, (publication, in use) by pool, with just one query
+    assigned: typing.Dict[int, typing.List[typing.Tuple[typing.Optional[int], bool]]] = {}
+    poolIds = {poolId for entry in catalogue for poolId in entry['pools']}
+    if poolIds:
+        for poolId, pubId, inUse, state in UserService.objects.filter(
+            user=request.user,
+            deployed_service_id__in=poolIds,
+            cache_level=0,
+            state__in=states.userService.VALID_STATES,
+        ).values_list('deployed_service_id', 'publication_id', 'in_use', 'state'):
+            assigned.setdefault(poolId, []).append(
+                (pubId, inUse and state == states.userService.USABLE)
             )
 
-            services.append(
-                {
-                    'id': 'M' + meta.uuid,
-                    'name': meta.name,
-                    'visual_name': meta.visual_name,
-                    'description': meta.comments,
-                    'group': group,
-                    'transports': [
-                        {
-                            'id': 'meta',
-                            'name': 'meta',
-                            'link': html.udsMetaLink(request, 'M' + meta.uuid),
-                            'priority': 0,
-                        }
-                    ],
-                    'imageId': meta.image and meta.image.uuid or 'x',
-                    'show_transports': False,
-                    'allow_users_remove': False,
-                    'allow_users_reset': False,
-                    'maintenance': meta.isInMaintenance(),
-                    'not_accesible': not meta.isAccessAllowed(now),
-                    'in_use': in_use,
-                    'to_be_replaced': None,
-                    'to_be_replaced_text': '',
-                    'custom_calendar_text': meta.calendar_message,
-                }
-            )
+    notifyRemoval = GlobalConfig.NOTIFY_REMOVAL_BY_PUB.getBool(False)
+    defaultGroup: typing.Optional[typing.MutableMapping[str, typing.Any]] = None
 
-    # Now generic user service
-    for sPool in availServicePools:
-        # Skip pools that are part of meta pools
-        if sPool.owned_by_meta:
-            continue
-
-        use_percent = str(sPool.usage(sPool.usage_count)) + '%'
-        use_count = str(sPool.usage_count)
-        left_count = str(sPool.max_srvs - sPool.usage_count)
+    services = []
+    for entry in catalogue:
+        service = entry['service'].copy()
+        if service['group'] is None:
+            if defaultGroup is None:
+                defaultGroup = ServicePoolGroup.default().as_dict
+            service['group'] = defaultGroup
 
         trans = []
-        for t in sorted(
-            sPool.transports.all(), key=lambda x: x.priority
-        ):  # In memory sort, allows reuse prefetched and not too big array
+        for transId, name, priority, ownLink in entry['transports']:
+            if ownLink is None:
+                link = html.udsMetaLink(request, service['id'])
+            elif ownLink:
+                link = reverse('TransportOwnLink', args=(service['id'], transId))
+            else:
+                link = html.udsAccessLink(request, service['id'], transId)
+            trans.append({'id': transId, 'name': name, 'link': link, 'priority': priority})
+        service['transports'] = trans
+
+        userServices = [us for poolId in entry['pools'] for us in assigned.get(poolId, ())]
+        service['in_use'] = any(inUse for _, inUse in userServices)
+
+        # Only add toBeReplaced info in case we allow it, and only if user has any service
+        # not belonging to the active publication (this will generate some "overload")
+        toBeReplaced = None
+        if (
+            notifyRemoval
+            and entry['publication']
+            and any(pubId != entry['publication'] for pubId, _ in userServices)
+        ):
             try:
-                typeTrans = t.getType()
-            except Exception:
-                continue
-            if (
-                t.validForIp(request.ip)
-                and typeTrans.supportsOs(osName)
-                and t.validForOs(osName)
-            ):
-                if typeTrans.ownLink:
-                    link = reverse('TransportOwnLink', args=('F' + sPool.uuid, t.uuid))
-                else:
-                    link = html.udsAccessLink(request, 'F' + sPool.uuid, t.uuid)
-                trans.append(
-                    {'id': t.uuid, 'name': t.name, 'link': link, 'priority': t.priority}
-                )
-
-        # If empty transports, do not include it on list
-        if not trans:
-            continue
-
-        if sPool.image:
-            imageId = sPool.image.uuid
-        else:
-            imageId = 'x'
-
-        # Locate if user service has any already assigned user service for this. Use "pre cached" number of assignations in this pool to optimize
-        in_use = typing.cast(typing.Any, sPool).number_in_use > 0
-        # if svr.number_in_use:  # Anotated value got from getDeployedServicesForGroups(...). If 0, no assignation for this user
-        #     ads = userServiceManager().getExistingAssignationForUser(svr, request.user)
-        #     if ads:
-        #         in_use = ads.in_use
-
-        group = (
-            sPool.servicesPoolGroup.as_dict
-            if sPool.servicesPoolGroup
-            else ServicePoolGroup.default().as_dict
-        )
-
-        # Only add toBeReplaced info in case we allow it. This will generate some "overload" on the services
-        toBeReplaced = (
-            sPool.toBeReplaced(request.user)
-            if typing.cast(typing.Any, sPool).pubs_active > 0
-            and GlobalConfig.NOTIFY_REMOVAL_BY_PUB.getBool(False)
-            else None
-        )
-        # tbr = False
+                toBeReplaced = ServicePool.objects.get(
+                    id=entry['pools'][0]
+                ).toBeReplaced(request.user)
+            except ServicePool.DoesNotExist:
+                pass
         if toBeReplaced:
             toBeReplaced = formats.date_format(toBeReplaced, 'SHORT_DATETIME_FORMAT')
             toBeReplacedTxt = ugettext(
@@ -238,52 +309,13 @@ def getServicesData(
             ).format(toBeReplaced)
         else:
             toBeReplacedTxt = ''
+        service['to_be_replaced'] = toBeReplaced
+        service['to_be_replaced_text'] = toBeReplacedTxt
 
-        # Calculate max deployed
-        maxDeployed = str(sPool.max_srvs)
-        # if sPool.service.getType().usesCache is False:
-        #    maxDeployed = sPool.service.getInstance().maxDeployed
-
-        def datator(x) -> str:
-            return (
-                x.replace('{use}', use_percent)
-                .replace('{total}', str(sPool.max_srvs))
-                .replace('{usec}', use_count)
-                .replace('{left}', left_count)
-            )
-
-        services.append(
-            {
-                'id': 'F' + sPool.uuid,
-                'name': datator(sPool.name),
-                'visual_name': datator(
-                    sPool.visual_name.replace('{use}', use_percent).replace(
-                        '{total}', maxDeployed
-                    )
-                ),
-                'description': sPool.comments,
-                'group': group,
-                'transports': trans,
-                'imageId': imageId,
-                'show_transports': sPool.show_transports,
-                'allow_users_remove': sPool.allow_users_remove,
-                'allow_users_reset': sPool.allow_users_reset,
-                'maintenance': sPool.isInMaintenance(),
-                'not_accesible': not sPool.isAccessAllowed(now),
-                'in_use': in_use,
-                'to_be_replaced': toBeReplaced,
-                'to_be_replaced_text': toBeReplacedTxt,
-                'custom_calendar_text': sPool.calendar_message,
-            }
-        )
+        services.append(service)
 
     # logger.debug('Services: %s', services)
 
-    # Sort services and remove services with no transports...
-    services = [
-        s for s in sorted(services, key=lambda s: s['name'].upper()) if s['transports']
-    ]
-
     autorun = False
     if (
         len(services) == 1
@@ -0,0 +1,522 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2021 Virtual Cable S.L.U.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without modification,
+# are permitted provided that the following conditions are met:
+#
+#    * Redistributions of source code must retain the above copyright notice,
+#      this list of conditions and the following disclaimer.
+#    * Redistributions in binary form must reproduce the above copyright notice,
+#      this list of conditions and the following disclaimer in the documentation
+#      and/or other materials provided with the distribution.
+#    * Neither the name of Virtual Cable S.L. nor the names of its contributors
+#      may be used to endorse or promote products derived from this software
+#      without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+'''
+Tunnel load benchmark.
+
+Starts a real tunnel server (udstunnel.py, with a generated configuration), a mock
+UDS broker, and echo/sink backends, and drives it with concurrent TLS clients
+(HANDSHAKE_V1 + OPEN + ticket). Reports, as JSON:
+  * Tunnel setup latency percentiles (connect + TLS + OPEN until OK)
+  * Memory (RSS of tunnel server processes) per idle tunnel
+  * Sustained throughput (total and per worker, from tunnel server metrics endpoint) and
+    tunnel server CPU per Gbit
+
+Backends and clients run on their own processes, so only tunnel server processes
+are accounted for cpu and memory. Needs openssl command (for a self signed certificate)
+and Linux /proc.
+
+Run from tunnel server src folder:
+    python -m benchmark.load [--workers N] [--tunnels N] [--streams N] [--seconds S]
+
+@author: Adolfo Gómez, dkmaster at dkmon dot com
+'''
+import argparse
+import http.server
+import json
+import multiprocessing
+import os
+import socket
+import ssl
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import typing
+import urllib.request
+
+import curio
+import curio.network
+
+from uds_tunnel import consts
+
+# Tickets are [a-zA-Z0-9]{consts.TICKET_LENGTH}. First char tells the mock broker which backend to use
+ECHO_TICKET = 'E'
+SINK_TICKET = 'S'
+
+CLIENT_BUFFER = 64 * 1024
+
+
+def ticket(backend: str, n: int) -> bytes:
+    return f'{backend}{n:0{consts.TICKET_LENGTH - 1}d}'.encode()
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def percentiles(values: typing.List[float]) -> typing.Dict[str, float]:
+    if not values:
+        return {}
+    values = sorted(values)
+
+    def at(p: float) -> float:
+        return values[min(len(values) - 1, int(p * len(values)))] * 1000  # ms
+
+    return {
+        'p50_ms': at(0.50),
+        'p90_ms': at(0.90),
+        'p99_ms': at(0.99),
+        'max_ms': values[-1] * 1000,
+    }
+
+
+# Mock broker, on a thread of benchmark process
+class Broker(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+    backends: typing.Dict[str, int]
+    opened: int
+    stopped: int
+
+    def __init__(self, backends: typing.Dict[str, int]) -> None:
+        super().__init__(('127.0.0.1', 0), BrokerHandler)
+        self.backends = backends
+        self.opened = self.stopped = 0
+        self.lock = threading.Lock()
+
+
+class BrokerHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # Keep alive, as tunnel server does
+    server: Broker
+
+    def do_GET(self) -> None:
+        # /<ticket>/<ip> or /<ticket>/stop?sent=x&recv=y
+        parts = self.path.strip('/').split('/')
+        if len(parts) != 2 or parts[0][:1] not in self.server.backends:
+            self.reply(404, {'error': 'invalid ticket'})
+            return
+        with self.server.lock:
+            if parts[1].startswith('stop'):
+                self.server.stopped += 1
+                result: typing.Dict[str, typing.Any] = {}
+            else:
+                self.server.opened += 1
+                result = {
+                    'host': '127.0.0.1',
+                    'port': self.server.backends[parts[0][0]],
+                    'notify': parts[0],
+                }
+        self.reply(200, result)
+
+    def reply(self, code: int, result: typing.Any) -> None:
+        data = json.dumps(result).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format: str, *args: typing.Any) -> None:
+        pass
+
+
+# Backends, on their own process
+async def echo(client, address) -> None:
+    buffer = memoryview(bytearray(CLIENT_BUFFER))
+    async with client:
+        while True:
+            received = await client.recv_into(buffer)
+            if not received:
+                break
+            await client.sendall(buffer[:received])
+
+
+async def sink(client, address) -> None:
+    buffer = memoryview(bytearray(CLIENT_BUFFER))
+    async with client:
+        while await client.recv_into(buffer):
+            pass
+
+
+async def backends(echo_sock, sink_sock) -> None:
+    async with curio.TaskGroup() as grp:
+        await grp.spawn(curio.network.run_server, echo_sock, echo)
+        await grp.spawn(curio.network.run_server, sink_sock, sink)
+
+
+# Clients
+def client_context() -> ssl.SSLContext:
+    context = ssl.create_default_context()
+    context.check_hostname = False
+    context.verify_mode = ssl.CERT_NONE
+    return context
+
+
+async def open_tunnel(port: int, context: ssl.SSLContext, tkt: bytes):
+    sock = await curio.open_connection(
+        '127.0.0.1', port, ssl=context, server_hostname='localhost'
+    )
+    try:
+        await sock.sendall(consts.HANDSHAKE_V1 + consts.COMMAND_OPEN + tkt)
+        response = await sock.recv(32)
+        if response != b'OK':
+            raise Exception(f'OPEN failed: {response!r}')
+    except BaseException:
+        await sock.close()
+        raise
+    return sock
+
+
+async def setup_clients(port: int, count: int, concurrency: int) -> typing.Tuple[typing.List[float], int, typing.List[typing.Any]]:
+    """
+    Opens count tunnels (at most concurrency at a time), measuring setup time of each one.
+    Opened tunnels are returned (idle), along with setup times and errors count.
+    """
+    context = client_context()
+    latencies: typing.List[float] = []
+    errors = 0
+    sockets = []
+    semaphore = curio.Semaphore(concurrency)
+
+    async def one(n: int) -> None:
+        nonlocal errors
+        async with semaphore:
+            start = time.perf_counter()
+            try:
+                sockets.append(await open_tunnel(port, context, ticket(SINK_TICKET, n)))
+                latencies.append(time.perf_counter() - start)
+            except Exception:
+                errors += 1
+
+    async with curio.TaskGroup() as grp:
+        for n in range(count):
+            await grp.spawn(one, n)
+
+    return latencies, errors, sockets
+
+
+def setup_process(
+    port: int,
+    count: int,
+    concurrency: int,
+    results: multiprocessing.Queue,
+    hold: typing.Any,
+) -> None:
+    async def run() -> None:
+        latencies, errors, sockets = await setup_clients(port, count, concurrency)
+        results.put((latencies, errors))
+        await curio.run_in_thread(hold.wait)
+        for sock in sockets:
+            await sock.close()
+
+    curio.run(run)
+
+
+def stream_process(
+    port: int, streams: int, seconds: float, backend: str, first: int, results: multiprocessing.Queue
+) -> None:
+    async def stream(n: int) -> int:
+        sock = await open_tunnel(port, client_context(), ticket(backend, first + n))
+        data = memoryview(bytearray(CLIENT_BUFFER))
+        sent = 0
+        deadline = time.monotonic() + seconds
+        async with sock:
+            if backend == ECHO_TICKET:
+                async def reader() -> None:
+                    buffer = memoryview(bytearray(CLIENT_BUFFER))
+                    while await sock.recv_into(buffer):
+                        pass
+
+                read_task = await curio.spawn(reader)
+            while time.monotonic() < deadline:
+                await sock.sendall(data)
+                sent += len(data)
+            if backend == ECHO_TICKET:
+                await read_task.cancel()
+        return sent
+
+    async def run() -> None:
+        tasks = [await curio.spawn(stream, n) for n in range(streams)]
+        total = 0
+        for task in tasks:
+            try:
+                total += await task.join()
+            except curio.TaskError:
+                pass
+        results.put(total)
+
+    curio.run(run)
+
+
+# Tunnel server processes accounting, from /proc
+def process_tree(pid: int) -> typing.List[int]:
+    parents: typing.Dict[int, int] = {}
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry}/stat') as f:
+                parents[int(entry)] = int(f.read().rsplit(')', 1)[1].split()[1])
+        except Exception:
+            pass  # Process gone
+    tree, pending = [], [pid]
+    while pending:
+        current = pending.pop()
+        tree.append(current)
+        pending.extend(p for p, parent in parents.items() if parent == current)
+    return tree
+
+
+def rss_bytes(pids: typing.Iterable[int]) -> int:
+    total = 0
+    for pid in pids:
+        try:
+            with open(f'/proc/{pid}/status') as f:
+                for line in f:
+                    if line.startswith('VmRSS:'):
+                        total += int(line.split()[1]) * 1024
+        except Exception:
+            pass
+    return total
+
+
+def cpu_seconds(pids: typing.Iterable[int]) -> float:
+    total = 0
+    for pid in pids:
+        try:
+            with open(f'/proc/{pid}/stat') as f:
+                fields = f.read().rsplit(')', 1)[1].split()
+            total += int(fields[11]) + int(fields[12])  # utime + stime
+        except Exception:
+            pass
+    return total / os.sysconf('SC_CLK_TCK')
+
+
+def relayed_bytes(metrics_port: int) -> typing.Dict[int, int]:
+    """
+    Bytes relayed (sent + received) by every tunnel server worker, from its metrics endpoint
+    """
+    with urllib.request.urlopen(f'http://127.0.0.1:{metrics_port}/metrics', timeout=10) as r:
+        lines = r.read().decode().splitlines()
+    relayed: typing.Dict[int, int] = {}
+    for line in lines:
+        for name in ('udstunnel_sent_bytes_total', 'udstunnel_recv_bytes_total'):
+            prefix = name + '{worker="'
+            if line.startswith(prefix):
+                worker, value = line[len(prefix):].split('"} ')
+                relayed[int(worker)] = relayed.get(int(worker), 0) + int(value)
+    return relayed
+
+
+def start_server(workdir: str, workers: int, port: int, broker_port: int, metrics_port: int) -> subprocess.Popen:
+    cert, key = os.path.join(workdir, 'cert.pem'), os.path.join(workdir, 'key.pem')
+    subprocess.run(
+        [
+            'openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '1',
+            '-subj', '/CN=localhost', '-keyout', key, '-out', cert,
+        ],
+        check=True,
+        capture_output=True,
+    )
+    config_file = os.path.join(workdir, 'udstunnel.conf')
+    with open(config_file, 'w') as f:
+        f.write(
+            '\n'.join(
+                [
+                    'address = 127.0.0.1',
+                    f'port = {port}',
+                    f'metrics_port = {metrics_port}',
+                    f'workers = {workers}',
+                    'loglevel = ERROR',
+                    'drain_timeout = 5',
+                    f'logfile = {os.path.join(workdir, "udstunnel.log")}',
+                    f'ssl_certificate = {cert}',
+                    f'ssl_certificate_key = {key}',
+                    f'uds_server = http://127.0.0.1:{broker_port}/',
+                    'secret = benchmark',
+                    'allow = 127.0.0.1',
+                    '',
+                ]
+            )
+        )
+    server = subprocess.Popen(
+        [sys.executable, 'udstunnel.py', '-t', '-c', config_file],
+        cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    )
+    # Wait until tunnel is ready
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection(('127.0.0.1', port)) as s:
+                with client_context().wrap_socket(s) as tls:
+                    tls.sendall(consts.HANDSHAKE_V1 + consts.COMMAND_TEST)
+                    if tls.recv(2) == b'OK':
+                        return server
+        except Exception:
+            time.sleep(0.2)
+    server.terminate()
+    raise Exception('Tunnel server did not start')
+
+
+def benchmark(args: argparse.Namespace) -> typing.Dict[str, typing.Any]:
+    echo_sock = curio.network.tcp_server_socket('127.0.0.1', 0)
+    sink_sock = curio.network.tcp_server_socket('127.0.0.1', 0)
+    backends_process = multiprocessing.Process(
+        target=curio.run, args=(backends, echo_sock, sink_sock), daemon=True
+    )
+    backends_process.start()
+
+    broker = Broker(
+        {
+            ECHO_TICKET: echo_sock.getsockname()[1],
+            SINK_TICKET: sink_sock.getsockname()[1],
+        }
+    )
+    threading.Thread(target=broker.serve_forever, daemon=True).start()
+
+    port, metrics_port = free_port(), free_port()
+    results: typing.Dict[str, typing.Any] = {
+        'workers': args.workers,
+        'tunnels': args.tunnels,
+        'streams': args.streams,
+        'backend': 'echo' if args.backend == ECHO_TICKET else 'sink',
+    }
+    with tempfile.TemporaryDirectory() as workdir:
+        server = start_server(workdir, args.workers, port, broker.server_address[1], metrics_port)
+        try:
+            time.sleep(1)  # Let workers settle
+            pids = process_tree(server.pid)
+            rss_before = rss_bytes(pids)
+
+            # Setup latency, and memory of idle tunnels
+            queue: multiprocessing.Queue = multiprocessing.Queue()
+            hold = multiprocessing.Event()
+            setup = multiprocessing.Process(
+                target=setup_process,
+                args=(port, args.tunnels, args.concurrency, queue, hold),
+            )
+            wall = time.perf_counter()
+            setup.start()
+            latencies, errors = queue.get()
+            wall = time.perf_counter() - wall
+            time.sleep(1)
+            rss_idle = rss_bytes(pids)
+            hold.set()
+            setup.join()
+
+            results['setup'] = {
+                'opened': len(latencies),
+                'errors': errors,
+                'tunnels_per_second': len(latencies) / wall,
+                **percentiles(latencies),
+            }
+            results['memory'] = {
+                'rss_bytes': rss_before,
+                'rss_bytes_idle_tunnels': rss_idle,
+                'bytes_per_idle_tunnel': (rss_idle - rss_before) / len(latencies)
+                if latencies
+                else 0.0,
+            }
+
+            # Sustained throughput
+            streamers = [
+                multiprocessing.Process(
+                    target=stream_process,
+                    args=(
+                        port,
+                        args.streams // args.client_processes
+                        + (1 if i < args.streams % args.client_processes else 0),
+                        args.seconds,
+                        args.backend,
+                        args.tunnels + i * args.streams,
+                        queue,
+                    ),
+                )
+                for i in range(args.client_processes)
+            ]
+            by_worker = relayed_bytes(metrics_port)
+            cpu, wall = cpu_seconds(pids), time.perf_counter()
+            for p in streamers:
+                p.start()
+            sent = sum(queue.get() for _ in streamers)
+            cpu, wall = cpu_seconds(pids) - cpu, time.perf_counter() - wall
+            for p in streamers:
+                p.join()
+            time.sleep(1)  # Closed tunnels counters, and pending stop notifications
+            by_worker = {
+                worker: relayed - by_worker.get(worker, 0)
+                for worker, relayed in relayed_bytes(metrics_port).items()
+            }
+
+            # With echo backend, every byte is relayed twice (to backend and back)
+            relayed = sent * (2 if args.backend == ECHO_TICKET else 1)
+            gbits = relayed * 8 / 1e9
+            results['throughput'] = {
+                'bytes': relayed,
+                'seconds': wall,
+                'mb_per_second': relayed / wall / (1024 * 1024),
+                # Workers (stats slots) that relayed something, as counted by tunnel server
+                'mb_per_second_per_worker': {
+                    str(worker): value / wall / (1024 * 1024)
+                    for worker, value in sorted(by_worker.items())
+                    if value
+                },
+                'cpu_seconds': cpu,
+                'cpu_seconds_per_gbit': cpu / gbits if gbits else 0.0,
+            }
+            results['broker'] = {'opened': broker.opened, 'stopped': broker.stopped}
+        finally:
+            server.terminate()
+            server.wait()
+            broker.shutdown()
+            backends_process.terminate()
+
+    return results
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Tunnel server load benchmark')
+    parser.add_argument('--workers', type=int, default=2, help='Tunnel server workers (default 2)')
+    parser.add_argument('--tunnels', type=int, default=500, help='Idle tunnels opened for setup latency and memory (default 500)')
+    parser.add_argument('--concurrency', type=int, default=50, help='Tunnels being opened at a time (default 50)')
+    parser.add_argument('--streams', type=int, default=8, help='Tunnels sending data for throughput (default 8)')
+    parser.add_argument('--client-processes', type=int, default=2, help='Processes used by streaming clients (default 2)')
+    parser.add_argument('--seconds', type=float, default=10, help='Seconds of streaming (default 10)')
+    parser.add_argument('--backend', choices=('echo', 'sink'), default='sink', help='Backend for streaming tunnels (default sink)')
+    args = parser.parse_args()
+    args.backend = ECHO_TICKET if args.backend == 'echo' else SINK_TICKET
+    args.client_processes = max(1, min(args.client_processes, args.streams))
+
+    print(json.dumps(benchmark(args), indent=2))
+
+
+if __name__ == '__main__':
+    main()
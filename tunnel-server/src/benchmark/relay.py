@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2021 Virtual Cable S.L.U.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without modification,
+# are permitted provided that the following conditions are met:
+#
+#    * Redistributions of source code must retain the above copyright notice,
+#      this list of conditions and the following disclaimer.
+#    * Redistributions in binary form must reproduce the above copyright notice,
+#      this list of conditions and the following disclaimer in the documentation
+#      and/or other materials provided with the distribution.
+#    * Neither the name of Virtual Cable S.L. nor the names of its contributors
+#      may be used to endorse or promote products derived from this software
+#      without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+'''
+Relay micro benchmark.
+
+Pushes data through a local relay (client -> relay -> echo server -> relay -> client),
+all on same process, and reports MB/s and MB/s per cpu core of the previous relay
+loop (recv + sendall) and the current Proxy.doProxy.
+
+Run from tunnel server src folder:
+    python -m benchmark.relay [--size MB] [--chunk BYTES]
+
+@author: Adolfo Gómez, dkmaster at dkmon dot com
+'''
+import argparse
+import json
+import time
+import typing
+
+import curio
+import curio.network
+
+from uds_tunnel import consts
+from uds_tunnel import proxy
+from uds_tunnel import stats
+
+
+async def legacy_relay(source, destination, counter: stats.StatsSingleCounter) -> None:
+    # Relay loop used before buffer reusing one, kept as baseline
+    while True:
+        data = await source.recv(consts.BUFFER_SIZE)
+        if not data:
+            break
+        await destination.sendall(data)
+        counter.add(len(data))
+
+
+async def echo(client, address) -> None:
+    buffer = memoryview(bytearray(consts.BUFFER_SIZE_MAX))
+    async with client:
+        while True:
+            received = await client.recv_into(buffer)
+            if not received:
+                break
+            await client.sendall(buffer[:received])
+
+
+def listener() -> typing.Tuple[typing.Any, int]:
+    sock = curio.network.tcp_server_socket('127.0.0.1', 0)
+    return sock, sock.getsockname()[1]
+
+
+async def run(relay: typing.Callable, size: int, chunk: int) -> typing.Dict[str, float]:
+    echo_sock, echo_port = listener()
+    relay_sock, relay_port = listener()
+    worker_stats = stats.GlobalStats(1).for_worker(0)
+
+    async def relay_handler(client, address) -> None:
+        counter = stats.Stats(worker_stats)
+        destination = await curio.open_connection('127.0.0.1', echo_port)
+        async with client, destination:
+            async with curio.TaskGroup(wait=any) as grp:
+                await grp.spawn(relay, client, destination, counter.as_sent_counter())
+                await grp.spawn(relay, destination, client, counter.as_recv_counter())
+        counter.close()
+
+    echo_task = await curio.spawn(curio.network.run_server, echo_sock, echo)
+    relay_task = await curio.spawn(curio.network.run_server, relay_sock, relay_handler)
+
+    data = memoryview(bytearray(chunk))
+    wall, cpu = time.perf_counter(), time.process_time()
+
+    sock = await curio.open_connection('127.0.0.1', relay_port)
+
+    async def sender() -> None:
+        sent = 0
+        while sent < size:
+            await sock.sendall(data[: min(chunk, size - sent)])
+            sent += chunk
+
+    async with sock:
+        send_task = await curio.spawn(sender)
+        buffer = memoryview(bytearray(consts.BUFFER_SIZE_MAX))
+        received = 0
+        while received < size:
+            count = await sock.recv_into(buffer)
+            if not count:
+                break
+            received += count
+        await send_task.join()
+
+    wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+    await relay_task.cancel()
+    await echo_task.cancel()
+
+    # Every byte is relayed twice (to echo server and back)
+    mbytes = 2 * received / (1024 * 1024)
+    return {
+        'mbytes': mbytes,
+        'seconds': wall,
+        'cpu_seconds': cpu,
+        'mb_per_second': mbytes / wall,
+        'mb_per_second_per_core': mbytes / cpu if cpu else 0.0,
+    }
+
+
+async def benchmark(size: int, chunk: int) -> None:
+    results = {
+        'legacy': await run(legacy_relay, size, chunk),
+        'current': await run(proxy.Proxy.doProxy, size, chunk),
+    }
+    print(json.dumps(results, indent=2))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Tunnel relay micro benchmark')
+    parser.add_argument('--size', type=int, default=1024, help='MB to transfer on each run (default 1024)')
+    parser.add_argument('--chunk', type=int, default=64 * 1024, help='Client write size in bytes (default 65536)')
+    args = parser.parse_args()
+
+    curio.run(benchmark, args.size * 1024 * 1024, args.chunk)
+
+
+if __name__ == '__main__':
+    main()
@@ -51,20 +51,39 @@ class ConfigurationType(typing.NamedTuple):
     listen_port: int
 
     workers: int
+    reuse_port: bool
+    drain_timeout: int
     
     ssl_certificate: str
     ssl_certificate_key: str
     ssl_ciphers: str
     ssl_dhparam: str
+    ssl_share_tickets: bool
+    ssl_ticket_lifetime: int
+    ssl_handshake_threads: int
+
+    tunnel_bandwidth: float
+    ip_bandwidth: float
+    bandwidth_burst: float
+
+    metrics_address: str
+    metrics_port: int
 
     uds_server: str
+    uds_timeout: float
+    uds_connections: int
+
+    ticket_cache_time: int
+    ip_block_failures: int
+    ip_block_time: int
 
     secret: str
     allow: typing.Set[str]
     
 
-def read() -> ConfigurationType:
-    with open(CONFIGFILE, 'r') as f:
+def read(config_file: typing.Optional[str] = None) -> ConfigurationType:
+    config_file = config_file or CONFIGFILE
+    with open(config_file, 'r') as f:
         config_str = '[uds]\n' + f.read()
 
     cfg = configparser.ConfigParser()
@@ -99,15 +118,30 @@ def read() -> ConfigurationType:
             listen_address=uds.get('address', '0.0.0.0'),
             listen_port=int(uds.get('port', '443')),
             workers=int(uds.get('workers', '0')) or multiprocessing.cpu_count(),
+            reuse_port=uds.getboolean('reuse_port', False),
+            drain_timeout=int(uds.get('drain_timeout', '3600')),
             ssl_certificate=uds['ssl_certificate'],
             ssl_certificate_key=uds['ssl_certificate_key'],
             ssl_ciphers=uds.get('ssl_ciphers'),
             ssl_dhparam=uds.get('ssl_dhparam'),
+            ssl_share_tickets=uds.getboolean('ssl_share_tickets', False),
+            ssl_ticket_lifetime=int(uds.get('ssl_ticket_lifetime', '3600')),
+            ssl_handshake_threads=int(uds.get('ssl_handshake_threads', '0')),
+            tunnel_bandwidth=float(uds.get('tunnel_bandwidth', '0')),
+            ip_bandwidth=float(uds.get('ip_bandwidth', '0')),
+            bandwidth_burst=float(uds.get('bandwidth_burst', '1')),
+            metrics_address=uds.get('metrics_address', '127.0.0.1'),
+            metrics_port=int(uds.get('metrics_port', '0')),
             uds_server=uds_server,
+            uds_timeout=float(uds.get('uds_timeout', '10')),
+            uds_connections=int(uds.get('uds_connections', '16')),
+            ticket_cache_time=int(uds.get('ticket_cache_time', '60')),
+            ip_block_failures=int(uds.get('ip_block_failures', '0')),
+            ip_block_time=int(uds.get('ip_block_time', '60')),
             secret=secret,
             allow=set(uds.get('allow', '127.0.0.1').split(',')),
         )
     except ValueError as e:
-        raise Exception(f'Mandatory configuration file in incorrect format: {e.args[0]}. Please, revise  {CONFIGFILE}')
+        raise Exception(f'Mandatory configuration file in incorrect format: {e.args[0]}. Please, revise  {config_file}')
     except KeyError as e:
-        raise Exception(f'Mandatory configuration parameter not found: {e.args[0]}. Please, revise {CONFIGFILE}')
+        raise Exception(f'Mandatory configuration parameter not found: {e.args[0]}. Please, revise {config_file}')
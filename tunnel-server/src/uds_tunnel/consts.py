@@ -37,16 +37,46 @@ else:
     CONFIGFILE = '/etc/udstunnel.conf'
     LOGFORMAT = '%(levelname)s %(asctime)s %(message)s'
 
-# MAX Length of read buffer for proxyed requests
+# Length of read buffer for proxyed requests
 BUFFER_SIZE = 1024 * 16
+# MAX Length of read buffer for proxyed requests (buffer grows up to this on bulk transfers)
+BUFFER_SIZE_MAX = 1024 * 256
+# Relayed bytes are accounted on stats when this size or this number of chunks is reached
+STATS_BATCH_SIZE = 1024 * 1024
+STATS_BATCH_CHUNKS = 16
 # Handshake for conversation start
 HANDSHAKE_V1 = b'\x5AMGB\xA5\x01\x00'
+# Max time for TLS handshake, in seconds
+HANDSHAKE_TIMEOUT = 10
 # Ticket length
 TICKET_LENGTH = 48
 # Admin password length, (size of an hex sha256)
 PASSWORD_LENGTH = 64
 # Bandwidth calc time lapse
 BANDWIDTH_TIME = 10
+# Ticket chars shown on detailed stats
+TICKET_PREFIX_LENGTH = 8
+# Max live tunnels per worker kept on detailed stats registry
+MAX_TUNNELS_INFO = 2048
+
+# Relays yield control to other relays after transferring (weight *) this bytes
+SHAPING_QUANTUM = 1024 * 64
+# Min weight allowed for a tunnel (from UDS)
+SHAPING_MIN_WEIGHT = 0.1
+
+# Stop notifications to UDS: concurrent senders per worker, retries and base delay
+# between retries (doubled on every retry)
+NOTIFY_SENDERS = 4
+NOTIFY_RETRIES = 5
+NOTIFY_RETRY_DELAY = 2
+# Max seconds a draining worker waits for its pending stop notifications
+NOTIFY_DRAIN_TIMEOUT = 30
+
+# Max entries (refused tickets, failing or blocked ips) kept by every worker invalid tickets guard
+MAX_GUARD_ENTRIES = 16384
+
+# Worker generations that can coexist (active one plus draining ones, on reloads)
+MAX_GENERATIONS = 4
 
 # Commands LENGTH (all same length)
 COMMAND_LENGTH = 4 
@@ -55,4 +85,4 @@ COMMAND_LENGTH = 4
 COMMAND_OPEN = b'OPEN'
 COMMAND_TEST = b'TEST'
 COMMAND_STAT = b'STAT'  # full stats
-COMMAND_INFO = b'INFO'  # Basic stats, currently same as FULL
+COMMAND_INFO = b'INFO'  # Basic stats (global counters only)
@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2021 Virtual Cable S.L.U.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without modification,
+# are permitted provided that the following conditions are met:
+#
+#    * Redistributions of source code must retain the above copyright notice,
+#      this list of conditions and the following disclaimer.
+#    * Redistributions in binary form must reproduce the above copyright notice,
+#      this list of conditions and the following disclaimer in the documentation
+#      and/or other materials provided with the distribution.
+#    * Neither the name of Virtual Cable S.L. nor the names of its contributors
+#      may be used to endorse or promote products derived from this software
+#      without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+'''
+@author: Adolfo Gómez, dkmaster at dkmon dot com
+'''
+import collections
+import time
+import logging
+import typing
+
+from . import config
+from . import consts
+from . import stats
+
+logger = logging.getLogger(__name__)
+
+
+class TicketGuard:
+    """
+    Protects UDS from invalid tickets floods (scanners, misbehaving clients), on a worker.
+    Recently rejected tickets are refused without asking UDS, and source ips with too
+    many rejected tickets are blocked for a while.
+    As all entries of a kind live the same time, they expire in insertion order.
+    """
+    cache_time: float
+    block_failures: int
+    block_time: float
+    rejected_tickets: 'collections.OrderedDict[bytes, float]'  # ticket -> expiration
+    failures: 'collections.OrderedDict[str, typing.Tuple[float, int]]'  # ip -> (expiration, count)
+    blocked: 'collections.OrderedDict[str, float]'  # ip -> expiration
+
+    def __init__(self, cfg: config.ConfigurationType) -> None:
+        self.cache_time = cfg.ticket_cache_time
+        self.block_failures = cfg.ip_block_failures
+        self.block_time = cfg.ip_block_time
+        self.rejected_tickets = collections.OrderedDict()
+        self.failures = collections.OrderedDict()
+        self.blocked = collections.OrderedDict()
+
+    @staticmethod
+    def _expire(entries: 'collections.OrderedDict', now: float, limit: int) -> None:
+        while entries:
+            key, value = next(iter(entries.items()))
+            expiration = value[0] if isinstance(value, tuple) else value
+            if expiration > now and len(entries) <= limit:
+                break
+            del entries[key]
+
+    def check(self, ticket: bytes, ip: str) -> typing.Optional[int]:
+        """
+        Returns the stats counter of the block reason if ticket must be refused, or None
+        """
+        now = time.monotonic()
+        self._expire(self.blocked, now, consts.MAX_GUARD_ENTRIES)
+        if ip in self.blocked:
+            return stats.BLOCKED_IPS
+        self._expire(self.rejected_tickets, now, consts.MAX_GUARD_ENTRIES)
+        if ticket in self.rejected_tickets:
+            self.rejected(ticket, ip, cache=False)  # Counts as a failure of this ip
+            return stats.BLOCKED_TICKETS
+        return None
+
+    def rejected(self, ticket: bytes, ip: str, cache: bool = True) -> None:
+        """
+        Registers a ticket refused by UDS (or malformed) from ip
+        """
+        now = time.monotonic()
+        if cache and self.cache_time:
+            self.rejected_tickets[ticket] = now + self.cache_time
+
+        if not self.block_failures:
+            return
+        self._expire(self.failures, now, consts.MAX_GUARD_ENTRIES)
+        expiration, count = self.failures.get(ip, (now + self.block_time, 0))
+        count += 1
+        if count < self.block_failures:
+            self.failures[ip] = (expiration, count)
+            return
+        # Too many failures, block ip
+        self.failures.pop(ip, None)
+        self.blocked[ip] = now + self.block_time
+        logger.warning('BLOCKED %s for %s seconds (%s invalid tickets)', ip, self.block_time, count)
@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2021 Virtual Cable S.L.U.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without modification,
+# are permitted provided that the following conditions are met:
+#
+#    * Redistributions of source code must retain the above copyright notice,
+#      this list of conditions and the following disclaimer.
+#    * Redistributions in binary form must reproduce the above copyright notice,
+#      this list of conditions and the following disclaimer in the documentation
+#      and/or other materials provided with the distribution.
+#    * Neither the name of Virtual Cable S.L. nor the names of its contributors
+#      may be used to endorse or promote products derived from this software
+#      without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+'''
+@author: Adolfo Gómez, dkmaster at dkmon dot com
+'''
+import json
+import ssl
+import time
+import logging
+import typing
+import urllib.parse
+
+import curio
+
+logger = logging.getLogger(__name__)
+
+# Idle connections older than this are not reused (server probably closed them)
+MAX_IDLE_TIME = 30
+
+
+class HTTPError(Exception):
+    pass
+
+
+class Response(typing.NamedTuple):
+    status: int
+    headers: typing.Mapping[str, str]
+    content: bytes
+
+    @property
+    def ok(self) -> bool:
+        return 200 <= self.status < 400
+
+    def json(self) -> typing.Any:
+        return json.loads(self.content)
+
+
+class HTTPClient:
+    """
+    Minimal async HTTP/1.1 client (GET only) for a single server, with a pool
+    of keep-alive connections. One instance per worker process.
+    """
+    host: str
+    port: int
+    path: str
+    timeout: float
+    max_connections: int
+
+    def __init__(self, url: str, timeout: float, max_connections: int) -> None:
+        parsed = urllib.parse.urlsplit(url)
+        self.host = parsed.hostname or 'localhost'
+        self.port = parsed.port or (443 if parsed.scheme == 'https' else 80)
+        self.path = parsed.path.rstrip('/')
+        self.timeout = timeout
+        self.max_connections = max_connections
+        self._ssl = ssl.create_default_context() if parsed.scheme == 'https' else None
+        self._hostHeader = parsed.netloc.encode()
+        self._idle: typing.List[typing.Tuple[float, typing.Any]] = []
+        self._semaphore = curio.Semaphore(max_connections)
+
+    async def _connect(self) -> typing.Any:
+        sock = await curio.open_connection(
+            self.host,
+            self.port,
+            ssl=self._ssl,
+            server_hostname=self.host if self._ssl else None,
+        )
+        return sock.as_stream()
+
+    async def _acquire(self) -> typing.Optional[typing.Any]:
+        # Most recently used first, so the older ones expire
+        now = time.monotonic()
+        while self._idle:
+            stamp, stream = self._idle.pop()
+            if now - stamp < MAX_IDLE_TIME:
+                return stream
+            await stream.close()
+        return None
+
+    def _release(self, stream: typing.Any) -> None:
+        self._idle.append((time.monotonic(), stream))
+
+    async def _request(self, stream: typing.Any, path: str) -> typing.Tuple[Response, bool]:
+        await stream.write(
+            b'GET '
+            + path.encode()
+            + b' HTTP/1.1\r\nHost: '
+            + self._hostHeader
+            + b'\r\nContent-Type: application/json\r\nConnection: keep-alive\r\n\r\n'
+        )
+
+        statusLine = await stream.readline()
+        if not statusLine:
+            raise ConnectionResetError('Connection closed by server')
+        try:
+            version, status = statusLine.split(b' ', 2)[:2]
+            statusCode = int(status)
+        except Exception:
+            raise HTTPError(f'Invalid response: {statusLine!r}')
+
+        headers: typing.Dict[str, str] = {}
+        while True:
+            line = await stream.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+
+        keepAlive = (
+            version == b'HTTP/1.1'
+            and headers.get('connection', '').lower() != 'close'
+        )
+        if headers.get('transfer-encoding', '').lower() == 'chunked':
+            parts = []
+            while True:
+                size = int((await stream.readline()).split(b';')[0], 16)
+                if size == 0:
+                    # Trailers, until empty line
+                    while (await stream.readline()) not in (b'\r\n', b'\n', b''):
+                        pass
+                    break
+                parts.append(await stream.read_exactly(size))
+                await stream.read_exactly(2)  # CRLF after chunk
+            content = b''.join(parts)
+        elif 'content-length' in headers:
+            content = await stream.read_exactly(int(headers['content-length']))
+        else:  # Until connection closes
+            content = await stream.readall()
+            keepAlive = False
+
+        return Response(statusCode, headers, content), keepAlive
+
+    async def get(self, path: str) -> Response:
+        """
+        Gets path (relative to the client url). Timeout is applied to the whole request.
+        A request failing on a reused connection (probably closed by server) is retried on another one.
+        """
+        path = self.path + '/' + path.lstrip('/')
+        async with self._semaphore:
+            try:
+                return await curio.timeout_after(self.timeout, self._get(path))
+            except curio.TaskTimeout:
+                raise TimeoutError(f'Timeout ({self.timeout} seconds) waiting for response')
+
+    async def _get(self, path: str) -> Response:
+        while True:
+            stream = await self._acquire()
+            reused = stream is not None
+            if stream is None:
+                stream = await self._connect()
+            try:
+                response, keepAlive = await self._request(stream, path)
+            except (OSError, EOFError) as e:
+                await stream.close()
+                if reused:
+                    logger.debug('Reused connection failed (%s), retrying', e)
+                    continue
+                raise
+            except BaseException:
+                await stream.close()
+                raise
+
+            if keepAlive:
+                self._release(stream)
+            else:
+                await stream.close()
+            return response
+
+    async def close(self) -> None:
+        while self._idle:
+            await self._idle.pop()[1].close()
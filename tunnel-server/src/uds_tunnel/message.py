@@ -35,6 +35,7 @@ import typing
 class Command(enum.IntEnum):
     TUNNEL = 0
     STATS = 1
+    DRAIN = 2
 
 class Message:
     command: Command
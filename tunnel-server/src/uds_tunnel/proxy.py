@@ -29,50 +29,68 @@
 @author: Adolfo Gómez, dkmaster at dkmon dot com
 '''
 import logging
+import time
 import typing
 
 import curio
-import requests
 
 from . import config
 from . import stats
 from . import consts
-
-if typing.TYPE_CHECKING:
-    from multiprocessing.managers import Namespace
+from . import http_client
+from . import shaping
+from . import guard
 
 logger = logging.getLogger(__name__)
 
 
+class InvalidTicket(Exception):
+    """
+    Ticket is malformed, or not found by UDS
+    """
+
+
 class Proxy:
     cfg: config.ConfigurationType
-    ns: 'Namespace'
+    worker_stats: stats.WorkerStats
+    uds: http_client.HTTPClient
+    notifications: curio.Queue
+    shaping: shaping.Shaping
+    guard: guard.TicketGuard
 
-    def __init__(self, cfg: config.ConfigurationType, ns: 'Namespace') -> None:
+    def __init__(self, cfg: config.ConfigurationType, worker_stats: stats.WorkerStats) -> None:
         self.cfg = cfg
-        self.ns = ns
-
-    @staticmethod
-    def _getUdsUrl(cfg: config.ConfigurationType, ticket: bytes, msg: str) -> typing.MutableMapping[str, typing.Any]:
+        self.worker_stats = worker_stats
+        # Keep alive connections to UDS, shared by all tunnels of this worker
+        self.uds = http_client.HTTPClient(
+            cfg.uds_server, cfg.uds_timeout, cfg.uds_connections
+        )
+        self.notifications = curio.Queue()
+        self.shaping = shaping.Shaping(cfg)
+        self.guard = guard.TicketGuard(cfg)
+
+    async def _getUdsUrl(self, ticket: bytes, msg: str) -> typing.MutableMapping[str, typing.Any]:
+        try:
+            r = await self.uds.get(ticket.decode() + '/' + msg)
+        except Exception as e:
+            raise Exception(f'TICKET COMMS ERROR: {e!s}')
+        # UDS answers 404 for unknown (or expired) tickets. Any other refusal (untrusted
+        # source, broker failures, ...) is not a ticket problem, so it is not cached nor blocked
+        if r.status == 404:
+            raise InvalidTicket('TICKET NOT FOUND')
+        if not r.ok:
+            raise Exception(f'TICKET COMMS ERROR: {r.content!s}')
         try:
-            url = cfg.uds_server + '/' + ticket.decode() + '/' + msg
-            r = requests.get(url, headers={'content-type': 'application/json'})
-            if not r.ok:
-                raise Exception(r.content)
-
             return r.json()
         except Exception as e:
             raise Exception(f'TICKET COMMS ERROR: {e!s}')
-        
 
-    @staticmethod
-    def getFromUds(
-        cfg: config.ConfigurationType, ticket: bytes,
-        address: typing.Tuple[str, int]
+    async def getFromUds(
+        self, ticket: bytes, address: typing.Tuple[str, int]
     ) -> typing.MutableMapping[str, typing.Any]:
         # Sanity checks
         if len(ticket) != consts.TICKET_LENGTH:
-            raise Exception(f'TICKET INVALID (len={len(ticket)})')
+            raise InvalidTicket(f'TICKET INVALID (len={len(ticket)})')
 
         for n, i in enumerate(ticket.decode(errors='ignore')):
             if (
@@ -81,23 +99,91 @@ class Proxy:
                 or (i >= 'A' and i <= 'Z')
             ):
                 continue  # Correctus
-            raise Exception(f'TICKET INVALID (char {i} at pos {n})')
+            raise InvalidTicket(f'TICKET INVALID (char {i} at pos {n})')
 
-        return Proxy._getUdsUrl(cfg, ticket, address[0])
+        return await self._getUdsUrl(ticket, address[0])
 
-    @staticmethod
-    def notifyEndToUds(cfg: config.ConfigurationType, ticket: bytes, counter: stats.Stats) -> None:
+    async def notifyEndToUds(self, ticket: bytes, counter: stats.Stats) -> None:
+        # Queued, so relays never wait for (or fail because of) the broker
         msg = f'stop?sent={counter.sent}&recv={counter.recv}'
-        Proxy._getUdsUrl(cfg, ticket, msg)  # Ignore results
+        await self.notifications.put((ticket, msg, 0))
+
+    async def notifier(self) -> None:
+        """
+        Sends queued stop notifications to UDS, retrying failed ones
+        """
+        async def requeue(item: typing.Tuple[bytes, str, int]) -> None:
+            await curio.sleep(consts.NOTIFY_RETRY_DELAY * 2 ** item[2])
+            await self.notifications.put((item[0], item[1], item[2] + 1))
+            # Done after requeued, so pending notifications are never seen as 0 (drain)
+            await self.notifications.task_done()
+
+        async def sender() -> None:
+            while True:
+                item = await self.notifications.get()
+                try:
+                    await self._getUdsUrl(item[0], item[1])  # Ignore results
+                except Exception as e:
+                    # Not found ones will not be found again
+                    if item[2] < consts.NOTIFY_RETRIES and not isinstance(e, InvalidTicket):
+                        logger.info('NOTIFY retrying (%s): %s', item[2] + 1, e)
+                        await curio.spawn(requeue, item, daemon=True)
+                        continue
+                    logger.error('NOTIFY failed: %s', e)
+                await self.notifications.task_done()
+
+        async with curio.TaskGroup() as grp:
+            for _ in range(consts.NOTIFY_SENDERS):
+                await grp.spawn(sender)
 
     @staticmethod
-    async def doProxy(source, destination, counter: stats.StatsSingleCounter) -> None:
-        while True:
-            data = await source.recv(consts.BUFFER_SIZE)
-            if not data:
-                break
-            await destination.sendall(data)
-            counter.add(len(data))
+    async def doProxy(
+        source,
+        destination,
+        counter: stats.StatsSingleCounter,
+        shaper: typing.Optional[shaping.Shaper] = None,
+    ) -> None:
+        # Received data is read into a reused buffer (no allocation per chunk).
+        # Buffer grows (up to consts.BUFFER_SIZE_MAX) while reads fill it (bulk transfers),
+        # and the used part shrinks back on small reads (interactive traffic)
+        # If shaper is present, it limits bandwidth and interleaves this relay with the others
+        size = consts.BUFFER_SIZE
+        buffer = memoryview(bytearray(size))
+        add = counter.add
+        monotonic = time.monotonic
+        pending = chunks = 0
+        flushed = monotonic()
+        try:
+            while True:
+                received = await source.recv_into(buffer[:size])
+                if not received:
+                    break
+                await destination.sendall(buffer[:received])
+                if shaper:
+                    await shaper.consume(received)
+
+                # Stats are accounted in batches, or at least every stats.INTERVAL (low volume tunnels)
+                pending += received
+                chunks += 1
+                if (
+                    pending >= consts.STATS_BATCH_SIZE
+                    or chunks >= consts.STATS_BATCH_CHUNKS
+                    or monotonic() - flushed >= stats.INTERVAL
+                ):
+                    add(pending)
+                    pending = chunks = 0
+                    flushed = monotonic()
+
+                if received == size:
+                    if size < consts.BUFFER_SIZE_MAX:
+                        size *= 2
+                        if size > len(buffer):
+                            buffer = memoryview(bytearray(size))
+                elif received < size // 8 and size > consts.BUFFER_SIZE:
+                    size //= 2
+        finally:
+            if pending:
+                add(pending)
 
     # Method responsible of proxying requests
     async def __call__(self, source, address: typing.Tuple[str, int]) -> None:
@@ -117,7 +203,7 @@ class Proxy:
             await source.sendall(b'FORBIDDEN')
             return
 
-        data = stats.GlobalStats.get_stats(self.ns)
+        data = self.worker_stats.global_stats.info(full)
 
         for v in data:
             logger.debug('SENDING %s', v)
@@ -165,10 +251,20 @@ class Proxy:
             # Now, read a TICKET_LENGTH (64) bytes string, that must be [a-zA-Z0-9]{64}
             ticket: bytes = await source.recv(consts.TICKET_LENGTH)
 
+            # Recently refused tickets, or from blocked ips, are not sent to UDS
+            blocked = self.guard.check(ticket, address[0])
+            if blocked is not None:
+                self.worker_stats.add(blocked, 1)
+                logger.info('BLOCKED TICKET from %s', pretty_adress)
+                await source.sendall(b'ERROR INVALID TICKET')
+                return
+
             # Ticket received, now process it with UDS
             try:
-                result = await curio.run_in_thread(Proxy.getFromUds, self.cfg, ticket, address)
+                result = await self.getFromUds(ticket, address)
             except Exception as e:
+                if isinstance(e, InvalidTicket):
+                    self.guard.rejected(ticket, address[0])
                 logger.error('ERROR %s', e.args[0] if e.args else e)
                 await source.sendall(b'ERROR INVALID TICKET')
                 return
@@ -186,7 +282,12 @@ class Proxy:
         await source.sendall(b'OK')
 
         # Initialize own stats counter
-        counter = stats.Stats(self.ns)
+        counter = stats.Stats(
+            self.worker_stats, address, (result['host'], result['port']), ticket
+        )
+
+        # Bandwidth shaping for both directions
+        sent_shaper, recv_shaper = self.shaping.shapers(address[0], result, counter)
 
         # Open remote server connection
         try:
@@ -195,15 +296,15 @@ class Proxy:
             )
             async with curio.TaskGroup(wait=any) as grp:
                 await grp.spawn(
-                    Proxy.doProxy, source, destination, counter.as_sent_counter()
+                    Proxy.doProxy, source, destination, counter.as_sent_counter(), sent_shaper
                 )
                 await grp.spawn(
-                    Proxy.doProxy, destination, source, counter.as_recv_counter()
+                    Proxy.doProxy, destination, source, counter.as_recv_counter(), recv_shaper
                 )
                 logger.debug('PROXIES READY')
 
             logger.debug('Proxies finalized: %s', grp.exceptions)
-            await curio.run_in_thread(Proxy.notifyEndToUds, self.cfg, result['notify'].encode(), counter)
+            await self.notifyEndToUds(result['notify'].encode(), counter)
 
         except Exception as e:
             if consts.DEBUG:
@@ -211,6 +312,7 @@ class Proxy:
 
             logger.error('REMOTE from %s: %s', address, e)
         finally:
-            counter.close()  # So we ensure stats are correctly updated on ns
+            self.shaping.release(address[0])
+            counter.close()  # So we ensure stats are correctly updated on global stats
 
         logger.info('TERMINATED %s', ':'.join(str(i) for i in address))
@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2021 Virtual Cable S.L.U.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without modification,
+# are permitted provided that the following conditions are met:
+#
+#    * Redistributions of source code must retain the above copyright notice,
+#      this list of conditions and the following disclaimer.
+#    * Redistributions in binary form must reproduce the above copyright notice,
+#      this list of conditions and the following disclaimer in the documentation
+#      and/or other materials provided with the distribution.
+#    * Neither the name of Virtual Cable S.L. nor the names of its contributors
+#      may be used to endorse or promote products derived from this software
+#      without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+'''
+@author: Adolfo Gómez, dkmaster at dkmon dot com
+'''
+import time
+import logging
+import typing
+
+import curio
+
+from . import config
+from . import consts
+
+if typing.TYPE_CHECKING:
+    from . import stats
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    """
+    Token bucket rate limiter. Tokens are bytes, and may go negative (debt),
+    so consumers sleep the time needed to pay it.
+    """
+    rate: float  # bytes per second
+    burst: float
+    tokens: float
+    last: float
+
+    def __init__(self, rate: float, burst: float) -> None:
+        self.rate = rate
+        self.burst = max(burst, consts.BUFFER_SIZE_MAX)
+        self.tokens = self.burst
+        self.last = time.monotonic()
+
+    def consume(self, size: int) -> float:
+        """
+        Consumes size tokens, returning the seconds the consumer should wait
+        """
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+        self.tokens -= size
+        return -self.tokens / self.rate if self.tokens < 0 else 0.0
+
+
+class Shaper:
+    """
+    Shaping of a relay direction: rate limiting (tunnel and source ip buckets) and
+    fair scheduling with other relays of the worker (relays yield control after
+    transferring weight * consts.SHAPING_QUANTUM bytes)
+    """
+    buckets: typing.List[TokenBucket]
+    weight: float
+    budget: float
+    counter: typing.Optional['stats.Stats']
+
+    def __init__(
+        self,
+        buckets: typing.List[TokenBucket],
+        weight: float,
+        counter: typing.Optional['stats.Stats'] = None,
+    ) -> None:
+        self.buckets = buckets
+        self.weight = weight
+        self.budget = weight * consts.SHAPING_QUANTUM
+        self.counter = counter
+
+    async def consume(self, size: int) -> None:
+        delay = max([b.consume(size) for b in self.buckets], default=0.0)
+        if delay > 0:
+            if self.counter:
+                self.counter.add_throttled(delay)
+            await curio.sleep(delay)
+            return
+
+        self.budget -= size
+        if self.budget <= 0:
+            self.budget += self.weight * consts.SHAPING_QUANTUM
+            await curio.sleep(0)  # Let other relays run
+
+
+class Shaping:
+    """
+    Shapers factory for a worker. Keeps source ips buckets, shared by all tunnels
+    from same ip on this worker.
+    """
+    cfg: config.ConfigurationType
+    ips: typing.Dict[typing.Tuple[str, bool], typing.List[typing.Any]]  # (ip, sent) -> [bucket, references]
+
+    def __init__(self, cfg: config.ConfigurationType) -> None:
+        self.cfg = cfg
+        self.ips = {}
+
+    def _bucket(self, rate: float) -> TokenBucket:
+        return TokenBucket(rate, rate * self.cfg.bandwidth_burst)
+
+    def shapers(
+        self,
+        ip: str,
+        result: typing.Mapping[str, typing.Any],
+        counter: typing.Optional['stats.Stats'] = None,
+    ) -> typing.Tuple[Shaper, Shaper]:
+        """
+        Returns (sent, received) shapers for a tunnel. Broker result can override
+        tunnel bandwidth ("bandwidth", in KB/s, 0 is unlimited) and "weight".
+        Must be paired with a call to release.
+        """
+        try:
+            rate = float(result.get('bandwidth', self.cfg.tunnel_bandwidth)) * 1024
+            weight = max(float(result.get('weight', 1)), consts.SHAPING_MIN_WEIGHT)
+        except (TypeError, ValueError):
+            logger.warning('Invalid shaping parameters from UDS: %s', result)
+            rate, weight = self.cfg.tunnel_bandwidth * 1024, 1.0
+
+        shapers = []
+        for sent in (True, False):
+            buckets = [self._bucket(rate)] if rate > 0 else []
+            if self.cfg.ip_bandwidth > 0:
+                entry = self.ips.setdefault(
+                    (ip, sent), [self._bucket(self.cfg.ip_bandwidth * 1024), 0]
+                )
+                entry[1] += 1
+                buckets.append(entry[0])
+            shapers.append(Shaper(buckets, weight, counter))
+        return shapers[0], shapers[1]
+
+    def release(self, ip: str) -> None:
+        for sent in (True, False):
+            entry = self.ips.get((ip, sent))
+            if entry:
+                entry[1] -= 1
+                if entry[1] <= 0:
+                    del self.ips[(ip, sent)]
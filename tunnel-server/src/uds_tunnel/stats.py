@@ -28,14 +28,18 @@
 '''
 @author: Adolfo Gómez, dkmaster at dkmon dot com
 '''
+import collections
+import ctypes
+import datetime
+import http.server
 import multiprocessing
+import multiprocessing.sharedctypes
+import signal
 import time
 import logging
 import typing
 import io
 import ssl
-import logging
-import typing
 
 import curio
 
@@ -43,11 +47,53 @@ from . import config
 from . import consts
 
 
-if typing.TYPE_CHECKING:
-    from multiprocessing.managers import Namespace, SyncManager
-
 INTERVAL = 2  # Interval in seconds between stats update
 
+# Counters kept for every worker
+(
+    CURRENT,
+    TOTAL,
+    SENT,
+    RECV,
+    HANDSHAKES,
+    RESUMED,
+    HANDSHAKE_ERRORS,
+    HANDSHAKE_USECS,
+    THROTTLED_USECS,
+    BLOCKED_TICKETS,
+    BLOCKED_IPS,
+) = range(11)
+COUNTERS = 11
+
+# Worker states (of every stats slot)
+WORKER_UNUSED = 0
+WORKER_ACTIVE = 1
+WORKER_DRAINING = 2  # Not accepting tunnels, waiting for live ones to finish
+
+# Max length of texts stored on live tunnels registry (longer ones are truncated)
+ADDRESS_LENGTH = 46  # Enough for an IPv6 address
+HOST_LENGTH = 96
+
+
+class TunnelInfo(ctypes.Structure):
+    """
+    Live tunnel information, as stored on shared memory registry
+    """
+    _fields_ = [
+        ('in_use', ctypes.c_bool),
+        ('source', ctypes.c_char * ADDRESS_LENGTH),
+        ('host', ctypes.c_char * HOST_LENGTH),
+        ('port', ctypes.c_int32),
+        ('ticket', ctypes.c_char * consts.TICKET_PREFIX_LENGTH),
+        ('start', ctypes.c_double),
+        ('updated', ctypes.c_double),
+        ('sent', ctypes.c_int64),
+        ('recv', ctypes.c_int64),
+        ('sent_rate', ctypes.c_double),
+        ('recv_rate', ctypes.c_double),
+        ('throttled', ctypes.c_double),
+    ]
+
 logger = logging.getLogger(__name__)
 
 class StatsSingleCounter:
@@ -63,29 +109,52 @@ class StatsSingleCounter:
 
 
 class Stats:
-    ns: 'Namespace'
+    owner: 'WorkerStats'
     last_sent: int
     sent: int
     last_recv: int
     recv: int
     last: float
+    throttled: float
+    info: typing.Optional[TunnelInfo]
+    samples: typing.Deque[typing.Tuple[float, int, int]]
 
-    def __init__(self, ns: 'Namespace'):
-        self.ns = ns
-        self.ns.current += 1
-        self.ns.total += 1
+    def __init__(
+        self,
+        owner: 'WorkerStats',
+        source: typing.Tuple[str, int] = ('', 0),
+        destination: typing.Tuple[str, int] = ('', 0),
+        ticket: bytes = b'',
+    ):
+        self.owner = owner
+        self.owner.add(CURRENT, 1)
+        self.owner.add(TOTAL, 1)
         self.sent = self.last_sent = 0
         self.recv = self.last_recv = 0
         self.last = time.monotonic()
+        self.throttled = 0.0
+        # Samples for throughput calculation (over last consts.BANDWIDTH_TIME seconds)
+        self.samples = collections.deque([(self.last, 0, 0)])
+        self.info = owner.register(source, destination, ticket)
 
     def update(self, force: bool = False):
         now = time.monotonic()
         if force or now - self.last > INTERVAL:
             self.last = now
-            self.ns.recv += self.recv - self.last_recv
-            self.ns.sent += self.sent - self.last_sent
+            self.owner.add(RECV, self.recv - self.last_recv)
+            self.owner.add(SENT, self.sent - self.last_sent)
             self.last_sent = self.sent
             self.last_recv = self.recv
+            if self.info:
+                self.samples.append((now, self.sent, self.recv))
+                while len(self.samples) > 2 and now - self.samples[1][0] >= consts.BANDWIDTH_TIME:
+                    self.samples.popleft()
+                elapsed = max(now - self.samples[0][0], INTERVAL)
+                self.info.sent_rate = (self.sent - self.samples[0][1]) / elapsed
+                self.info.recv_rate = (self.recv - self.samples[0][2]) / elapsed
+                self.info.sent = self.sent
+                self.info.recv = self.recv
+                self.info.updated = time.time()
 
     def add_recv(self, size: int) -> None:
         self.recv += size
@@ -95,6 +164,12 @@ class Stats:
         self.sent += size
         self.update()
 
+    def add_throttled(self, seconds: float) -> None:
+        self.throttled += seconds
+        self.owner.add(THROTTLED_USECS, int(seconds * 1000000))
+        if self.info:
+            self.info.throttled = self.throttled
+
     def as_sent_counter(self) -> 'StatsSingleCounter':
         return StatsSingleCounter(self, False)
 
@@ -103,32 +178,290 @@ class Stats:
 
     def close(self):
         self.update(True)
-        self.ns.current -= 1
+        self.owner.add(CURRENT, -1)
+        if self.info:
+            self.owner.unregister(self.info)
+            self.info = None
 
-# Stats collector thread
+
+# Global stats, shared by all workers
 class GlobalStats:
-    manager: 'SyncManager'
-    ns: 'Namespace'
-    counter: int
+    """
+    Counters are kept on shared memory, with an slot for every worker.
+    Every worker only writes to its own slot (so no locks and no IPC are needed),
+    and readers sum all slots.
+    """
+    workers: int
+    counters: typing.Any  # ctypes array on shared memory
+    states: typing.Any  # Worker state (WORKER_*) of every slot
+    tunnels: typing.Any  # Live tunnels registry, consts.MAX_TUNNELS_INFO slots per worker
+
+    def __init__(self, workers: int):
+        self.workers = workers
+        self.counters = multiprocessing.sharedctypes.RawArray(
+            ctypes.c_int64, workers * COUNTERS
+        )
+        self.states = multiprocessing.sharedctypes.RawArray(ctypes.c_int8, workers)
+        self.tunnels = multiprocessing.sharedctypes.RawArray(
+            TunnelInfo, workers * consts.MAX_TUNNELS_INFO
+        )
+
+    def for_worker(self, worker: int) -> 'WorkerStats':
+        return WorkerStats(self, worker)
+
+    def get(self, counter: int, worker: typing.Optional[int] = None) -> int:
+        if worker is not None:
+            return self.counters[worker * COUNTERS + counter]
+        return sum(self.counters[counter::COUNTERS])
 
-    def __init__(self):
-        super().__init__()
-        self.manager = multiprocessing.Manager()
-        self.ns = self.manager.Namespace()
+    def reset(self, worker: int) -> None:
+        # Used when a worker is replaced, live connections died with it
+        self.counters[worker * COUNTERS + CURRENT] = 0
+        base = worker * consts.MAX_TUNNELS_INFO
+        for i in range(base, base + consts.MAX_TUNNELS_INFO):
+            self.tunnels[i].in_use = False
 
-        # Counters
-        self.ns.current = 0
-        self.ns.total = 0
-        self.ns.sent = 0
-        self.ns.recv = 0
-        self.counter = 0
+    def set_state(self, worker: int, state: int) -> None:
+        self.states[worker] = state
 
-    def info(self) -> typing.Iterable[str]:
-        return GlobalStats.get_stats(self.ns)
+    def count_state(self, state: int) -> int:
+        return sum(1 for s in self.states if s == state)
+
+    def live_tunnels(
+        self,
+    ) -> typing.Iterable[typing.Tuple[int, typing.Dict[str, typing.Any]]]:
+        """
+        Returns a (worker, info) tuple for every live tunnel.
+        Throughput of tunnels without recent traffic is reported as 0.
+        """
+        now = time.time()
+        for i, info in enumerate(self.tunnels):
+            if not info.in_use:
+                continue
+            idle = now - info.updated > consts.BANDWIDTH_TIME
+            yield i // consts.MAX_TUNNELS_INFO, {
+                'source': info.source.decode(errors='replace'),
+                'host': info.host.decode(errors='replace'),
+                'port': info.port,
+                'ticket': info.ticket.decode(errors='replace'),
+                'start': info.start,
+                'sent': info.sent,
+                'recv': info.recv,
+                'sent_rate': 0.0 if idle else info.sent_rate,
+                'recv_rate': 0.0 if idle else info.recv_rate,
+                'throttled': info.throttled,
+            }
+
+    def info(self, full: bool = False) -> typing.Iterable[str]:
+        return GlobalStats.get_stats(self, full)
 
     @staticmethod
-    def get_stats(ns: 'Namespace') -> typing.Iterable[str]:
-        yield ';'.join([str(ns.current), str(ns.total), str(ns.sent), str(ns.recv)])
+    def get_stats(global_stats: 'GlobalStats', full: bool = False) -> typing.Iterable[str]:
+        yield ';'.join(
+            str(global_stats.get(counter)) for counter in (CURRENT, TOTAL, SENT, RECV)
+        )
+        if not full:
+            return
+        yield ';'.join(
+            [
+                'WORKERS',
+                str(global_stats.count_state(WORKER_ACTIVE)),
+                str(global_stats.count_state(WORKER_DRAINING)),
+            ]
+        )
+        yield ';'.join(
+            [
+                'BLOCKED',
+                str(global_stats.get(BLOCKED_TICKETS)),
+                str(global_stats.get(BLOCKED_IPS)),
+            ]
+        )
+        # One line per live tunnel
+        for worker, t in global_stats.live_tunnels():
+            yield ';'.join(
+                [
+                    str(worker),
+                    t['source'],
+                    f'{t["host"]}:{t["port"]}',
+                    t['ticket'],
+                    datetime.datetime.fromtimestamp(t['start']).isoformat(timespec='seconds'),
+                    str(t['sent']),
+                    str(t['recv']),
+                    f'{t["sent_rate"]:.0f}',
+                    f'{t["recv_rate"]:.0f}',
+                    f'{t["throttled"]:.1f}',
+                ]
+            )
+
+    def prometheus(self) -> typing.Iterable[str]:
+        """
+        Stats in Prometheus text exposition format
+        """
+        def escape(value: str) -> str:
+            return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+        for name, counter, kind, help in (
+            ('udstunnel_tunnels_current', CURRENT, 'gauge', 'Live tunnels'),
+            ('udstunnel_tunnels_total', TOTAL, 'counter', 'Tunnels opened'),
+            ('udstunnel_sent_bytes_total', SENT, 'counter', 'Bytes sent from clients to services'),
+            ('udstunnel_recv_bytes_total', RECV, 'counter', 'Bytes received from services to clients'),
+            ('udstunnel_tls_handshakes_total', HANDSHAKES, 'counter', 'TLS handshakes completed'),
+            ('udstunnel_tls_resumed_total', RESUMED, 'counter', 'TLS handshakes that resumed a session'),
+            ('udstunnel_tls_handshake_errors_total', HANDSHAKE_ERRORS, 'counter', 'TLS handshakes failed'),
+            ('udstunnel_blocked_tickets_total', BLOCKED_TICKETS, 'counter', 'Tunnels refused because ticket was recently refused'),
+            ('udstunnel_blocked_ips_total', BLOCKED_IPS, 'counter', 'Tunnels refused because source ip was blocked'),
+        ):
+            yield f'# HELP {name} {help}'
+            yield f'# TYPE {name} {kind}'
+            for worker in range(self.workers):
+                yield f'{name}{{worker="{worker}"}} {self.get(counter, worker)}'
+
+        for name, counter, help in (
+            ('udstunnel_tls_handshake_seconds_total', HANDSHAKE_USECS, 'Time spent on completed TLS handshakes'),
+            ('udstunnel_throttled_seconds_total', THROTTLED_USECS, 'Time relays waited because of bandwidth limits'),
+        ):
+            yield f'# HELP {name} {help}'
+            yield f'# TYPE {name} counter'
+            for worker in range(self.workers):
+                yield f'{name}{{worker="{worker}"}} {self.get(counter, worker) / 1000000}'
+
+        name = 'udstunnel_workers'
+        yield f'# HELP {name} Worker processes, active (accepting tunnels) or draining'
+        yield f'# TYPE {name} gauge'
+        for state, label in ((WORKER_ACTIVE, 'active'), (WORKER_DRAINING, 'draining')):
+            yield f'{name}{{state="{label}"}} {self.count_state(state)}'
+
+        tunnels = list(self.live_tunnels())
+        for name, field, kind, help in (
+            ('udstunnel_tunnel_start_time_seconds', 'start', 'gauge', 'Tunnel start time'),
+            ('udstunnel_tunnel_sent_bytes', 'sent', 'gauge', 'Bytes sent from client to service on tunnel'),
+            ('udstunnel_tunnel_recv_bytes', 'recv', 'gauge', 'Bytes received from service to client on tunnel'),
+            ('udstunnel_tunnel_sent_rate_bytes', 'sent_rate', 'gauge', 'Bytes per second sent on tunnel'),
+            ('udstunnel_tunnel_recv_rate_bytes', 'recv_rate', 'gauge', 'Bytes per second received on tunnel'),
+            ('udstunnel_tunnel_throttled_seconds', 'throttled', 'gauge', 'Time tunnel waited because of bandwidth limits'),
+        ):
+            yield f'# HELP {name} {help}'
+            yield f'# TYPE {name} {kind}'
+            for worker, t in tunnels:
+                labels = ','.join(
+                    [
+                        f'worker="{worker}"',
+                        f'source="{escape(t["source"])}"',
+                        f'destination="{escape(t["host"])}:{t["port"]}"',
+                        f'ticket="{escape(t["ticket"])}"',
+                    ]
+                )
+                yield f'{name}{{{labels}}} {t[field]}'
+
+
+class WorkerStats:
+    """
+    Slot of global stats owned by a worker
+    """
+    global_stats: GlobalStats
+    worker: int
+
+    def __init__(self, global_stats: GlobalStats, worker: int):
+        self.global_stats = global_stats
+        self.worker = worker
+        self._base = worker * COUNTERS
+
+        # Free slots of this worker on live tunnels registry (only this worker writes them)
+        base = worker * consts.MAX_TUNNELS_INFO
+        self._free = list(range(base + consts.MAX_TUNNELS_INFO - 1, base - 1, -1))
+
+    def add(self, counter: int, value: int) -> None:
+        self.global_stats.counters[self._base + counter] += value
+
+    def register(
+        self,
+        source: typing.Tuple[str, int],
+        destination: typing.Tuple[str, int],
+        ticket: bytes,
+    ) -> typing.Optional[TunnelInfo]:
+        if not self._free:  # Registry full, tunnel will not be detailed
+            return None
+        info = self.global_stats.tunnels[self._free.pop()]
+        info.source = source[0].encode()[:ADDRESS_LENGTH]
+        info.host = str(destination[0]).encode()[:HOST_LENGTH]
+        info.port = int(destination[1])
+        info.ticket = ticket[: consts.TICKET_PREFIX_LENGTH]
+        info.start = info.updated = time.time()
+        info.sent = info.recv = 0
+        info.sent_rate = info.recv_rate = info.throttled = 0.0
+        info.in_use = True  # Last, so readers do not see half filled info
+        return info
+
+    def unregister(self, info: TunnelInfo) -> None:
+        info.in_use = False
+        self._free.append(
+            (ctypes.addressof(info) - ctypes.addressof(self.global_stats.tunnels))
+            // ctypes.sizeof(TunnelInfo)
+        )
+
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    global_stats: typing.ClassVar[GlobalStats]
+
+    def do_GET(self) -> None:
+        if self.path != '/metrics':
+            self.send_error(404)
+            return
+        body = ('\n'.join(self.global_stats.prometheus()) + '\n').encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format: str, *args: typing.Any) -> None:
+        logger.debug('METRICS %s', format % args)
+
+
+def _serve_metrics(server: http.server.ThreadingHTTPServer) -> None:
+    # Main process controls this process life
+    for signum in (signal.SIGINT, signal.SIGHUP):
+        signal.signal(signum, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    server.serve_forever()
+
+
+class MetricsServer:
+    """
+    Serves stats in Prometheus format on cfg.metrics_address:cfg.metrics_port.
+    Requests are served (with threads) on its own process, so main process, that forks
+    workers, never runs any thread. Port is bound on creation, so errors are raised here.
+    """
+    server: http.server.ThreadingHTTPServer
+    process: typing.Optional[multiprocessing.Process]
+
+    def __init__(self, cfg: config.ConfigurationType, global_stats: GlobalStats) -> None:
+        handler = type('Handler', (MetricsHandler,), {'global_stats': global_stats})
+        self.server = http.server.ThreadingHTTPServer((cfg.metrics_address, cfg.metrics_port), handler)
+        self.server.daemon_threads = True
+        self.process = None
+        logger.info('METRICS listening on %s:%s', cfg.metrics_address, cfg.metrics_port)
+
+    def start(self) -> None:
+        self.process = multiprocessing.Process(
+            target=_serve_metrics, args=(self.server,), name='metrics', daemon=True
+        )
+        self.process.start()
+
+    def check(self) -> None:
+        # Restarts the serving process if it died
+        if self.process and not self.process.is_alive():
+            logger.error('METRICS process died (exit code %s), RESTARTING', self.process.exitcode)
+            self.process.join()
+            self.start()
+
+    def stop(self) -> None:
+        if self.process:
+            self.process.terminate()
+            self.process.join()
+            self.process = None
+        self.server.server_close()
+
 
 # Stats processor, invoked from command line
 async def getServerStats(detailed: bool = False) -> None:
@@ -0,0 +1,227 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2021 Virtual Cable S.L.U.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without modification,
+# are permitted provided that the following conditions are met:
+#
+#    * Redistributions of source code must retain the above copyright notice,
+#      this list of conditions and the following disclaimer.
+#    * Redistributions in binary form must reproduce the above copyright notice,
+#      this list of conditions and the following disclaimer in the documentation
+#      and/or other materials provided with the distribution.
+#    * Neither the name of Virtual Cable S.L. nor the names of its contributors
+#      may be used to endorse or promote products derived from this software
+#      without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+'''
+@author: Adolfo Gómez, dkmaster at dkmon dot com
+'''
+import _ssl
+import ctypes
+import multiprocessing.sharedctypes
+import os
+import platform
+import select
+import socket
+import ssl
+import time
+import logging
+import typing
+
+import curio
+import curio.io
+import curio.ssl
+
+from . import config
+from . import consts
+from . import stats
+
+logger = logging.getLogger(__name__)
+
+# Session tickets key (OpenSSL >= 1.1): 16 bytes name + 32 bytes HMAC secret + 32 bytes AES key
+TICKET_KEY_LENGTH = 80
+SSL_CTRL_SET_TLSEXT_TICKET_KEYS = 59
+
+
+def _libssl() -> typing.Optional[typing.Any]:
+    """
+    Returns the OpenSSL library the ssl module is linked with (symbols are resolved
+    through the _ssl module itself, so it is the very same library, wherever it is)
+    """
+    try:
+        lib = ctypes.CDLL(_ssl.__file__)
+        lib.SSL_CTX_ctrl.restype = ctypes.c_long
+        lib.SSL_CTX_ctrl.argtypes = [ctypes.c_void_p, ctypes.c_int, ctypes.c_long, ctypes.c_void_p]
+        return lib
+    except Exception as e:
+        logger.warning('OpenSSL symbols not accessible, session ticket keys will not be shared: %s', e)
+        return None
+
+
+def _ssl_ctx(context: ssl.SSLContext) -> typing.Optional[int]:
+    """
+    Returns the SSL_CTX pointer of an ssl.SSLContext. On CPython, it is the first field
+    of the context object after the object header, so this is only done on CPython and if
+    the context object is big enough to hold it.
+    """
+    pointer_offset = object.__basicsize__
+    if (
+        platform.python_implementation() != 'CPython'
+        or type(context).__basicsize__ < pointer_offset + ctypes.sizeof(ctypes.c_void_p)
+    ):
+        logger.warning('SSL_CTX not accessible, session ticket keys will not be shared')
+        return None
+    return ctypes.c_void_p.from_address(id(context) + pointer_offset).value
+
+
+class TicketKeys:
+    """
+    Session tickets key, on shared memory, so a session resumes on any worker.
+
+    The main process rotates it, and workers apply it to their contexts when changed.
+    Writes are guarded with a sequence counter (odd while writing), so readers can
+    discard half written keys.
+    """
+    key: typing.Any
+    sequence: typing.Any
+
+    def __init__(self) -> None:
+        self.key = multiprocessing.sharedctypes.RawArray(ctypes.c_char, TICKET_KEY_LENGTH)
+        self.sequence = multiprocessing.sharedctypes.RawValue(ctypes.c_int64, 0)
+        self.rotated = 0.0
+        self.rotate()
+
+    def rotate(self) -> None:
+        self.sequence.value += 1
+        self.key.raw = os.urandom(TICKET_KEY_LENGTH)
+        self.sequence.value += 1
+        self.rotated = time.monotonic()
+
+    def read(self) -> typing.Optional[typing.Tuple[int, bytes]]:
+        sequence = self.sequence.value
+        key = self.key.raw
+        if sequence % 2 or sequence != self.sequence.value:
+            return None  # Being rotated, try again later
+        return sequence, key
+
+
+class ServerContext:
+    """
+    TLS server side of a worker: context, shared session tickets key and handshakes
+    (with metrics, and optionally offloaded to a bounded number of threads)
+    """
+    context: typing.Any  # curio.ssl.CurioSSLContext
+    ticket_keys: typing.Optional[TicketKeys]
+    worker_stats: stats.WorkerStats
+
+    def __init__(
+        self,
+        cfg: config.ConfigurationType,
+        ticket_keys: typing.Optional[TicketKeys],
+        worker_stats: stats.WorkerStats,
+    ) -> None:
+        self.context = curio.ssl.SSLContext(curio.ssl.PROTOCOL_TLS_SERVER)
+        self.context.load_cert_chain(cfg.ssl_certificate, cfg.ssl_certificate_key)
+
+        if cfg.ssl_ciphers:
+            self.context.set_ciphers(cfg.ssl_ciphers)
+
+        if cfg.ssl_dhparam:
+            self.context.load_dh_params(cfg.ssl_dhparam)
+
+        self.worker_stats = worker_stats
+        self.ticket_keys = ticket_keys
+        self._sequence = 0
+        self._lib = _libssl() if ticket_keys else None
+        self._ctx = _ssl_ctx(self.context._context) if self._lib else None
+        self._threads = (
+            curio.Semaphore(cfg.ssl_handshake_threads)
+            if cfg.ssl_handshake_threads
+            else None
+        )
+
+    def update_ticket_key(self) -> None:
+        if not self._ctx or not self.ticket_keys:
+            return
+        if self.ticket_keys.sequence.value == self._sequence:
+            return
+        current = self.ticket_keys.read()
+        if not current:
+            return
+        sequence, key = current
+        buffer = ctypes.create_string_buffer(key, TICKET_KEY_LENGTH)
+        if self._lib.SSL_CTX_ctrl(
+            self._ctx, SSL_CTRL_SET_TLSEXT_TICKET_KEYS, TICKET_KEY_LENGTH, buffer
+        ):
+            self._sequence = sequence
+        else:
+            logger.warning('Could not set session tickets key')
+            self._ctx = None
+
+    def _blocking_handshake(self, sock: socket.socket) -> ssl.SSLSocket:
+        # Whole handshake must be done before deadline (not only every read or write)
+        deadline = time.monotonic() + consts.HANDSHAKE_TIMEOUT
+        sock.setblocking(False)
+        ssl_sock = self.context._context.wrap_socket(
+            sock, server_side=True, do_handshake_on_connect=False
+        )
+        try:
+            while True:
+                try:
+                    ssl_sock.do_handshake()
+                    return ssl_sock
+                except ssl.SSLWantReadError:
+                    wait_read = True
+                except ssl.SSLWantWriteError:
+                    wait_read = False
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise TimeoutError('Handshake timeout')
+                if wait_read:
+                    select.select([ssl_sock], [], [], remaining)
+                else:
+                    select.select([], [ssl_sock], [], remaining)
+        except BaseException:
+            ssl_sock.close()  # Owns the socket now (wrap_socket detaches the original one)
+            raise
+
+    async def handshake(self, sock: curio.io.Socket) -> curio.io.Socket:
+        self.update_ticket_key()
+        start = time.monotonic()
+        try:
+            if self._threads:
+                # Expensive handshakes run on threads, so they do not stall relays on this worker
+                async with self._threads:
+                    ssl_sock = curio.io.Socket(
+                        await curio.run_in_thread(self._blocking_handshake, sock._socket)
+                    )
+            else:
+                ssl_sock = await curio.timeout_after(
+                    consts.HANDSHAKE_TIMEOUT,
+                    self.context.wrap_socket(sock, server_side=True),
+                )
+        except BaseException as e:
+            self.worker_stats.add(stats.HANDSHAKE_ERRORS, 1)
+            if isinstance(e, curio.TaskTimeout):
+                raise TimeoutError('Handshake timeout')
+            raise
+
+        self.worker_stats.add(stats.HANDSHAKES, 1)
+        self.worker_stats.add(
+            stats.HANDSHAKE_USECS, int((time.monotonic() - start) * 1000000)
+        )
+        if ssl_sock._socket.session_reused:
+            self.worker_stats.add(stats.RESUMED, 1)
+        return ssl_sock
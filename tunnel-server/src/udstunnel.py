@@ -32,6 +32,7 @@
 import os
 import pwd
 import sys
+import time
 import argparse
 import multiprocessing
 import signal
@@ -40,23 +41,25 @@ import logging
 import typing
 
 import curio
-import psutil
 
 from uds_tunnel import config
 from uds_tunnel import proxy
 from uds_tunnel import consts
 from uds_tunnel import message
 from uds_tunnel import stats
+from uds_tunnel import tls
 
 if typing.TYPE_CHECKING:
     from multiprocessing.connection import Connection
-    from multiprocessing.managers import Namespace
 
 BACKLOG = 100
+# Seconds between checks of workers health
+SUPERVISE_INTERVAL = 1.0
 
 logger = logging.getLogger(__name__)
 
 do_stop = False
+do_reload = False
 
 
 def stop_signal(signum, frame):
@@ -65,6 +68,12 @@ def stop_signal(signum, frame):
     logger.debug('SIGNAL %s, frame: %s', signum, frame)
 
 
+def reload_signal(signum, frame):
+    global do_reload
+    do_reload = True
+    logger.debug('SIGNAL %s, frame: %s', signum, frame)
+
+
 def setup_log(cfg: config.ConfigurationType) -> None:
     from logging.handlers import RotatingFileHandler
 
@@ -96,80 +105,132 @@ def setup_log(cfg: config.ConfigurationType) -> None:
         log.addHandler(handler)
 
 
+def create_listener(cfg: config.ConfigurationType, reuse_port: bool) -> socket.socket:
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, True)
+    if reuse_port:
+        # Every worker has its own listener, and kernel spreads connections among them
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, True)  # type: ignore
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    sock.bind((cfg.listen_address, cfg.listen_port))
+    sock.listen(BACKLOG)
+    return sock
+
+
 async def tunnel_proc_async(
-    pipe: 'Connection', cfg: config.ConfigurationType, ns: 'Namespace'
+    pipe: 'Connection',
+    cfg: config.ConfigurationType,
+    global_stats: stats.GlobalStats,
+    ticket_keys: typing.Optional[tls.TicketKeys],
+    worker: int,
+    listener: typing.Optional[socket.socket],
 ) -> None:
-    def get_socket(pipe: 'Connection') -> typing.Tuple[socket.SocketType, typing.Any]:
+    def get_message(pipe: 'Connection') -> typing.Optional[message.Message]:
         try:
-            while True:
-                msg: message.Message = pipe.recv()
-                if msg.command == message.Command.TUNNEL and msg.connection:
-                    return msg.connection
-                # Process other messages, and retry
+            return pipe.recv()
         except Exception:
             logger.exception('Receiving data from parent process')
-            return None, None
+            return None
+
+    # Main process controls the worker life (drain)
+    for signum in (signal.SIGINT, signal.SIGTERM, signal.SIGHUP):
+        signal.signal(signum, signal.SIG_IGN)
 
-    async def run_server(
-        pipe: 'Connection', cfg: config.ConfigurationType, group: curio.TaskGroup
-    ) -> None:
-        # Instantiate a proxy redirector for this process (we only need one per process!!)
-        tunneler = proxy.Proxy(cfg, ns)
+    # Instantiate a proxy redirector for this process (we only need one per process!!)
+    tunneler = proxy.Proxy(cfg, global_stats.for_worker(worker))
 
-        # Generate SSL context
-        context = curio.ssl.SSLContext(curio.ssl.PROTOCOL_TLS_SERVER)
-        context.load_cert_chain(cfg.ssl_certificate, cfg.ssl_certificate_key)
+    # Generate SSL context
+    context = tls.ServerContext(cfg, ticket_keys, tunneler.worker_stats)
 
-        if cfg.ssl_ciphers:
-            context.set_ciphers(cfg.ssl_ciphers)
+    own_listener = curio.io.Socket(listener) if listener else None
 
-        if cfg.ssl_dhparam:
-            context.load_dh_params(cfg.ssl_dhparam)
+    # Live tunnels tasks
+    live: typing.Set[curio.Task] = set()
 
+    async def negotiate(sock: curio.io.Socket, address: typing.Tuple[str, int]) -> None:
+        # Handshake is done on its own task, so it does not delay accepting connections
+        try:
+            try:
+                sock = await context.handshake(sock)
+            except Exception as e:
+                logger.error('NEGOTIATION ERROR from %s: %s', address[0], e)
+                await sock.close()
+                return
+            await tunneler(sock, address)
+        finally:
+            live.discard(await curio.current_task())
+
+    async def start_tunnel(sock: curio.io.Socket, address: typing.Tuple[str, int]) -> None:
+        logger.debug(f'CONNECTION from {address!r} (pid: {os.getpid()})')
+        live.add(await curio.spawn(negotiate, sock, address, daemon=True))
+
+    async def accept(listener: curio.io.Socket) -> None:
         while True:
             address = ('', '')
             try:
-                sock, address = await curio.run_in_thread(get_socket, pipe)
-                if not sock:
-                    break
-                logger.debug(
-                    f'CONNECTION from {address!r} (pid: {os.getpid()})'
-                )
-                sock = await context.wrap_socket(
-                    curio.io.Socket(sock), server_side=True
-                )
-                await group.spawn(tunneler, sock, address)
+                sock, address = await listener.accept()
+                await start_tunnel(sock, address)
                 del sock
+            except curio.CancelledError:
+                raise
             except Exception:
-                logger.error('NEGOTIATION ERROR from %s', address[0])
+                logger.error('ACCEPT ERROR from %s', address[0])
+
+    # Stop notifications are sent to UDS on background
+    notifier = await curio.spawn(tunneler.notifier, daemon=True)
+    acceptor = (
+        await curio.spawn(accept, own_listener, daemon=True) if own_listener else None
+    )
+
+    # Messages from main process: connections (on connection passing mode), until
+    # a drain request is received (or main process is gone)
+    while True:
+        msg = await curio.run_in_thread(get_message, pipe)
+        if not msg or msg.command == message.Command.DRAIN:
+            break
+        if msg.command == message.Command.TUNNEL and msg.connection:
+            client, address = msg.connection
+            await start_tunnel(curio.io.Socket(client), address)
+            del client
+
+    # Drain: stop accepting, and let live tunnels finish (up to drain timeout)
+    logger.info('DRAINING worker %s, %s live tunnels', os.getpid(), len(live))
+    if acceptor and own_listener:
+        await acceptor.cancel()
+        await own_listener.close()  # Only this process copy, listener is still used by others
+
+    deadline = time.monotonic() + cfg.drain_timeout
+    while live and time.monotonic() < deadline:
+        await curio.sleep(SUPERVISE_INTERVAL)
+    for task in list(live):
+        await task.cancel()
+
+    # Give some time to pending stop notifications
+    await curio.ignore_after(consts.NOTIFY_DRAIN_TIMEOUT, tunneler.notifications.join())
+    await notifier.cancel()
+    await tunneler.uds.close()
+    logger.info('DRAINED worker %s', os.getpid())
+
+
+class WorkerProcess(typing.NamedTuple):
+    slot: int  # Stats slot
+    pipe: 'Connection'
+    process: multiprocessing.Process
+    deadline: float  # When draining, time to kill it if still running
 
-    async with curio.TaskGroup() as tg:
-        await tg.spawn(run_server, pipe, cfg, tg)
-        # Reap all of the children tasks as they complete
-        async for task in tg:
-            logger.debug(f'REMOVING async task {task!r}')
-            task.joined = True
-            del task
 
+def tunnel_main(config_file: typing.Optional[str] = None) -> None:
+    cfg = config.read(config_file)
 
-def tunnel_main():
-    cfg = config.read()
+    reuse_port = cfg.reuse_port and hasattr(socket, 'SO_REUSEPORT')
 
     # Try to bind to port as running user
-    # Wait for socket incoming connections and spread them
-    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, True)
-    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
-    sock.settimeout(3.0)  # So we can check for stop from time to time
-    # We will not reuse port, we only want a UDS tunnel server running on a port
-    # but this may change on future...
-    # try:
-    #     sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, True)
-    # except (AttributeError, OSError) as e:
-    #     logger.warning('socket.REUSEPORT not available')
+    # On reuse port mode, every worker gets its own listener (created here, before dropping privileges)
+    # and accepts connections directly. If not, we wait for socket incoming connections and spread them
+    listeners: typing.List[socket.socket] = []
     try:
-        sock.bind((cfg.listen_address, cfg.listen_port))
-        sock.listen(BACKLOG)
+        for _ in range(cfg.workers if reuse_port else 1):
+            listeners.append(create_listener(cfg, reuse_port))
 
         # If running as root, and requested drop privileges after port bind
         if os.getuid() == 0 and cfg.user:
@@ -190,63 +251,187 @@ def tunnel_main():
         logger.error('MAIN: %s', e)
         return
 
+    if cfg.reuse_port and not reuse_port:
+        logger.warning('socket.SO_REUSEPORT not available, using connection passing mode')
 
     # Setup signal handlers
     signal.signal(signal.SIGINT, stop_signal)
     signal.signal(signal.SIGTERM, stop_signal)
+    signal.signal(signal.SIGHUP, reload_signal)
+
+    # Stats slots for active workers and for draining ones (of previous generations)
+    stats_collector = stats.GlobalStats(cfg.workers * consts.MAX_GENERATIONS)
+    free_slots = list(range(cfg.workers * consts.MAX_GENERATIONS - 1, -1, -1))
+    # Shared TLS session tickets key, rotated on supervision
+    ticket_keys = (
+        tls.TicketKeys() if cfg.ssl_share_tickets and cfg.ssl_ticket_lifetime else None
+    )
 
-    # Creates as many processes and pipes as required
-    child: typing.List[
-        typing.Tuple['Connection', multiprocessing.Process, psutil.Process]
-    ] = []
-
-    stats_collector = stats.GlobalStats()
-
-    for i in range(cfg.workers):
+    def start_child(index: int, slot: typing.Optional[int] = None) -> WorkerProcess:
+        if slot is None:
+            slot = free_slots.pop()
+        stats_collector.reset(slot)
+        stats_collector.set_state(slot, stats.WORKER_ACTIVE)
         own_conn, child_conn = multiprocessing.Pipe()
         task = multiprocessing.Process(
             target=curio.run,
-            args=(tunnel_proc_async, child_conn, cfg, stats_collector.ns),
+            args=(
+                tunnel_proc_async,
+                child_conn,
+                cfg,
+                stats_collector,
+                ticket_keys,
+                slot,
+                listeners[index] if reuse_port else None,
+            ),
         )
         task.start()
         logger.debug('ADD CHILD PID: %s', task.pid)
-        child.append((own_conn, task, psutil.Process(task.pid)))
+        return WorkerProcess(slot, own_conn, task, 0.0)
+
+    def drain_child(worker: WorkerProcess) -> WorkerProcess:
+        stats_collector.set_state(worker.slot, stats.WORKER_DRAINING)
+        try:
+            worker.pipe.send(message.Message(message.Command.DRAIN, None))
+        except Exception as e:
+            logger.info('DRAINING child %s: %s', worker.process.pid, e)
+        return worker._replace(
+            deadline=time.monotonic() + cfg.drain_timeout + consts.NOTIFY_DRAIN_TIMEOUT
+        )
+
+    def free_child(worker: WorkerProcess) -> None:
+        if worker.process.is_alive():
+            try:
+                worker.process.kill()
+            except Exception as e:
+                logger.info('KILLING child %s: %s', worker.process.pid, e)
+        worker.process.join()
+        stats_collector.reset(worker.slot)
+        stats_collector.set_state(worker.slot, stats.WORKER_UNUSED)
+        free_slots.append(worker.slot)
+
+    # Creates as many processes and pipes as required
+    child: typing.List[WorkerProcess] = [start_child(i) for i in range(cfg.workers)]
+    # Workers of previous generations, finishing their tunnels
+    draining: typing.List[WorkerProcess] = []
+
+    # Metrics are served from its own process, so no thread ever runs on this one (that forks workers)
+    metrics: typing.Optional[stats.MetricsServer] = None
+    if cfg.metrics_port:
+        try:
+            metrics = stats.MetricsServer(cfg, stats_collector)
+            metrics.start()
+        except Exception as e:
+            logger.error('METRICS: %s', e)
+            metrics = None
+
+    last_check = time.monotonic()
+
+    def reload() -> None:
+        # New generation of workers (with new configuration) takes over listeners now,
+        # and current one drains
+        nonlocal cfg, child
+        try:
+            new_cfg = config.read(config_file)
+        except Exception as e:
+            logger.error('RELOAD: %s', e)
+            return
+        # Listening related parameters can only be changed with a full restart
+        cfg = new_cfg._replace(
+            listen_address=cfg.listen_address,
+            listen_port=cfg.listen_port,
+            workers=cfg.workers,
+            reuse_port=cfg.reuse_port,
+            user=cfg.user,
+            pidfile=cfg.pidfile,
+            metrics_address=cfg.metrics_address,
+            metrics_port=cfg.metrics_port,
+        )
+        # Not enough slots for a new generation, oldest draining workers are stopped
+        while len(free_slots) < cfg.workers and draining:
+            free_child(draining.pop(0))
+
+        logger.info('RELOADING workers')
+        old = child
+        child = [start_child(i) for i in range(cfg.workers)]
+        draining.extend(drain_child(w) for w in old)
+
+    def supervise() -> None:
+        # Replace dead workers (on reuse port mode, with same listener)
+        nonlocal last_check
+        last_check = time.monotonic()
+        if ticket_keys and last_check - ticket_keys.rotated > cfg.ssl_ticket_lifetime:
+            ticket_keys.rotate()
+        for i, w in enumerate(child):
+            if not w.process.is_alive():
+                logger.error('CHILD %s DIED (exit code %s), RESTARTING', w.process.pid, w.process.exitcode)
+                w.process.join()
+                child[i] = start_child(i, w.slot)
+        # Remove drained workers (killing the ones out of time)
+        for w in draining[:]:
+            if not w.process.is_alive() or last_check > w.deadline:
+                free_child(w)
+                draining.remove(w)
+        if metrics:
+            metrics.check()
+
+    next_child = 0
 
     def best_child() -> 'Connection':
-        best: typing.Tuple[float, 'Connection'] = (1000.0, child[0][0])
-        for c in child:
-            percent = c[2].cpu_percent()
-            logger.debug('PID %s has %s', c[2].pid, percent)
-            if percent < best[0]:
-                best = (percent, c[0])
-        return best[1]
+        # Worker with less live connections. On ties, round robin
+        nonlocal next_child
+        count = len(child)
+        best = min(
+            range(count),
+            key=lambda i: (
+                stats_collector.get(stats.CURRENT, child[i].slot),
+                (i - next_child) % count,
+            ),
+        )
+        next_child = (best + 1) % count
+        return child[best].pipe
 
+    global do_reload
     try:
+        if not reuse_port:
+            listeners[0].settimeout(SUPERVISE_INTERVAL)  # So we can check for stop from time to time
         while not do_stop:
-            try:
-                client, addr = sock.accept()
-                # Select BEST process for sending this new connection
-                best_child().send(
-                    message.Message(message.Command.TUNNEL, (client, addr))
-                )
-                del client  # Ensure socket is controlled on child process
-            except socket.timeout:
-                pass  # Continue and retry
-            except Exception as e:
-                logger.error('LOOP: %s', e)
+            if do_reload:
+                do_reload = False
+                reload()
+            if reuse_port:
+                time.sleep(SUPERVISE_INTERVAL)
+            else:
+                try:
+                    client, addr = listeners[0].accept()
+                    # Select BEST process for sending this new connection
+                    best_child().send(
+                        message.Message(message.Command.TUNNEL, (client, addr))
+                    )
+                    del client  # Ensure socket is controlled on child process
+                except socket.timeout:
+                    pass  # Continue and retry
+                except Exception as e:
+                    logger.error('LOOP: %s', e)
+            if time.monotonic() - last_check > SUPERVISE_INTERVAL:
+                supervise()
     except Exception as e:
         sys.stderr.write(f'Error: {e}\n')
         logger.error('MAIN: %s', e)
 
-    if sock:
+    for sock in listeners:
         sock.close()
 
-    # Try to stop running childs
-    for i in child:
-        try:
-            i[2].kill()
-        except Exception as e:
-            logger.info('KILLING child %s: %s', i[2], e)
+    # Drain all workers, waiting for them to finish
+    draining.extend(drain_child(w) for w in child)
+    child = []
+    logger.info('STOPPING, waiting for %s workers to drain', len(draining))
+    while draining:
+        time.sleep(SUPERVISE_INTERVAL)
+        supervise()
+
+    if metrics:
+        metrics.stop()
 
     try:
         if cfg.pidfile:
@@ -275,10 +460,13 @@ def main() -> None:
         help='get current detailed stats from RUNNING tunnel',
         action='store_true',
     )
+    parser.add_argument(
+        '-c', '--config', help=f'configuration file (defaults to {consts.CONFIGFILE})'
+    )
     args = parser.parse_args()
 
     if args.tunnel:
-        tunnel_main()
+        tunnel_main(args.config)
     elif args.detailed_stats:
         curio.run(stats.getServerStats, True)
     elif args.stats: